@@ -0,0 +1,304 @@
+import datetime
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+from factories import MarketFactory
+from ssm import Stock
+
+"""
+Reproducible benchmarks for the ssm hot paths, run over synthetic markets from factories.py at several scale tiers.
+Every benchmark reports throughput, per-call latency percentiles and the peak memory traced while it ran, and the whole
+run is written as JSON so two runs can be compared. The run also times importing ssm in fresh interpreters against a
+cold start budget, and checks that the optional heavy dependencies are not loaded by the import.
+
+Usage:
+    python benchmarks.py --tiers small medium --output bench.json
+    python benchmarks.py --output new.json --compare bench.json
+
+Implemented Functions:
+    run_suite
+    measure_import
+    compare
+"""
+
+# name -> (stocks, trades per stock)
+TIERS = {
+    'small': (10, 1000),
+    'medium': (100, 10000),
+    'large': (1000, 10000),
+}
+# price and all_share_index are answered from the price and index caches after their first call; the _uncached
+# variants empty those caches before every call, timing the work a read does after each trade
+BENCHMARKS = ('add_transaction', 'get_transactions_for_last_x_min', 'price', 'price_uncached', 'all_share_index',
+              'all_share_index_uncached', 'all_share_index_incremental', 'list_stocks')
+# cold start budget for importing ssm in a fresh interpreter with its bytecode cached, in milliseconds, counting only
+# ssm and the third-party modules it loads; the standard library modules are shared with any program using it
+IMPORT_BUDGET_MS = 3.0
+# optional dependencies that must load on first use, never when ssm is imported
+LAZY_MODULES = ('numpy', 'regex')
+# short enough that every synthetic trade is still inside the default 15 minute price window when it is read
+_SPAN = datetime.timedelta(minutes=10)
+
+
+def _percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _measure(call, calls):
+    """
+    Times calls to call(i) one by one, then repeats a short run under tracemalloc for its peak memory
+    :return: result dict
+    """
+    timer = time.perf_counter_ns
+    latencies = [0] * calls
+    gc.collect()
+    gc.disable()
+    try:
+        start = timer()
+        for i in range(calls):
+            before = timer()
+            call(i)
+            latencies[i] = timer() - before
+        elapsed = timer() - start
+    finally:
+        gc.enable()
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        for i in range(min(calls, 100)):
+            call(i)
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+    latencies.sort()
+    return {
+        'calls': calls,
+        'seconds': elapsed / 1e9,
+        'ops_per_second': calls / (elapsed / 1e9) if elapsed else None,
+        'p50_us': _percentile(latencies, 0.5) / 1e3,
+        'p90_us': _percentile(latencies, 0.9) / 1e3,
+        'p99_us': _percentile(latencies, 0.99) / 1e3,
+        'max_us': latencies[-1] / 1e3,
+        'peak_memory_bytes': peak,
+    }
+
+
+def _import_times_us(stderr, module):
+    """
+    Parses python -X importtime output, lines of 'import time: self | cumulative | name' in the order the imports
+    finished, each nested import indented under the one that triggered it
+    :return: (cumulative time of module, summed self time of module and the non standard library modules it loaded),
+        in us
+    """
+    subtree = []
+    for line in stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        subtree.append((name, int(fields[0].split(':')[-1]), int(fields[1])))
+        if fields[2][1:2] != ' ':
+            # a top level import closes the subtree of everything it loaded
+            if name == module:
+                own = sum(self_us for imported, self_us, cumulative in subtree
+                          if imported == module or imported.split('.')[0] not in sys.stdlib_module_names)
+                return subtree[-1][2], own
+            subtree = []
+    raise ValueError("no import time reported for %s" % module)
+
+
+def measure_import(module='ssm', runs=5, budget_ms=IMPORT_BUDGET_MS):
+    """
+    Times importing a module in fresh interpreters with python -X importtime. A first run writes the bytecode to a
+    temporary cache so every timed run measures a cold start with compiled modules, as an installed package would.
+    :param module: module name, importable from this directory
+    :param runs: timed imports
+    :param budget_ms: median time allowed for the module and the third-party modules it loads, in milliseconds
+    :return: dict of module, runs, median_ms and max_ms (the whole import), own_ms (the module and third-party
+        modules), budget_ms, eager_modules (members of LAZY_MODULES the import loaded) and within_budget
+    """
+    code = 'import sys, %s; print(",".join(m for m in %r if m in sys.modules))' % (module, LAZY_MODULES)
+    timings = []
+    own = []
+    with tempfile.TemporaryDirectory() as cache:
+        environment = dict(os.environ, PYTHONPYCACHEPREFIX=cache)
+        environment.pop('PYTHONDONTWRITEBYTECODE', None)
+        for run in range(runs + 1):
+            result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=environment,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+                                    check=True)
+            if run:
+                total_us, own_us = _import_times_us(result.stderr, module)
+                timings.append(total_us / 1e3)
+                own.append(own_us / 1e3)
+    timings.sort()
+    own.sort()
+    eager = [name for name in result.stdout.strip().split(',') if name]
+    median = _percentile(own, 0.5)
+    return {'module': module, 'runs': runs, 'median_ms': _percentile(timings, 0.5), 'max_ms': timings[-1],
+            'own_ms': median, 'budget_ms': budget_ms, 'eager_modules': eager,
+            'within_budget': median <= budget_ms and not eager}
+
+
+def _build(stocks, trades, seed, incremental_index=False):
+    return MarketFactory(1, stocks, trades, seed=seed, span=_SPAN, incremental_index=incremental_index).market_list[0]
+
+
+def _setup(name, stocks, trades, seed):
+    """
+    Builds the tier's market under tracemalloc
+    :return: (market, result dict)
+    """
+    # imported up front so the module itself is not counted as market memory
+    import numpy
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        market = _build(stocks, trades, seed)
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return market, {'tier': name, 'stocks': stocks, 'trades': stocks * trades, 'build_seconds': elapsed,
+                    'resident_bytes': current, 'peak_memory_bytes': peak,
+                    'bytes_per_trade': current / (stocks * trades) if trades else None}
+
+
+def _uncached_price(stock):
+    stock._price_cache.clear()
+    return stock.price()
+
+
+def _uncached_index(market, listed):
+    market._index_cache = None
+    for stock in listed:
+        stock._price_cache.clear()
+    return market.all_share_index()
+
+
+def _benchmarks(market, incremental, stocks, trades):
+    """
+    :return: dict of benchmark name -> (call(i), number of calls)
+    """
+    listed = market.stocks
+    fresh = Stock('BENCH')
+    calls = min(stocks * trades, 100000)
+    now = datetime.datetime.now()
+    timestamps = [now + datetime.timedelta(microseconds=i) for i in range(calls)]
+    return {
+        'add_transaction': (lambda i: fresh.add_transaction('buy' if i & 1 else 'sell', 100.0 + i % 7, 10,
+                                                          timestamps[i]),
+                            calls),
+        'get_transactions_for_last_x_min': (lambda i: listed[i % stocks].get_transactions_for_last_x_min(),
+                                            max(stocks, 1000)),
+        'price': (lambda i: listed[i % stocks].price(), max(stocks, 10000)),
+        'price_uncached': (lambda i: _uncached_price(listed[i % stocks]), max(stocks, 10000)),
+        'all_share_index': (lambda i: market.all_share_index(), 20),
+        'all_share_index_uncached': (lambda i: _uncached_index(market, listed), 20),
+        'all_share_index_incremental': (lambda i: incremental.all_share_index(), 10000),
+        'list_stocks': (lambda i: market.list_stocks(), 10000),
+    }
+
+
+def run_suite(tiers=('small', 'medium'), benchmarks=BENCHMARKS, seed=0, import_runs=5,
+              import_budget_ms=IMPORT_BUDGET_MS):
+    """
+    Runs the benchmarks over each tier's synthetic market
+    :param tiers: names from TIERS
+    :param benchmarks: names from BENCHMARKS
+    :param seed: random seed passed to the factories
+    :param import_runs: timed imports of ssm, see measure_import; 0 skips the import check
+    :param import_budget_ms: median time allowed for ssm and the third-party modules it loads, in milliseconds
+    :return: JSON serializable dict of results
+    """
+    report = {
+        'meta': {
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'started': datetime.datetime.now().isoformat(),
+            'seed': seed,
+        },
+        'import': measure_import('ssm', import_runs, import_budget_ms) if import_runs else None,
+        'setup': [],
+        'results': [],
+    }
+    for name in tiers:
+        stocks, trades = TIERS[name]
+        market, setup = _setup(name, stocks, trades, seed)
+        report['setup'].append(setup)
+        incremental = _build(stocks, trades, seed, incremental_index=True)
+        cases = _benchmarks(market, incremental, stocks, trades)
+        with warnings.catch_warnings():
+            # list_stocks warns about large markets on every call
+            warnings.simplefilter('ignore')
+            for benchmark in benchmarks:
+                call, calls = cases[benchmark]
+                result = _measure(call, calls)
+                result.update(tier=name, benchmark=benchmark)
+                report['results'].append(result)
+        del market, incremental, cases
+    return report
+
+
+def compare(old, new, threshold=0.2):
+    """
+    Compares the throughput of two run_suite reports
+    :param old: baseline report
+    :param new: report to check
+    :param threshold: relative slowdown that counts as a regression
+    :return: list of (tier, benchmark, old ops/s, new ops/s, new / old, regressed) for benchmarks in both reports
+    """
+    baseline = dict(((r['tier'], r['benchmark']), r['ops_per_second']) for r in old['results'])
+    rows = []
+    for result in new['results']:
+        key = (result['tier'], result['benchmark'])
+        if key not in baseline or not baseline[key] or not result['ops_per_second']:
+            continue
+        ratio = result['ops_per_second'] / baseline[key]
+        rows.append(key + (baseline[key], result['ops_per_second'], ratio, ratio < 1 - threshold))
+    return rows
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the ssm hot paths over synthetic markets')
+    parser.add_argument('--tiers', nargs='+', default=['small', 'medium'], choices=sorted(TIERS))
+    parser.add_argument('--benchmarks', nargs='+', default=list(BENCHMARKS), choices=BENCHMARKS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', default=None, help='JSON report of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown that fails the comparison')
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET_MS,
+                        help='median milliseconds allowed to import ssm and its third-party dependencies, '
+                             'exceeding it fails the run')
+    arguments = parser.parse_args()
+    report = run_suite(arguments.tiers, arguments.benchmarks, arguments.seed, import_budget_ms=arguments.import_budget)
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    startup = report['import']
+    failed = not startup['within_budget']
+    print('import ssm %.2f ms median, %.2f ms outside the standard library, budget %.2f ms%s%s' % (
+        startup['median_ms'], startup['own_ms'], startup['budget_ms'], '  OVER BUDGET' if failed else '',
+        '  eager imports: %s' % ', '.join(startup['eager_modules']) if startup['eager_modules'] else ''),
+        file=sys.stderr)
+    if arguments.compare:
+        with open(arguments.compare) as baseline:
+            rows = compare(json.load(baseline), report, arguments.threshold)
+        for tier, benchmark, old_ops, new_ops, ratio, regressed in rows:
+            print('%-8s %-32s %14.1f %14.1f %7.2fx%s' % (tier, benchmark, old_ops, new_ops, ratio,
+                                                          '  REGRESSION' if regressed else ''), file=sys.stderr)
+        failed = failed or any(row[-1] for row in rows)
+    if failed:
+        sys.exit(1)
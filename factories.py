@@ -1,24 +1,128 @@
-from ssm import Market, Stock, Transaction
+import datetime
+import random
+from string import ascii_uppercase
+
+from ssm import Market, Stock, datetime_to_ns, timedelta_to_ns
+
+"""
+Factories for synthetic markets, used by the benchmarks and handy in tests. Everything is seeded so a given set of
+arguments always builds the same market. Trades are generated with NumPy, imported on first use.
+
+Timestamp distributions for TransactionFactory:
+    uniform: trades spread evenly at random over the span
+    poisson: exponential gaps between trades, i.e. a Poisson arrival process
+    burst:   most trades clustered in a few short bursts, like news driven trading
+"""
+
+DISTRIBUTIONS = ('uniform', 'poisson', 'burst')
+
+
+def ticker_for(n):
+    """
+    n-th ticker in the sequence A, B, ... Z, AA, AB, ... up to 5 letters
+    :param n: non-negative int
+    :return: ticker string
+    """
+    ticker = ''
+    n += 1
+    while n:
+        n, letter = divmod(n - 1, 26)
+        ticker = ascii_uppercase[letter] + ticker
+    if len(ticker) > 5:
+        raise ValueError("ran out of 5 letter tickers")
+    return ticker
+
+
+def timestamps_ns(n, start, span, distribution='uniform', generator=None):
+    """
+    Sorted synthetic trade timestamps
+    :param n: number of timestamps
+    :param start: datetime object the span begins at
+    :param span: datetime.timedelta object
+    :param distribution: one of DISTRIBUTIONS
+    :param generator: numpy.random.Generator to draw from
+    :return: NumPy int64 array of epoch-ns
+    """
+    import numpy as np
+    generator = generator or np.random.default_rng(0)
+    start_ns = datetime_to_ns(start)
+    span_ns = timedelta_to_ns(span)
+    if distribution == 'uniform':
+        offsets = generator.random(n)
+    elif distribution == 'poisson':
+        offsets = np.cumsum(generator.exponential(1.0, n))
+        if n:
+            offsets /= offsets[-1]
+    elif distribution == 'burst':
+        centres = generator.random(5)
+        offsets = np.clip(generator.normal(centres[generator.integers(0, 5, n)], 0.01), 0.0, 1.0)
+        background = generator.random(n) >= 0.9
+        offsets[background] = generator.random(int(background.sum()))
+    else:
+        raise ValueError("distribution must be one of %s" % ', '.join(DISTRIBUTIONS))
+    return np.sort(start_ns + (offsets * span_ns).astype('i8'))
 
 
 class TransactionFactory:
-    def __init__(self, market, no_of_transactions):
-        self.signal_options = ['buy', 'sell']
+    def __init__(self, market, no_of_transactions, start=None, span=datetime.timedelta(minutes=15),
+                 distribution='uniform', seed=0):
+        """
+            Args:
+                market: Market whose stocks receive the trades
+                no_of_transactions: trades per stock
+                start: datetime the trades begin at, defaults to span before now
+                span: datetime.timedelta the trades are spread over
+                distribution: timestamp distribution, one of DISTRIBUTIONS
+                seed: random seed
+        """
+        import numpy as np
+        generator = np.random.default_rng(seed)
+        if start is None:
+            start = datetime.datetime.now() - span
         for stock in market.stocks:
-            for transaction_no in range(no_of_transactions):
-                transaction = Transaction()
-                stock.add_transaction(transaction)
+            # random walk from a random opening price, rounded to pennies
+            walk = np.cumprod(1 + generator.normal(0, 0.001, no_of_transactions))
+            prices = np.maximum(np.round(generator.uniform(10, 500) * walk, 2), 0.01)
+            # signals as flags, 1 buy and 0 sell
+            stock.add_transactions(generator.integers(0, 2, no_of_transactions), prices,
+                                   generator.integers(1, 1001, no_of_transactions).astype('f8'),
+                                   timestamps_ns(no_of_transactions, start, span, distribution, generator))
 
 
 class StockFactory:
-    def __init__(self, no_of_stocks):
+    def __init__(self, no_of_stocks, seed=0):
+        """
+            Args:
+                no_of_stocks: number of stocks to create, with tickers A, B, ... in order
+                seed: random seed
+        """
+        generator = random.Random(seed)
         self.stock_list = []
-        self.stock_name_options = []
-        self.stock_list.append(Stock())
+        self.stock_name_options = [ticker_for(i) for i in range(no_of_stocks)]
+        for ticker in self.stock_name_options:
+            if generator.random() < 0.2:
+                self.stock_list.append(Stock(ticker, stock_type='preferred', last_dividend=generator.randint(0, 20),
+                                             fixed_dividend=round(generator.uniform(0.01, 0.1), 2), par_value=100))
+            else:
+                self.stock_list.append(Stock(ticker, last_dividend=generator.randint(0, 20), par_value=100))
 
 
 class MarketFactory:
-    def __init__(self, no_of_markets):
+    def __init__(self, no_of_markets, no_of_stocks=0, no_of_transactions=0, seed=0, incremental_index=False,
+                 **transaction_options):
+        """
+            Args:
+                no_of_markets: number of markets to create
+                no_of_stocks: stocks listed in each market
+                no_of_transactions: trades per stock
+                seed: random seed
+                incremental_index: build markets that maintain the All Share Index incrementally
+                transaction_options: passed on to TransactionFactory, e.g. span or distribution
+        """
         self.market_list = []
         for i in range(no_of_markets):
-            self.market_list.append(Market())
\ No newline at end of file
+            market = Market(incremental_index=incremental_index)
+            market.add_stocks(StockFactory(no_of_stocks, seed=seed + i).stock_list)
+            if no_of_transactions:
+                TransactionFactory(market, no_of_transactions, seed=seed + i, **transaction_options)
+            self.market_list.append(market)
@@ -0,0 +1,376 @@
+import asyncio
+import datetime
+import json
+import logging
+import math
+import os
+import random
+import time
+
+from ssm import Market, Stock, datetime_to_ns
+
+"""
+asyncio market data gateway for the ssm Market. Feed handlers send trades over a local TCP or Unix socket, the
+gateway batches them into Market.ingest and pushes VWAP and All Share Index updates to subscribers.
+
+Wire protocol, one message per line:
+    trade:      ticker,signal,price,volume,timestamp_ns[,sent_ns]
+    subscribe:  SUBSCRIBE
+A subscribed connection receives one JSON object per line, either
+    {"type": "vwap", "ticker": ..., "price": ..., "sent_ns": ...}
+    {"type": "index", "value": ..., "sent_ns": ...}
+where sent_ns is the earliest send time of the trades in the batch that caused the update, so a subscriber can
+measure publish latency. The index is only published for a Market(incremental_index=True).
+
+Backpressure: trades go through a bounded queue, so when ingestion falls behind the gateway stops reading sockets
+and TCP flow control pushes back on the senders. Each subscriber has its own bounded queue; a slow subscriber has its
+oldest updates dropped rather than stalling the feed.
+
+Rejections: malformed trades and trades for tickers that are not listed are rejected one by one. A batch that
+Market.ingest or one of its listeners raises on is logged and counted as rejected, and batching carries on.
+
+Gateway:
+    Usage:
+        gateway = Gateway(LSE)
+        await gateway.start(port=9000)
+
+    Implemented Methods:
+        start
+        stop
+
+Implemented Functions:
+    simulate
+    subscribe
+    benchmark
+"""
+
+_SUBSCRIBE = b'SUBSCRIBE'
+_log = logging.getLogger(__name__)
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Gateway:
+    """
+    Batches socket trade messages into a Market and publishes derived prices
+    """
+    def __init__(self, market, batch_size=5000, batch_interval=0.002, queue_size=100000, subscriber_queue_size=10000,
+                 stock_type='common'):
+        """
+            Args:
+                market: Market the trades are recorded in
+                batch_size: most trades ingested in one Market.ingest call
+                batch_interval: seconds to wait for a batch to fill before ingesting what has arrived
+                queue_size: trades buffered before readers stop reading their sockets
+                subscriber_queue_size: updates buffered per subscriber before the oldest are dropped
+                stock_type: type of the listings the tickers refer to
+        """
+        self._market = market
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._queue = None
+        self._queue_size = queue_size
+        self._subscriber_queue_size = subscriber_queue_size
+        self._stock_type = stock_type
+        self._subscribers = []
+        self._server = None
+        self._path = None
+        self._batcher = None
+        self.received = 0
+        self.rejected = 0
+        self.ingested = 0
+        self.published = 0
+        self.dropped = 0
+
+    address = property(lambda self: self._server.sockets[0].getsockname() if self._server else None)
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        """
+        Starts listening and ingesting
+        :param host: TCP interface
+        :param port: TCP port, 0 picks a free one (see address)
+        :param path: Unix socket path, used instead of TCP when given
+        :return:
+        """
+        self._queue = asyncio.Queue(self._queue_size)
+        self._batcher = asyncio.ensure_future(self._ingest())
+        self._path = path
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._on_connection, path=path)
+        else:
+            self._server = await asyncio.start_server(self._on_connection, host, port)
+
+    async def stop(self):
+        """
+        Stops listening, ingests anything still queued and disconnects subscribers
+        :return:
+        """
+        self._server.close()
+        await self._server.wait_closed()
+        if self._path is not None and os.path.exists(self._path):
+            os.remove(self._path)
+        await self._queue.join()
+        self._batcher.cancel()
+        for queue, task in self._subscribers:
+            task.cancel()
+        self._subscribers = []
+
+    async def _on_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if line == _SUBSCRIBE:
+                    await self._serve_subscriber(writer)
+                    return
+                trade = self._parse(line)
+                if trade is None:
+                    self.rejected += 1
+                    continue
+                self.received += 1
+                await self._queue.put(trade)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def _parse(self, line):
+        fields = line.decode('utf-8', 'replace').split(',')
+        if len(fields) not in (5, 6):
+            return None
+        try:
+            ticker, signal = fields[0], fields[1].lower()
+            price, volume = float(fields[2]), float(fields[3])
+            timestamp_ns = int(fields[4])
+            sent_ns = int(fields[5]) if len(fields) == 6 else time.time_ns()
+        except ValueError:
+            return None
+        # an inf or nan would fail validation of the whole ingest batch it lands in
+        if not (math.isfinite(price) and math.isfinite(volume)):
+            return None
+        if signal not in ('buy', 'sell') or price < 0 or volume < 0:
+            return None
+        try:
+            self._market.get(ticker, self._stock_type)
+        except LookupError:
+            return None
+        return ticker, signal, price, volume, timestamp_ns, sent_ns
+
+    async def _ingest(self):
+        queue = self._queue
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self._batch_interval
+            while len(batch) < self._batch_size:
+                if queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(queue.get_nowait())
+            try:
+                # trades for a stock delisted after they were queued are rejected on their own
+                listed = self._listed({trade[0] for trade in batch})
+                trades = [trade for trade in batch if trade[0] in listed]
+                self.rejected += len(batch) - len(trades)
+                if not trades:
+                    continue
+                tickers, signals, prices, volumes, timestamps, sent = zip(*trades)
+                try:
+                    self._market.ingest(tickers, signals, prices, volumes, timestamps, stock_type=self._stock_type)
+                except Exception:
+                    # the batcher must keep draining the queue whatever a listener or the market raises, or stop
+                    # would wait on it forever
+                    _log.exception("Gateway rejected a batch of %d trades", len(trades))
+                    self.rejected += len(trades)
+                    continue
+                self.ingested += len(trades)
+                if self._subscribers:
+                    self._publish(set(tickers), min(sent))
+            except Exception:
+                _log.exception("Gateway failed to publish updates")
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    def _listed(self, tickers):
+        listed = set()
+        for ticker in tickers:
+            try:
+                self._market.get(ticker, self._stock_type)
+            except LookupError:
+                continue
+            listed.add(ticker)
+        return listed
+
+    def _publish(self, tickers, sent_ns):
+        updates = []
+        for ticker in tickers:
+            price = self._market.get(ticker, self._stock_type)._price()
+            if price is not None:
+                updates.append({'type': 'vwap', 'ticker': ticker, 'price': price, 'sent_ns': sent_ns})
+        if self._market.incremental_index:
+            index = self._market.all_share_index()
+            if index is not None:
+                updates.append({'type': 'index', 'value': index, 'sent_ns': sent_ns})
+        lines = [(json.dumps(update) + '\n').encode('utf-8') for update in updates]
+        for queue, task in self._subscribers:
+            for line in lines:
+                if queue.full():
+                    queue.get_nowait()
+                    self.dropped += 1
+                queue.put_nowait(line)
+        self.published += len(lines)
+
+    async def _serve_subscriber(self, writer):
+        queue = asyncio.Queue(self._subscriber_queue_size)
+        subscriber = (queue, asyncio.current_task())
+        self._subscribers.append(subscriber)
+        try:
+            while True:
+                lines = [await queue.get()]
+                while not queue.empty():
+                    lines.append(queue.get_nowait())
+                writer.write(b''.join(lines))
+                await writer.drain()
+        finally:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+
+async def _connect(address):
+    if isinstance(address, str):
+        return await asyncio.open_unix_connection(address)
+    return await asyncio.open_connection(*address[:2])
+
+
+async def simulate(address, trades, rate=None, chunk=1000):
+    """
+    Replays trades to a gateway at a fixed rate, stamping each with its send time
+    :param address: (host, port) or Unix socket path of the gateway
+    :param trades: iterable of (ticker, signal, price, volume, timestamp_ns)
+    :param rate: messages per second, None to send as fast as the gateway accepts them
+    :param chunk: messages written per pacing step
+    :return: number of messages sent
+    """
+    reader, writer = await _connect(address)
+    sent = 0
+    start = time.perf_counter()
+    lines = []
+    for ticker, signal, price, volume, timestamp_ns in trades:
+        lines.append('%s,%s,%r,%r,%d,%d\n' % (ticker, signal, price, volume, timestamp_ns, time.time_ns()))
+        if len(lines) == chunk:
+            writer.write(''.join(lines).encode('utf-8'))
+            await writer.drain()
+            sent += len(lines)
+            lines = []
+            if rate:
+                delay = sent / rate - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+    if lines:
+        writer.write(''.join(lines).encode('utf-8'))
+        sent += len(lines)
+    await writer.drain()
+    writer.close()
+    return sent
+
+
+async def subscribe(address, on_update):
+    """
+    Subscribes to a gateway and calls on_update(update dict, latency in ns) for every update until disconnected
+    :param address: (host, port) or Unix socket path of the gateway
+    :param on_update: callable
+    :return:
+    """
+    reader, writer = await _connect(address)
+    writer.write(_SUBSCRIBE + b'\n')
+    await writer.drain()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            update = json.loads(line.decode('utf-8'))
+            on_update(update, time.time_ns() - update['sent_ns'])
+    finally:
+        writer.close()
+
+
+def synthetic_trades(tickers, n, seed=0):
+    """
+    Random walk trades across tickers, timestamped now
+    :param tickers: list of tickers
+    :param n: number of trades
+    :param seed: random seed
+    :return: generator of (ticker, signal, price, volume, timestamp_ns)
+    """
+    generator = random.Random(seed)
+    prices = dict((ticker, 100.0) for ticker in tickers)
+    for i in range(n):
+        ticker = generator.choice(tickers)
+        prices[ticker] = max(0.01, prices[ticker] * (1 + generator.gauss(0, 0.001)))
+        yield (ticker, generator.choice(('buy', 'sell')), round(prices[ticker], 4), generator.randint(1, 1000),
+               datetime_to_ns(datetime.datetime.now()))
+
+
+async def benchmark(messages=100000, rate=None, stocks=100, path=None):
+    """
+    Runs a gateway, a subscriber and the simulator in one event loop and measures them
+    :param messages: trades to send
+    :param rate: messages per second, None for as fast as possible
+    :param stocks: number of listed stocks
+    :param path: Unix socket path, TCP on localhost when None
+    :return: dict of results
+    """
+    market = Market(incremental_index=True)
+    tickers = ['S%d' % i for i in range(stocks)]
+    market.add_stocks(Stock(ticker) for ticker in tickers)
+    gateway = Gateway(market)
+    await gateway.start(path=path)
+    address = path or gateway.address
+    latencies = []
+    listener = asyncio.ensure_future(subscribe(address, lambda update, latency: latencies.append(latency)))
+    while not gateway._subscribers:
+        await asyncio.sleep(0.001)
+    start = time.perf_counter()
+    await simulate(address, synthetic_trades(tickers, messages), rate)
+    while gateway.ingested + gateway.rejected < messages:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0.05)
+    await gateway.stop()
+    listener.cancel()
+    return {
+        'messages': gateway.ingested,
+        'seconds': elapsed,
+        'messages_per_second': gateway.ingested / elapsed,
+        'updates_published': gateway.published,
+        'updates_dropped': gateway.dropped,
+        'p50_publish_latency_ms': _percentile(latencies, 0.5) / 1e6 if latencies else None,
+        'p99_publish_latency_ms': _percentile(latencies, 0.99) / 1e6 if latencies else None,
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Measure the gateway against the local simulated feed')
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--rate', type=float, default=None, help='messages per second, default unthrottled')
+    parser.add_argument('--stocks', type=int, default=100)
+    parser.add_argument('--unix', default=None, help='Unix socket path instead of TCP')
+    arguments = parser.parse_args()
+    print(json.dumps(asyncio.run(benchmark(arguments.messages, arguments.rate, arguments.stocks, arguments.unix)),
+                     indent=2))
@@ -0,0 +1,343 @@
+import datetime
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+from ssm import Market, Stock, party, timedelta_to_ns
+
+"""
+Persistence for Market state: an append-only binary trade journal plus periodic compact snapshots. Recovery loads
+the latest snapshot and replays only the journal written after it.
+
+Every trade record carries the stock's sequence number of its first row (see Stock.sequence) and a snapshot stores
+each stock's sequence number at the moment it was copied, so a trade that is both in the snapshot and in the journal
+after the snapshot's offset is replayed once.
+
+Retention policies, bar aggregation, tracked price windows and listeners are not persisted, see recover.
+
+Party codes (see ssm.party_code) are only meaningful inside the process that interned them, so attributed trades are
+stored with their codes plus the (trader, book) each code stands for, and re-interned on recovery.
+
+Journal:
+    Attaches to a Market as a listener and appends a record for every trade batch, listing, delisting and metadata
+    change. Records are length prefixed and CRC checked so a torn write at the tail is detected and ignored on
+    recovery. Writes are buffered and fsync'd in batches, every sync_every records or sync_interval seconds.
+
+    Usage:
+        journal = Journal('market.journal')
+        journal.attach(LSE)
+
+    Implemented Methods:
+        attach
+        detach
+        sync
+        close
+
+Implemented Functions:
+    write_snapshot
+    recover
+"""
+
+JOURNAL_MAGIC = b'SSMJRNL2'
+SNAPSHOT_MAGIC = b'SSMSNAP2'
+
+# payload length, crc32 of the payload, record type
+_RECORD_HEADER = struct.Struct('<IIB')
+_KEY = struct.Struct('<H')
+# rows in a trade record, stock sequence number of its first row, 1 if a party code column follows the columns
+_TRADE_HEADER = struct.Struct('<IQB')
+# length of the JSON [code, trader, book] table after a party code column
+_TABLE = struct.Struct('<I')
+_METADATA = struct.Struct('<dddq')
+_SNAPSHOT_HEADER = struct.Struct('<QI')
+
+_TRADES, _LISTED, _DELISTED, _META = range(1, 5)
+_RECORD_TYPES = {'trade': _TRADES, 'listed': _LISTED, 'delisted': _DELISTED, 'meta': _META}
+_COLUMNS = (('timestamps', '<i8'), ('prices', '<f8'), ('volumes', '<f8'), ('sides', 'i1'))
+_PARTY_DTYPE = '<i4'
+
+
+def _key(stock):
+    key = ('%s\0%s' % (stock.ticker, stock.stock_type)).encode('utf-8')
+    return _KEY.pack(len(key)) + key
+
+
+def _metadata(stock):
+    return _METADATA.pack(stock.last_dividend, stock.fixed_dividend, stock.par_value,
+                          timedelta_to_ns(stock.price_window))
+
+
+def _party_table(codes):
+    """
+    [code, trader, book] list for the distinct codes of a party code column, the form stored as JSON
+    """
+    import numpy as np
+    return [[code] + list(party(code)) for code in np.unique(codes).tolist() if code]
+
+
+def _party_names(codes, table):
+    """
+    Trader and book columns for a party code column, from a table written by _party_table
+    """
+    names = {code: (trader, book) for code, trader, book in table}
+    names[0] = (None, None)
+    rows = [names[code] for code in codes.tolist()]
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+
+def _stock_from_metadata(ticker, stock_type, data):
+    last_dividend, fixed_dividend, par_value, window_ns = _METADATA.unpack(data)
+    return Stock(ticker, stock_type=stock_type, last_dividend=last_dividend, fixed_dividend=fixed_dividend,
+                 par_value=par_value, price_window=datetime.timedelta(microseconds=window_ns // 1000))
+
+
+class Journal:
+    """
+    Append-only binary journal of market events
+    """
+    def __init__(self, path, sync_every=1000, sync_interval=1.0):
+        """
+            Args:
+                path: journal file, appended to if it already exists
+                sync_every: fsync after this many records
+                sync_interval: fsync when this many seconds have passed since the last one
+        """
+        self._path = path
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(JOURNAL_MAGIC)
+        self._sync_every = sync_every
+        self._sync_interval = sync_interval
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        self._markets = []
+        # feed handler threads journal trades on different stocks concurrently
+        self._lock = threading.Lock()
+
+    path = property(lambda self: self._path)
+
+    def attach(self, market):
+        """
+        Starts journaling every event of the market
+        :param market: Market
+        :return:
+        """
+        market.add_listener(self._on_event)
+        self._markets.append(market)
+
+    def detach(self, market):
+        """
+        Stops journaling the market
+        :param market: Market
+        :return:
+        """
+        market.remove_listener(self._on_event)
+        self._markets.remove(market)
+
+    def tell(self):
+        """
+        Flushes buffered records and returns the journal size, the offset recovery resumes from
+        :return: byte offset
+        """
+        with self._lock:
+            self._file.flush()
+            return self._file.tell()
+
+    def sync(self):
+        """
+        Flushes buffered records and fsyncs the journal
+        :return:
+        """
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        """
+        Detaches from every market, syncs and closes the journal
+        :return:
+        """
+        for market in list(self._markets):
+            self.detach(market)
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def _on_event(self, stock, kind, payload):
+        import numpy as np
+        parts = [_key(stock)]
+        if kind == 'trade':
+            attributed = payload.parties is not None
+            parts.append(_TRADE_HEADER.pack(len(payload.timestamps), payload.sequence, attributed))
+            for (name, dtype), column in zip(_COLUMNS, payload):
+                parts.append(np.asarray(column, dtype=dtype).tobytes())
+            if attributed:
+                codes = np.asarray(payload.parties, dtype=_PARTY_DTYPE)
+                table = json.dumps(_party_table(codes)).encode('utf-8')
+                parts.extend((codes.tobytes(), _TABLE.pack(len(table)), table))
+        elif kind in ('listed', 'meta'):
+            parts.append(_metadata(stock))
+        body = b''.join(parts)
+        record = _RECORD_HEADER.pack(len(body), zlib.crc32(body), _RECORD_TYPES[kind]) + body
+        with self._lock:
+            self._file.write(record)
+            self._pending += 1
+            if self._pending >= self._sync_every or time.monotonic() - self._last_sync >= self._sync_interval:
+                self._sync()
+
+
+def _read_records(path, offset):
+    """
+    Yields (record type, key, body) for every complete record from offset, stopping at a torn or corrupt tail
+    """
+    with open(path, 'rb') as journal:
+        if journal.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+            raise ValueError("%s is not a market journal" % path)
+        journal.seek(max(offset, len(JOURNAL_MAGIC)))
+        while True:
+            header = journal.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                return
+            length, crc, record_type = _RECORD_HEADER.unpack(header)
+            body = journal.read(length)
+            if len(body) < length or zlib.crc32(body) != crc:
+                return
+            key_length, = _KEY.unpack_from(body)
+            ticker, stock_type = body[_KEY.size:_KEY.size + key_length].decode('utf-8').split('\0')
+            yield record_type, (ticker, stock_type), body[_KEY.size + key_length:]
+
+
+def _listed(market, key):
+    try:
+        return market.get(*key)
+    except LookupError:
+        return None
+
+
+def write_snapshot(market, path, journal=None):
+    """
+    Writes a compact snapshot of the market, its stocks' metadata and transaction buffers. The stocks are copied
+    under Market.snapshot, so ingestion only waits for the copy, not the disk write. The file is written beside path
+    and moved into place so a crash never leaves a partial snapshot.
+    :param market: Market
+    :param path: snapshot file
+    :param journal: Journal attached to the market; the snapshot records its offset so recovery replays only the tail
+    :return:
+    """
+    import numpy as np
+    offset = 0
+    if journal is not None:
+        journal.sync()
+        offset = journal.tell()
+    # records journaled after offset may already be in the copy, their sequence numbers tell recover to skip them
+    entries = []
+    columns = []
+    with market.snapshot() as stocks:
+        for stock in stocks:
+            store = stock.transactions
+            entries.append({'ticker': stock.ticker, 'stock_type': stock.stock_type, 'rows': len(store),
+                            'sequence': stock.sequence, 'attributed': store.parties is not None,
+                            'metadata': _metadata(stock).hex()})
+            columns.extend(getattr(store, name)[:] for name, dtype in _COLUMNS)
+            if store.parties is not None:
+                columns.append(store.parties[:])
+    codes = [np.frombuffer(column, dtype=_PARTY_DTYPE) for column in columns if column.typecode == 'i']
+    header = json.dumps({'incremental_index': market.incremental_index, 'stocks': entries,
+                         'parties': _party_table(np.concatenate(codes)) if codes else []}).encode('utf-8')
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as snapshot:
+        snapshot.write(SNAPSHOT_MAGIC + _SNAPSHOT_HEADER.pack(offset, len(header)) + header)
+        for column in columns:
+            column.tofile(snapshot)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temporary, path)
+
+
+def recover(snapshot_path=None, journal_path=None):
+    """
+    Rebuilds a Market from the latest snapshot and the journal tail written after it. Either file may be missing.
+    Only listings, metadata and trades are persisted: retention policies, bar aggregation, extra tracked price windows
+    and listeners are not restored and have to be set up again on the recovered market.
+    :param snapshot_path: snapshot written by write_snapshot
+    :param journal_path: journal written by Journal
+    :return: Market
+    """
+    import numpy as np
+    market = Market()
+    offset = 0
+    # key -> sequence number the snapshot holds each stock up to
+    covered = {}
+    if snapshot_path is not None and os.path.exists(snapshot_path):
+        with open(snapshot_path, 'rb') as snapshot:
+            data = snapshot.read()
+        if not data.startswith(SNAPSHOT_MAGIC):
+            raise ValueError("%s is not a market snapshot" % snapshot_path)
+        position = len(SNAPSHOT_MAGIC)
+        offset, header_length = _SNAPSHOT_HEADER.unpack_from(data, position)
+        position += _SNAPSHOT_HEADER.size
+        header = json.loads(data[position:position + header_length].decode('utf-8'))
+        position += header_length
+        market = Market(incremental_index=header['incremental_index'])
+        for entry in header['stocks']:
+            stock = _stock_from_metadata(entry['ticker'], entry['stock_type'], bytes.fromhex(entry['metadata']))
+            columns = []
+            for name, dtype in _COLUMNS + ((('parties', _PARTY_DTYPE),) if entry['attributed'] else ()):
+                columns.append(np.frombuffer(data, dtype=dtype, count=entry['rows'], offset=position))
+                position += columns[-1].nbytes
+            traders, books = _party_names(columns.pop(), header['parties']) if entry['attributed'] else (None, None)
+            timestamps, prices, volumes, sides = columns
+            stock.add_transactions(sides, prices, volumes, timestamps, traders, books)
+            # retention may have evicted rows, so the count of rows loaded can be below the stock's sequence; trades
+            # journaled after recovery must carry on from it or a later recovery would take them as covered
+            stock._sequence = entry['sequence']
+            market.add_stock_to_market(stock)
+            covered[(entry['ticker'], entry['stock_type'])] = entry['sequence']
+    if journal_path is not None and os.path.exists(journal_path):
+        for record_type, key, body in _read_records(journal_path, offset):
+            # the snapshot was taken after offset, so the records following it may already be reflected in it
+            if record_type == _TRADES:
+                n, sequence, attributed = _TRADE_HEADER.unpack_from(body)
+                skip = min(max(covered.get(key, 0) - sequence, 0), n)
+                position = _TRADE_HEADER.size
+                columns = []
+                for name, dtype in _COLUMNS + ((('parties', _PARTY_DTYPE),) if attributed else ()):
+                    columns.append(np.frombuffer(body, dtype=dtype, count=n, offset=position)[skip:])
+                    position += n * columns[-1].itemsize
+                traders = books = None
+                if attributed:
+                    length, = _TABLE.unpack_from(body, position)
+                    table = json.loads(body[position + _TABLE.size:position + _TABLE.size + length].decode('utf-8'))
+                    traders, books = _party_names(columns.pop(), table)
+                timestamps, prices, volumes, sides = columns
+                stock = _listed(market, key)
+                if stock is not None and skip < n:
+                    stock.add_transactions(sides, prices, volumes, timestamps, traders, books)
+            elif record_type == _LISTED:
+                # a listing the snapshot already has keeps its snapshot rows
+                if _listed(market, key) is None:
+                    market.add_stock_to_market(_stock_from_metadata(key[0], key[1], body))
+                    covered.pop(key, None)
+            elif record_type == _DELISTED:
+                # a stock delisted before the snapshot is not in it; a later listing under the key starts from 0
+                stock = _listed(market, key)
+                if stock is not None:
+                    market.remove_stock_from_market(stock)
+                covered.pop(key, None)
+            elif record_type == _META:
+                stock = _listed(market, key)
+                if stock is None:
+                    continue
+                last_dividend, fixed_dividend, par_value, window_ns = _METADATA.unpack(body)
+                stock.last_dividend = last_dividend
+                stock.fixed_dividend = fixed_dividend
+                stock.par_value = par_value
+    return market
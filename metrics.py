@@ -0,0 +1,248 @@
+import datetime
+import math
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from ssm import Market, Stock, datetime_to_ns, timedelta_to_ns
+
+"""
+Optional hot path instrumentation for ssm. Records call counts, latency histograms and the number of transactions
+each call scanned for price reads, window queries, the All Share Index and ingestion.
+
+Instrumentation is off by default and then costs nothing: enable() swaps the instrumented methods of Stock and Market
+for timing wrappers and disable() puts the originals back.
+
+Transactions scanned per call:
+    stock_price                               trades the rolling VWAP expired or restored on the read, or for an
+                                              as_of read or an untracked window the trades in the priced window
+    stock_get_transactions_for_last_x_min     trades returned
+    market_all_share_index                    stocks priced, none for a cached index and only the changed ones
+                                              for an incremental index
+    stock_add_transaction(s), market_ingest   trades added
+
+Usage:
+    metrics.enable()
+    LSE.all_share_index()
+    metrics.snapshot()['market_all_share_index']['calls']
+    print(metrics.prometheus())
+
+Implemented Functions:
+    enable
+    disable
+    enabled
+    reset
+    snapshot
+    latency_percentile
+    prometheus
+"""
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 0.1, 1.0,
+                   math.inf)
+# upper bounds of the transactions scanned histogram buckets
+SCANNED_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000, math.inf)
+
+
+def _vwap_position(stock):
+    # sum over the tracked windows of the first row in each; a read moves only the window it prices
+    return sum(state[1] for state in stock._vwap._windows.values())
+
+
+def _priced_rows(self, before, args, kwargs, result):
+    window, as_of = (args + (None, None))[:2]
+    window = kwargs.get('window', window)
+    as_of = kwargs.get('as_of', as_of)
+    window_ns = self._price_window if window is None else timedelta_to_ns(window)
+    if as_of is None and window_ns in self._vwap._windows:
+        return abs(_vwap_position(self) - before)
+    # summed from the stored trades; for a read at now the bounds are found again just after the call
+    end_ns = datetime_to_ns(as_of or datetime.datetime.now())
+    lo, hi = self.transactions.window(end_ns - window_ns, end_ns)
+    return hi - lo
+
+
+def _count(self, before, args, kwargs, result):
+    return result or 0
+
+
+# metric name -> (class, method, state before the call or None, transactions scanned)
+_TARGETS = {
+    'stock_price': (Stock, 'price', _vwap_position, _priced_rows),
+    'stock_get_transactions_for_last_x_min': (Stock, 'get_transactions_for_last_x_min', None,
+                                              lambda self, before, args, kwargs, result: len(result)),
+    'market_all_share_index': (Market, 'all_share_index', None,
+                               lambda self, before, args, kwargs, result: self._repriced),
+    'stock_add_transaction': (Stock, 'add_transaction', None, lambda self, before, args, kwargs, result: 1),
+    'stock_add_transactions': (Stock, 'add_transactions', None, _count),
+    'market_ingest': (Market, 'ingest', None, _count),
+}
+
+
+class _Series:
+    """
+    Counters for one instrumented method
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+        self.latency_counts = [0] * len(LATENCY_BUCKETS)
+        self.scanned_sum = 0
+        self.scanned_counts = [0] * len(SCANNED_BUCKETS)
+
+    def record(self, seconds, scanned, failed):
+        latency_bucket = bisect_left(LATENCY_BUCKETS, seconds)
+        scanned_bucket = bisect_left(SCANNED_BUCKETS, scanned)
+        with self._lock:
+            self.calls += 1
+            self.errors += failed
+            self.latency_sum += seconds
+            self.latency_counts[latency_bucket] += 1
+            self.scanned_sum += scanned
+            self.scanned_counts[scanned_bucket] += 1
+
+    def read(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'errors': self.errors,
+                'latency_seconds_sum': self.latency_sum,
+                'latency_buckets': list(zip(LATENCY_BUCKETS, _cumulative(self.latency_counts))),
+                'scanned_sum': self.scanned_sum,
+                'scanned_buckets': list(zip(SCANNED_BUCKETS, _cumulative(self.scanned_counts))),
+            }
+
+
+def _cumulative(counts):
+    total = 0
+    cumulative = []
+    for count in counts:
+        total += count
+        cumulative.append(total)
+    return cumulative
+
+
+_series = dict((name, _Series()) for name in _TARGETS)
+# metric name -> original method, while enabled
+_originals = {}
+_switch = threading.Lock()
+
+
+def _instrument(function, series, prepare, scanned):
+    timer = time.perf_counter_ns
+
+    @wraps(function)
+    def wrapper(self, *args, **kwargs):
+        before = prepare(self) if prepare is not None else None
+        result = None
+        failed = True
+        start = timer()
+        try:
+            result = function(self, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            elapsed = timer() - start
+            series.record(elapsed / 1e9, 0 if failed else scanned(self, before, args, kwargs, result), failed)
+    return wrapper
+
+
+def enable():
+    """
+    Starts recording metrics by wrapping the instrumented methods
+    :return:
+    """
+    with _switch:
+        for name, (cls, method, prepare, scanned) in _TARGETS.items():
+            if name not in _originals:
+                _originals[name] = cls.__dict__[method]
+                setattr(cls, method, _instrument(_originals[name], _series[name], prepare, scanned))
+
+
+def disable():
+    """
+    Stops recording metrics and restores the original methods. Recorded values are kept until reset.
+    :return:
+    """
+    with _switch:
+        for name, original in list(_originals.items()):
+            cls, method = _TARGETS[name][:2]
+            setattr(cls, method, original)
+            del _originals[name]
+
+
+def enabled():
+    """
+    :return: True while metrics are being recorded
+    """
+    return bool(_originals)
+
+
+def reset():
+    """
+    Clears every recorded value
+    :return:
+    """
+    for series in _series.values():
+        with series._lock:
+            series.clear()
+
+
+def snapshot():
+    """
+    Pull API for the recorded values
+    :return: dict of metric name -> dict of calls, errors, latency_seconds_sum, latency_buckets, scanned_sum and
+        scanned_buckets, the buckets being lists of (upper bound, cumulative count)
+    """
+    return dict((name, _series[name].read()) for name in _TARGETS)
+
+
+def latency_percentile(name, q):
+    """
+    Latency percentile estimated from a histogram
+    :param name: metric name
+    :param q: quantile between 0 and 1
+    :return: upper bound in seconds of the bucket holding the percentile, None before the first call
+    """
+    buckets = _series[name].read()['latency_buckets']
+    total = buckets[-1][1]
+    if not total:
+        return None
+    for bound, count in buckets:
+        if count >= q * total:
+            return bound
+
+
+def _label(bound):
+    return '+Inf' if bound == math.inf else repr(bound)
+
+
+def prometheus():
+    """
+    Recorded values in the Prometheus text exposition format
+    :return: string
+    """
+    lines = []
+    values = snapshot()
+    for name in _TARGETS:
+        value = values[name]
+        metric = 'ssm_%s' % name
+        lines.append('# HELP %s_calls_total Calls to %s.%s' % (metric, _TARGETS[name][0].__name__, _TARGETS[name][1]))
+        lines.append('# TYPE %s_calls_total counter' % metric)
+        lines.append('%s_calls_total %d' % (metric, value['calls']))
+        lines.append('# TYPE %s_errors_total counter' % metric)
+        lines.append('%s_errors_total %d' % (metric, value['errors']))
+        for suffix, buckets, total in (('latency_seconds', value['latency_buckets'], value['latency_seconds_sum']),
+                                       ('scanned_transactions', value['scanned_buckets'], value['scanned_sum'])):
+            lines.append('# TYPE %s_%s histogram' % (metric, suffix))
+            for bound, count in buckets:
+                lines.append('%s_%s_bucket{le="%s"} %d' % (metric, suffix, _label(bound), count))
+            lines.append('%s_%s_sum %r' % (metric, suffix, total))
+            lines.append('%s_%s_count %d' % (metric, suffix, value['calls']))
+    return '\n'.join(lines) + '\n'
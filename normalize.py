@@ -0,0 +1,132 @@
+import re
+from functools import lru_cache
+
+"""
+Normalizes CamelCase style names such as tickers, instrument codes and vendor field names into snake_case segments.
+This is the word splitting of test.func as a returning, memoized function with a batch API, for feeds that normalize
+the same few thousand names millions of times.
+
+A new segment starts at every upper case letter followed by a lower case one, so runs of capitals stay together and
+case is kept:
+    TradePrice -> Trade_Price
+    AAAABbbb   -> AAAA_Bbbb
+    ABcDe      -> A_Bc_De
+Unlike test.func, a name that starts with an upper case letter followed by a lower case one gets no empty leading
+segment: test.func gives _Trade_Price for TradePrice.
+
+ASCII names, the usual case, are split by one pass of a compiled regex; other names fall back to a single loop over
+the characters using the same str.isupper and str.islower tests as test.func.
+
+Usage:
+    normalize('TradePrice')
+    normalize_all(vendor_fields)
+    python normalize.py
+
+Implemented Functions:
+    normalize
+    normalize_all
+    benchmark
+"""
+
+# distinct names remembered by normalize
+CACHE_SIZE = 65536
+
+# the position before an upper case letter followed by a lower case one, other than the start of the name
+_BOUNDARY = re.compile(r'(?<=.)(?=[A-Z][a-z])', re.DOTALL)
+
+
+def _split(name):
+    if name.isascii():
+        return _BOUNDARY.sub('_', name)
+    segments = []
+    start = 0
+    for i in range(1, len(name) - 1):
+        if name[i].isupper() and name[i + 1].islower():
+            segments.append(name[start:i])
+            start = i
+    segments.append(name[start:])
+    return '_'.join(segments)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def normalize(name):
+    """
+    Splits a CamelCase style name into snake_case segments, memoized for the CACHE_SIZE most recently used names.
+    normalize.cache_info() and normalize.cache_clear() report on and empty the cache.
+    :param name: string
+    :return: string
+    """
+    if not isinstance(name, str):
+        raise TypeError("name must be a string")
+    return _split(name)
+
+
+def normalize_all(names):
+    """
+    Normalizes a batch of names, see normalize
+    :param names: iterable of strings
+    :return: list of strings, in the same order
+    """
+    return list(map(normalize, names))
+
+
+def _names(n, distinct, seed):
+    """
+    Synthetic vendor field names: CamelCase words, upper case acronyms and digits
+    """
+    import random
+    generator = random.Random(seed)
+    words = ('Trade', 'Price', 'Volume', 'Bid', 'Ask', 'Last', 'Open', 'Close', 'High', 'Low', 'Net', 'Change',
+             'Settle', 'Expiry', 'Strike', 'Yield', 'Coupon', 'Accrued', 'Interest', 'Date', 'Time', 'Book')
+    acronyms = ('VWAP', 'ISIN', 'SEDOL', 'CUSIP', 'FX', 'USD', 'GBP', 'PE', 'EPS', 'ID')
+    pool = []
+    for i in range(distinct):
+        parts = [generator.choice(acronyms if generator.random() < 0.3 else words)
+                 for j in range(generator.randint(1, 4))]
+        if generator.random() < 0.2:
+            parts.append(str(generator.randint(1, 12)))
+        pool.append(''.join(parts) + ('' if i < len(words) else str(i)))
+    return [generator.choice(pool) for i in range(n)]
+
+
+def benchmark(n=200000, distinct=5000, seed=0):
+    """
+    Times test.func against normalize on synthetic vendor field names, both bypassing the cache and through
+    normalize_all with the cache starting empty, and checks they agree. test.func prints its result, so its print is
+    swapped for a list append and the benchmark measures the splitting, not the terminal.
+    :param n: names to normalize
+    :param distinct: distinct names among them
+    :param seed: random seed
+    :return: dict of benchmark name -> names per second
+    """
+    import time
+    import test
+    names = _names(n, distinct, seed)
+    printed = []
+    test.print = printed.append
+    try:
+        start = time.perf_counter()
+        for name in names:
+            test.func(name)
+        legacy = time.perf_counter() - start
+    finally:
+        del test.print
+    split = normalize.__wrapped__
+    start = time.perf_counter()
+    cold = [split(name) for name in names]
+    uncached = time.perf_counter() - start
+    normalize.cache_clear()
+    start = time.perf_counter()
+    warm = normalize_all(names)
+    cached = time.perf_counter() - start
+    # the only difference from test.func is its empty leading segment
+    expected = [result[1:] if name[:1].isupper() and name[1:2].islower() else result
+                for name, result in zip(names, printed)]
+    if cold != expected or warm != expected:
+        raise AssertionError("normalize disagrees with test.func")
+    return {'test.func': n / legacy, 'normalize uncached': n / uncached, 'normalize_all cached': n / cached}
+
+
+if __name__ == '__main__':
+    for label, rate in benchmark().items():
+        print('%-24s %12.0f names/s' % (label, rate))
@@ -0,0 +1,154 @@
+import threading
+from collections import namedtuple
+
+from ssm import party
+
+"""
+Real-time positions and P&L per (trader, ticker, stock type, book), kept incrementally from the trades a Market or
+Stock records. Only trades attributed to a trader or book are counted, see Stock.add_transaction.
+
+PositionKeeper:
+    Attaches to a Market or a Stock as a listener. Every attributed trade updates its position's net quantity, average
+    cost and realized P&L in O(1), so reads never rescan trade history. Positions are marked to market on read against
+    Stock.price(), which is cached per stock, falling back to the last traded price the keeper saw when the stock has
+    no trades in its price window. Polling every position costs one price read per listing.
+
+    Average cost accounting: trades that add to a position move its average cost; trades that reduce it realize
+    (price - average cost) on the closed quantity, and a trade that flips the position opens the remainder at its price.
+
+    Trades recorded before the keeper was attached are not counted.
+
+    Usage:
+        keeper = PositionKeeper()
+        keeper.attach(LSE)
+        LSE.get('TEA').add_transaction('buy', 100.5, 200, trader='John', book='Sep-16')
+        keeper.position('John', 'TEA', 'Sep-16').pnl
+        keeper.positions(trader='John')
+
+    Implemented Methods:
+        attach
+        detach
+        position
+        positions
+"""
+
+Position = namedtuple('Position', 'trader ticker stock_type book quantity average_cost realized unrealized pnl mark '
+                                   'trades')
+
+
+class PositionKeeper:
+    """
+    Incremental net position, average cost and P&L per (trader, ticker, stock type, book)
+    """
+    def __init__(self):
+        # (trader, ticker, stock type, book) -> [quantity, average cost, realized P&L, trades]
+        self._positions = {}
+        # (ticker, stock type) -> (Stock, last traded price); a common and a preferred listing share a ticker
+        self._stocks = {}
+        self._sources = []
+        self._lock = threading.Lock()
+
+    def attach(self, source):
+        """
+        Starts keeping positions from the trades of a market or a single stock
+        :param source: Market or Stock
+        :return:
+        """
+        source.add_listener(self._on_event)
+        self._sources.append(source)
+
+    def detach(self, source):
+        """
+        Stops keeping positions from a market or stock, the positions kept so far stay
+        :param source: Market or Stock
+        :return:
+        """
+        source.remove_listener(self._on_event)
+        self._sources.remove(source)
+
+    def _on_event(self, stock, kind, payload):
+        if kind != 'trade' or payload.parties is None:
+            return
+        listing = (stock.ticker, stock.stock_type)
+        rows = zip(*(column.tolist() if hasattr(column, 'tolist') else column for column in payload[1:5]))
+        with self._lock:
+            positions = self._positions
+            for price, volume, side, code in rows:
+                if not code:
+                    continue
+                trader, book = party(code)
+                key = (trader,) + listing + (book,)
+                position = positions.get(key)
+                if position is None:
+                    position = positions[key] = [0.0, 0.0, 0.0, 0]
+                self._apply(position, volume if side else -volume, price)
+            self._stocks[listing] = (stock, price)
+
+    @staticmethod
+    def _apply(position, quantity, price):
+        held, cost = position[0], position[1]
+        position[3] += 1
+        if quantity == 0:
+            # moves nothing, and on a flat position would divide by zero
+            return
+        if held == 0 or (held > 0) == (quantity > 0):
+            position[1] = (held * cost + quantity * price) / (held + quantity)
+        else:
+            closed = min(abs(quantity), abs(held))
+            position[2] += closed * (price - cost) * (1 if held > 0 else -1)
+            if abs(quantity) > abs(held):
+                position[1] = price
+            elif abs(quantity) == abs(held):
+                position[1] = 0.0
+        position[0] = held + quantity
+
+    def _mark(self, listing, marks):
+        mark = marks.get(listing)
+        if mark is None:
+            stock, last = self._stocks[listing]
+            try:
+                mark = stock.price()
+            except LookupError:
+                mark = last
+            marks[listing] = mark
+        return mark
+
+    def _view(self, key, state, marks):
+        quantity, cost, realized, trades = state
+        mark = self._mark(key[1:3], marks)
+        unrealized = quantity * (mark - cost) if quantity else 0.0
+        return Position(*key + (quantity, cost, realized, unrealized, realized + unrealized, mark, trades))
+
+    def position(self, trader, ticker, book=None, stock_type='common'):
+        """
+        Looks up one position, marked to market
+        :param trader: trader name
+        :param ticker: stock ticker
+        :param book: book name
+        :param stock_type: 'common' or 'preferred'
+        :return: Position
+        """
+        key = (trader, ticker, stock_type, book)
+        with self._lock:
+            try:
+                state = list(self._positions[key])
+            except KeyError:
+                raise LookupError("No trades for %s in %s" % (trader, ticker))
+        return self._view(key, state, {})
+
+    def positions(self, trader=None, ticker=None, book=None, stock_type=None):
+        """
+        Lists positions marked to market, optionally filtered. Each listing is priced once per call.
+        :param trader: only this trader's positions
+        :param ticker: only positions in this stock
+        :param book: only positions in this book
+        :param stock_type: only positions in 'common' or 'preferred' listings
+        :return: list of Position, sorted by trader, ticker, stock type and book
+        """
+        with self._lock:
+            states = [(key, list(state)) for key, state in self._positions.items()
+                      if (trader is None or key[0] == trader) and (ticker is None or key[1] == ticker)
+                      and (stock_type is None or key[2] == stock_type) and (book is None or key[3] == book)]
+        marks = {}
+        states.sort(key=lambda item: tuple('' if part is None else part for part in item[0]))
+        return [self._view(key, state, marks) for key, state in states]
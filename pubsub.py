@@ -0,0 +1,309 @@
+import heapq
+import itertools
+import math
+import sys
+import threading
+import time
+from collections import namedtuple
+
+"""
+In-process publish/subscribe of derived market metrics, so screens are pushed updates instead of polling every stock.
+
+MetricBus:
+    Listens to a Market. A trade marks the touched stock's price, dividend yield and P/E ratio, plus the All Share
+    Index, as changed for the subscribers that want them; a dividend, par value or type change marks only the stock's
+    dividend yield and P/E ratio. Nothing is recomputed at that point. Values are computed when a subscriber is next
+    due an update, once per delivery round however many subscribers share them, from the cached Stock.price() and
+    Market.all_share_index().
+
+    Each subscriber has its own rate limit: it is called at most once per min_interval seconds with the latest value
+    of everything that changed since its last call, so a burst of trades on one stock coalesces into one update.
+    Updates held back by the rate limit are delivered once the interval has passed by a single dispatcher thread,
+    started on first use and shared by every subscriber, or straight away by flush.
+    Subscribers with no rate limit are called synchronously on the thread that recorded the trade. An exception raised
+    by a subscriber is reported through sys.excepthook and goes no further, so it never reaches the code recording the
+    trade or stops the market's other listeners.
+
+    Values only move on trades and metadata changes; a price whose window ages out with no new trade is not pushed.
+
+    Usage:
+        bus = MetricBus(LSE)
+        subscription = bus.subscribe(screen.update, metrics=('price', 'index'), tickers=['TEA', 'POP'],
+                                     min_interval=0.25)
+        subscription.cancel()
+
+    Implemented Methods:
+        subscribe
+        unsubscribe
+        flush
+        close
+
+Subscription:
+    Handle returned by MetricBus.subscribe
+
+    Implemented Methods:
+        cancel
+"""
+
+METRICS = ('price', 'dividend_yield', 'pe_ratio', 'index')
+# metrics a trade or a metadata change can move, the index is also moved by a trade in any stock
+_STOCK_METRICS = {'trade': ('price', 'dividend_yield', 'pe_ratio'), 'meta': ('dividend_yield', 'pe_ratio')}
+_INDEX = (None, 'index', None)
+
+# ticker and stock_type are None for the index; value is None when there is nothing to compute it from, e.g. no
+# recent trades. stock_type tells apart listings that share a ticker.
+Update = namedtuple('Update', 'ticker metric value stock_type', defaults=(None,))
+
+
+class Subscription:
+    """
+    Rate limited, coalescing subscription to derived metrics
+    """
+    def __init__(self, bus, callback, metrics, tickers, min_interval, tolerance):
+        self._bus = bus
+        self._callback = callback
+        self._metrics = metrics
+        self._tickers = tickers
+        self._min_interval = min_interval
+        self._tolerance = tolerance
+        # changed (ticker, metric, stock_type) keys waiting for delivery, in the order they first changed
+        self._dirty = {}
+        # (ticker, metric, stock_type) -> value last delivered
+        self._delivered = {}
+        self._last_delivery = None
+        # True while waiting in the dispatcher's queue
+        self._scheduled = False
+        # keeps deliveries to this subscriber in order when several threads record trades
+        self._sending = threading.Lock()
+
+    metrics = property(lambda self: self._metrics)
+    tickers = property(lambda self: self._tickers)
+
+    def cancel(self):
+        """
+        Stops the subscription, dropping any updates not yet delivered
+        :return:
+        """
+        self._bus.unsubscribe(self)
+
+    def _due(self, now):
+        return self._last_delivery is None or now - self._last_delivery >= self._min_interval
+
+    def _moved(self, key, value):
+        if key not in self._delivered:
+            return True
+        last = self._delivered[key]
+        if value is None or last is None:
+            return value is not last
+        return abs(value - last) > self._tolerance * abs(last)
+
+
+class MetricBus:
+    """
+    Pushes derived metric updates for a Market to subscribers
+    """
+    def __init__(self, market):
+        """
+            Args:
+                market: Market whose stocks are published
+        """
+        self._market = market
+        # ticker -> subscriptions filtered to it, subscriptions to every stock, subscriptions wanting the index
+        self._by_ticker = {}
+        self._everything = []
+        self._index = []
+        # (ticker, stock_type) -> Stock, from the events seen
+        self._stocks = {}
+        # (deadline, sequence, subscription) heap of held back deliveries, drained by the dispatcher thread
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._dispatcher = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        market.add_listener(self._on_event)
+
+    def subscribe(self, callback, metrics=('price',), tickers=None, min_interval=0.0, tolerance=0.0):
+        """
+        Subscribes callback(updates) to changes of derived metrics, updates being a list of Update
+        :param callback: callable
+        :param metrics: names from METRICS
+        :param tickers: tickers to follow, every listing of each, None for every stock; the index is followed
+            regardless
+        :param min_interval: least number of seconds between calls, changes in between are coalesced
+        :param tolerance: relative move a value needs since it was last delivered to be delivered again
+        :return: Subscription
+        """
+        metrics = tuple(metrics)
+        if not metrics or any(metric not in METRICS for metric in metrics):
+            raise ValueError("metrics must be some of %s" % ', '.join(METRICS))
+        if min_interval < 0 or tolerance < 0:
+            raise ValueError("min_interval and tolerance must not be negative")
+        if tickers is not None:
+            tickers = frozenset(tickers)
+        subscription = Subscription(self, callback, metrics, tickers, min_interval, tolerance)
+        with self._lock:
+            if 'index' in metrics:
+                self._index = self._index + [subscription]
+            if set(metrics) - {'index'}:
+                if tickers is None:
+                    self._everything = self._everything + [subscription]
+                else:
+                    for ticker in tickers:
+                        self._by_ticker[ticker] = self._by_ticker.get(ticker, []) + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Removes a subscription, dropping any updates not yet delivered to it
+        :param subscription: Subscription returned by subscribe
+        :return:
+        """
+        with self._lock:
+            found = False
+            if subscription in self._index:
+                self._index = [s for s in self._index if s is not subscription]
+                found = True
+            if subscription in self._everything:
+                self._everything = [s for s in self._everything if s is not subscription]
+                found = True
+            for ticker in subscription.tickers or ():
+                subscriptions = [s for s in self._by_ticker.get(ticker, ()) if s is not subscription]
+                found = found or len(subscriptions) < len(self._by_ticker.get(ticker, ()))
+                if subscriptions:
+                    self._by_ticker[ticker] = subscriptions
+                else:
+                    self._by_ticker.pop(ticker, None)
+            if not found:
+                raise ValueError("subscription is not active")
+            # a queued delivery finds nothing to send
+            subscription._dirty.clear()
+
+    def flush(self):
+        """
+        Delivers every held back update now, ignoring the rate limits
+        :return:
+        """
+        with self._lock:
+            subscriptions = [s for s in self._subscriptions() if s._dirty]
+        self._deliver(subscriptions)
+
+    def close(self):
+        """
+        Stops listening to the market and cancels every subscription
+        :return:
+        """
+        self._market.remove_listener(self._on_event)
+        with self._lock:
+            subscriptions = list(self._subscriptions())
+            self._closed = True
+            self._wakeup.notify()
+        for subscription in subscriptions:
+            self.unsubscribe(subscription)
+
+    def _subscriptions(self):
+        seen = dict.fromkeys(self._index)
+        seen.update(dict.fromkeys(self._everything))
+        for subscriptions in self._by_ticker.values():
+            seen.update(dict.fromkeys(subscriptions))
+        return seen.keys()
+
+    def _on_event(self, stock, kind, payload):
+        metrics = _STOCK_METRICS.get(kind)
+        if metrics is None:
+            return
+        ticker = stock.ticker
+        stock_type = stock.stock_type
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            self._stocks[(ticker, stock_type)] = stock
+            touched = []
+            for subscription in self._by_ticker.get(ticker, []) + self._everything:
+                for metric in metrics:
+                    if metric in subscription._metrics:
+                        subscription._dirty[(ticker, metric, stock_type)] = True
+                touched.append(subscription)
+            if kind == 'trade':
+                for subscription in self._index:
+                    subscription._dirty[_INDEX] = True
+                    touched.append(subscription)
+            for subscription in touched:
+                if not subscription._dirty or subscription._scheduled:
+                    continue
+                if subscription._due(now):
+                    due.append(subscription)
+                else:
+                    self._schedule(subscription, subscription._last_delivery + subscription._min_interval)
+        self._deliver(dict.fromkeys(due))
+
+    def _schedule(self, subscription, deadline):
+        # called holding the lock
+        subscription._scheduled = True
+        heapq.heappush(self._deadlines, (deadline, next(self._sequence), subscription))
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target=self._dispatch, name='MetricBus', daemon=True)
+            self._dispatcher.start()
+        elif self._deadlines[0][2] is subscription:
+            self._wakeup.notify()
+
+    def _dispatch(self):
+        while True:
+            with self._wakeup:
+                due = []
+                while not due:
+                    if self._closed:
+                        self._dispatcher = None
+                        return
+                    now = time.monotonic()
+                    while self._deadlines and self._deadlines[0][0] <= now:
+                        subscription = heapq.heappop(self._deadlines)[2]
+                        subscription._scheduled = False
+                        due.append(subscription)
+                    if not due:
+                        self._wakeup.wait(self._deadlines[0][0] - now if self._deadlines else None)
+            self._deliver(due)
+
+    def _value(self, key):
+        ticker, metric, stock_type = key
+        if metric == 'index':
+            return self._market.all_share_index()
+        stock = self._stocks[(ticker, stock_type)]
+        try:
+            price = stock.price()
+        except LookupError:
+            return None
+        if metric == 'price':
+            return price
+        if price <= 0:
+            return None
+        if metric == 'dividend_yield':
+            return stock.dividend_yield(price)
+        return stock.PE_ratio(price) if stock.last_dividend else math.inf
+
+    def _deliver(self, subscriptions):
+        # values computed this round, shared by every subscriber that wants them
+        values = {}
+        for subscription in subscriptions:
+            with subscription._sending:
+                with self._lock:
+                    keys = list(subscription._dirty)
+                    subscription._dirty.clear()
+                    if not keys:
+                        continue
+                    subscription._last_delivery = time.monotonic()
+                try:
+                    updates = []
+                    for key in keys:
+                        if key not in values:
+                            values[key] = self._value(key)
+                        value = values[key]
+                        if subscription._moved(key, value):
+                            subscription._delivered[key] = value
+                            updates.append(Update(key[0], key[1], value, key[2]))
+                    if updates:
+                        subscription._callback(updates)
+                except Exception:
+                    # reported, never raised: on the synchronous path that would stop the market's other listeners,
+                    # such as a Journal, and every other subscriber still gets its updates
+                    sys.excepthook(*sys.exc_info())
@@ -0,0 +1,208 @@
+import csv
+import io
+import os
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+"""
+Trade versus risk reconciliation, the Python counterpart of the pivot table recon in VBA/Ex1-6.xlsm. Trades are
+aggregated into signed quantity and signed notional per (instrument, expiry), joined by hash against the risk feed
+on the same key, and every key where the two disagree is reported as a break.
+
+In the VBA exercise data the trades are in VBA/internal.csv (ID, Quantity, Price, B/S, Instrument, Expiry, Trader)
+and the risk is in VBA/external.csv (Instrument, Expiry, Risk); risk is the signed notional, buys positive.
+
+Large trade files are streamed in blocks of rows, each aggregated with NumPy, so memory is bounded by the block size
+and the number of keys. With several workers the file is split into line aligned byte ranges aggregated in parallel
+processes, and the partial aggregates are merged per key. Quoted fields spanning lines are not supported.
+
+Usage:
+    breaks = reconcile('VBA/internal.csv', 'VBA/external.csv')
+    python recon.py VBA/internal.csv VBA/external.csv
+
+Implemented Functions:
+    aggregate_trades
+    load_risk
+    reconcile
+"""
+
+TRADE_COLUMNS = ('Quantity', 'Price', 'B/S', 'Instrument', 'Expiry')
+RISK_COLUMNS = ('Instrument', 'Expiry', 'Risk')
+_SEPARATOR = '\x1f'
+_BUY = ('B', 'BUY')
+_SELL = ('S', 'SELL')
+# rows are read and aggregated in blocks of about this size, bounding memory per worker
+_CHUNK_BYTES = 4 * 1024 * 1024
+# files smaller than this are aggregated in process, starting workers would cost more than it saves
+_PARALLEL_MIN_BYTES = 8 * 1024 * 1024
+
+Position = namedtuple('Position', 'quantity notional trades')
+Break = namedtuple('Break', 'instrument expiry quantity notional risk difference status')
+
+
+def _positions(header, columns, path):
+    header = [name.strip() for name in header]
+    try:
+        return [header.index(name) for name in columns]
+    except ValueError:
+        raise ValueError("%s must have the columns %s" % (path, ', '.join(columns)))
+
+
+def _aggregate_chunk(rows, positions, totals):
+    """
+    Folds a chunk of trade rows into totals, (instrument, expiry) -> [quantity, notional, trades]
+    """
+    import numpy as np
+    quantity, price, side, instrument, expiry = positions
+    columns = list(zip(*rows))
+    sides = np.char.upper(np.char.strip(np.array(columns[side], dtype='U')))
+    signs = np.where(np.isin(sides, _BUY), 1.0, np.where(np.isin(sides, _SELL), -1.0, np.nan))
+    if np.isnan(signs).any():
+        raise ValueError("B/S must be B or S, not %r" % columns[side][int(np.isnan(signs).argmax())])
+    quantities = np.array(columns[quantity], dtype='f8') * signs
+    notionals = quantities * np.array(columns[price], dtype='f8')
+    # NumPy strings drop trailing NULs, so the key halves are joined with the ASCII unit separator
+    keys, codes = np.unique(np.char.add(np.char.add(np.array(columns[instrument], dtype='U'), _SEPARATOR),
+                                        np.array(columns[expiry], dtype='U')), return_inverse=True)
+    sums = (np.bincount(codes, quantities, len(keys)), np.bincount(codes, notionals, len(keys)),
+            np.bincount(codes, minlength=len(keys)))
+    for key, key_quantity, key_notional, trades in zip(keys.tolist(), *(column.tolist() for column in sums)):
+        instrument_name, expiry_name = key.split(_SEPARATOR)
+        total = totals.setdefault((instrument_name.strip(), expiry_name.strip()), [0.0, 0.0, 0])
+        total[0] += key_quantity
+        total[1] += key_notional
+        total[2] += trades
+
+
+def _aggregate_range(path, start, end, positions, chunk_bytes, encoding):
+    """
+    Aggregates the trade rows starting in the byte range [start, end). start must be at the beginning of a line.
+    """
+    totals = {}
+    with open(path, 'rb') as trades:
+        trades.seek(start)
+        while start < end:
+            block = trades.read(min(chunk_bytes, end - start))
+            if not block:
+                break
+            if not block.endswith(b'\n') and trades.tell() < end:
+                # finish the row the block cut through, it cannot run past end as end starts a line
+                block += trades.readline()
+            start = trades.tell()
+            rows = [row for row in csv.reader(block.decode(encoding).splitlines()) if row]
+            if rows:
+                _aggregate_chunk(rows, positions, totals)
+    return totals
+
+
+def _merge(totals, partial):
+    for key, (quantity, notional, trades) in partial.items():
+        total = totals.setdefault(key, [0.0, 0.0, 0])
+        total[0] += quantity
+        total[1] += notional
+        total[2] += trades
+
+
+def aggregate_trades(path, chunk_bytes=_CHUNK_BYTES, workers=None, encoding='utf-8'):
+    """
+    Signed quantity and notional per (instrument, expiry), buys positive
+    :param path: trade CSV with Quantity, Price, B/S, Instrument and Expiry columns
+    :param chunk_bytes: size of the blocks of rows read and aggregated at a time
+    :param workers: processes to aggregate with, defaults to the number of cores; 1 aggregates in process
+    :param encoding: text encoding of the file
+    :return: dict of (instrument, expiry) -> Position
+    """
+    with open(path, 'rb') as trades:
+        header = next(csv.reader([trades.readline().decode(encoding)]), [])
+        start = trades.tell()
+        size = trades.seek(0, io.SEEK_END)
+        positions = _positions(header, TRADE_COLUMNS, path)
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or size - start < _PARALLEL_MIN_BYTES:
+            bounds = [start, size]
+        else:
+            # split points moved forward to the start of the next line
+            bounds = [start]
+            for i in range(1, workers):
+                trades.seek(max(start + (size - start) * i // workers, bounds[-1]))
+                trades.readline()
+                bounds.append(min(trades.tell(), size))
+            bounds.append(size)
+    ranges = [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+    totals = {}
+    if len(ranges) <= 1:
+        for lo, hi in ranges:
+            totals = _aggregate_range(path, lo, hi, positions, chunk_bytes, encoding)
+    else:
+        with ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(_aggregate_range, path, lo, hi, positions, chunk_bytes, encoding)
+                       for lo, hi in ranges]
+            for future in futures:
+                _merge(totals, future.result())
+    return dict((key, Position(*total)) for key, total in totals.items())
+
+
+def load_risk(path, encoding='utf-8'):
+    """
+    Risk per (instrument, expiry), summing any repeated keys
+    :param path: risk CSV with Instrument, Expiry and Risk columns
+    :param encoding: text encoding of the file
+    :return: dict of (instrument, expiry) -> risk
+    """
+    risk = {}
+    with open(path, newline='', encoding=encoding) as feed:
+        reader = csv.reader(feed)
+        instrument, expiry, value = _positions(next(reader, []), RISK_COLUMNS, path)
+        for row in reader:
+            if not row:
+                continue
+            key = (row[instrument].strip(), row[expiry].strip())
+            try:
+                risk[key] = risk.get(key, 0.0) + float(row[value])
+            except ValueError:
+                raise ValueError("Risk must be a number, not %r" % row[value])
+    return risk
+
+
+def reconcile(trades_path, risk_path, tolerance=0.005, chunk_bytes=_CHUNK_BYTES, workers=None):
+    """
+    Reconciles aggregated trades against risk
+    :param trades_path: trade CSV, see aggregate_trades
+    :param risk_path: risk CSV, see load_risk
+    :param tolerance: absolute notional difference still counted as a match
+    :param chunk_bytes: size of the blocks of trade rows aggregated at a time
+    :param workers: processes to aggregate trades with
+    :return: list of Break, sorted by instrument and expiry, with status 'mismatch', 'missing risk' or
+        'missing trades'
+    """
+    positions = aggregate_trades(trades_path, chunk_bytes, workers)
+    risk = load_risk(risk_path)
+    breaks = []
+    for key in sorted(set(positions) | set(risk)):
+        position = positions.get(key)
+        value = risk.get(key)
+        if position is None:
+            breaks.append(Break(key[0], key[1], 0.0, 0.0, value, -value, 'missing trades'))
+        elif value is None:
+            breaks.append(Break(key[0], key[1], position.quantity, position.notional, None, position.notional,
+                                'missing risk'))
+        elif abs(position.notional - value) > tolerance:
+            breaks.append(Break(key[0], key[1], position.quantity, position.notional, value,
+                                position.notional - value, 'mismatch'))
+    return breaks
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Reconcile trades against risk per instrument and expiry')
+    parser.add_argument('trades', nargs='?', default=os.path.join('VBA', 'internal.csv'))
+    parser.add_argument('risk', nargs='?', default=os.path.join('VBA', 'external.csv'))
+    parser.add_argument('--tolerance', type=float, default=0.005)
+    parser.add_argument('--chunk-bytes', type=int, default=_CHUNK_BYTES)
+    parser.add_argument('--workers', type=int, default=None)
+    arguments = parser.parse_args()
+    found = reconcile(arguments.trades, arguments.risk, arguments.tolerance, arguments.chunk_bytes, arguments.workers)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(Break._fields)
+    writer.writerows(found)
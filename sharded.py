@@ -0,0 +1,303 @@
+import datetime
+import math
+import operator
+import os
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from ssm import datetime_to_ns, timedelta_to_ns
+
+"""
+Multi-core All Share Index for large ssm Markets. Listed stocks are partitioned into shards, and each shard keeps the
+timestamps, prices and volumes of its stocks' recent trades resident in a shared memory segment. The ShardedMarket
+listens to the Market and appends every trade to its stock's shard as it is recorded, so an index read copies nothing:
+each worker process finds the in-window trades of its shard, computes the per-stock volume weighted prices and log
+price sum, and the parent reduces the shard sums to the index. Per read the parent only sends each shard's row range
+and the price window of each of its stocks.
+
+A shard's rows are appended in arrival order. Trades that have left every window as of a read are skipped by later
+reads and dropped when the segment next grows, so reads are expected to move forward in time, as they do when now is
+left to default. The trades a stock recorded before it was indexed, when the ShardedMarket is created or the stock is
+listed, are loaded once, only those still in its price window.
+
+ShardedMarket:
+    Usage:
+        with ShardedMarket(LSE, shards=8) as sharded:
+            index = sharded.all_share_index()
+
+    Implemented Methods:
+        all_share_index
+        shard_sums
+        close
+"""
+
+# worker process cache of attached segments, shard -> SharedMemory
+_ATTACHED = {}
+# bytes per resident row: int64 timestamp, float64 price, float64 volume, int32 stock slot
+_ROW_BYTES = 28
+_MIN_ROWS = 4096
+
+
+def _attach(shard, name):
+    segment = _ATTACHED.get(shard)
+    if segment is not None and segment.name == name:
+        return segment
+    if segment is not None:
+        segment.close()
+    # workers share the parent's resource tracker, so attaching here does not hand ownership to the worker
+    segment = shared_memory.SharedMemory(name=name)
+    _ATTACHED[shard] = segment
+    return segment
+
+
+def _columns(buffer, capacity, start, stop):
+    """
+    Timestamp, price, volume and stock slot views of rows [start, stop) of a shard segment
+    """
+    import numpy as np
+    n = stop - start
+    return (np.frombuffer(buffer, dtype='i8', count=n, offset=8 * start),
+            np.frombuffer(buffer, dtype='f8', count=n, offset=8 * capacity + 8 * start),
+            np.frombuffer(buffer, dtype='f8', count=n, offset=16 * capacity + 8 * start),
+            np.frombuffer(buffer, dtype='i4', count=n, offset=24 * capacity + 4 * start))
+
+
+def _shard_log_sum(shard, name, capacity, start, stop, windows, now_ns):
+    """
+    Worker side: volume weighted price of every stock in a shard segment
+    :return: (sum of log prices, priced stocks, zero priced stocks, unpriced stocks, first row still in a window)
+    """
+    import numpy as np
+    buffer = _attach(shard, name).buf
+    timestamps, prices, volumes, slots = _columns(buffer, capacity, start, stop)
+    # a delisted stock's slot has a window of 0, so none of its rows are live
+    windows = np.frombuffer(windows, dtype='i8')
+    row_windows = windows[slots]
+    live = (row_windows > 0) & (timestamps > now_ns - row_windows)
+    first_live = start + (int(live.argmax()) if live.any() else stop - start)
+    volumes = volumes[live]
+    notional = np.bincount(slots[live], weights=prices[live] * volumes, minlength=len(windows))
+    volume = np.bincount(slots[live], weights=volumes, minlength=len(windows))
+    listed = windows > 0
+    priced = listed & (volume > 0)
+    vwap = notional[priced] / volume[priced]
+    positive = vwap > 0
+    result = (math.fsum(np.log(vwap[positive]).tolist()), int(positive.sum()), int((~positive).sum()),
+              int(listed.sum()) - int(priced.sum()), first_live)
+    del timestamps, prices, volumes, slots, buffer
+    return result
+
+
+class _Shard:
+    """
+    Resident rows of one shard's stocks in a shared memory segment
+    """
+    def __init__(self):
+        self.segment = None
+        self.capacity = 0
+        # rows before start are out of every window, rows from stop on are unused
+        self.start = 0
+        self.stop = 0
+        # price window in ns of each stock slot, 0 once the stock is delisted
+        self.windows = array('q')
+        self.stocks = 0
+        # numpy views of the segment columns, dropped before the segment is closed
+        self.views = None
+        self.lock = threading.Lock()
+
+
+def _live_rows(shard):
+    """
+    Copies of a shard's rows from start that belong to a listed stock, so the segment can be closed after
+    """
+    import numpy as np
+    if shard.segment is None:
+        return [np.zeros(0, dtype=dtype) for dtype in ('i8', 'f8', 'f8', 'i4')]
+    columns = [column[shard.start:shard.stop] for column in shard.views]
+    keep = np.frombuffer(shard.windows, dtype='i8')[columns[3]] > 0
+    return [column[keep] for column in columns]
+
+
+class ShardedMarket:
+    """
+    Computes a Market's All Share Index across worker processes
+    """
+    def __init__(self, market, shards=None, executor=None):
+        """
+            Args:
+                market: Market to index
+                shards: number of shards, defaults to the number of cores
+                executor: ProcessPoolExecutor to run shards on, one is created per shard when None
+        """
+        self._market = market
+        self._shards = [_Shard() for i in range(shards or os.cpu_count() or 1)]
+        self._own_executor = executor is None
+        self._executor = executor or ProcessPoolExecutor(max_workers=len(self._shards))
+        # Stock -> (shard, slot)
+        self._slots = {}
+        # Stock -> trades it had recorded when loaded, the rows of later trade events overlapping them are skipped
+        self._loaded = {}
+        # segments replaced while a read may still be using them, released once no read is in flight
+        self._retired = []
+        self._readers = 0
+        self._lock = threading.Lock()
+        with market.snapshot() as stocks:
+            for stock in stocks:
+                self._load(stock)
+            market.add_listener(self._on_event)
+
+    shards = property(lambda self: len(self._shards))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Stops following the market, shuts down the workers and releases the shared memory
+        :return:
+        """
+        self._market.remove_listener(self._on_event)
+        if self._own_executor:
+            self._executor.shutdown()
+        for shard in self._shards:
+            with shard.lock:
+                self._retire(shard)
+        with self._lock:
+            self._release()
+
+    def _load(self, stock):
+        """
+        Gives a stock a slot in the least loaded shard and loads the trades in its price window
+        """
+        store = stock.transactions
+        with stock._lock:
+            if stock in self._slots:
+                return
+            shard = min(self._shards, key=operator.attrgetter('stocks'))
+            with shard.lock:
+                self._slots[stock] = (shard, len(shard.windows))
+                shard.windows.append(timedelta_to_ns(stock.price_window))
+                shard.stocks += 1
+            lo, hi = store.window(datetime_to_ns(datetime.datetime.now()) - timedelta_to_ns(stock.price_window))
+            self._append(stock, store.timestamps[lo:hi], store.prices[lo:hi], store.volumes[lo:hi])
+            self._loaded[stock] = stock.sequence
+
+    def _on_event(self, stock, kind, payload):
+        if kind == 'trade':
+            skip = self._loaded.get(stock, 0) - (payload.sequence or 0)
+            if skip > 0:
+                payload = [column[skip:] for column in payload[:3]]
+            self._append(stock, *payload[:3])
+        elif kind == 'listed':
+            self._load(stock)
+        elif kind == 'delisted':
+            shard, slot = self._slots.pop(stock, (None, None))
+            if shard is not None:
+                with shard.lock:
+                    shard.windows[slot] = 0
+                    shard.stocks -= 1
+
+    def _append(self, stock, timestamps, prices, volumes):
+        n = len(timestamps)
+        if stock not in self._slots or not n:
+            return
+        shard, slot = self._slots[stock]
+        with shard.lock:
+            if shard.stop + n > shard.capacity:
+                self._grow(shard, n)
+            stop = shard.stop
+            columns = shard.views
+            for column, values in zip(columns, (timestamps, prices, volumes)):
+                column[stop:stop + n] = values
+            columns[3][stop:stop + n] = slot
+            shard.stop = stop + n
+
+    def _grow(self, shard, n):
+        """
+        Moves a shard to a segment with room for n more rows, keeping only the rows a later read can still use.
+        Called holding the shard lock.
+        """
+        live = _live_rows(shard)
+        rows = len(live[0])
+        # grow geometrically so a busy market does not reallocate every few trades
+        capacity = max(2 * (rows + n), _MIN_ROWS)
+        segment = shared_memory.SharedMemory(create=True, size=_ROW_BYTES * capacity)
+        self._retire(shard)
+        shard.segment = segment
+        shard.capacity = capacity
+        shard.views = _columns(segment.buf, capacity, 0, capacity)
+        for column, values in zip(shard.views, live):
+            column[:rows] = values
+        shard.start = 0
+        shard.stop = rows
+
+    def _retire(self, shard):
+        # called holding the shard lock
+        shard.views = None
+        if shard.segment is not None:
+            with self._lock:
+                self._retired.append(shard.segment)
+                if not self._readers:
+                    self._release()
+        shard.segment = None
+
+    def _release(self):
+        # called holding self._lock
+        for segment in self._retired:
+            segment.close()
+            segment.unlink()
+        self._retired = []
+
+    def shard_sums(self, now=None):
+        """
+        Per-shard log price sums computed in parallel from the resident rows
+        :param now: datetime object, defaults to now
+        :return: list of (sum of log prices, priced stocks, zero priced stocks, unpriced stocks), one per shard
+        """
+        now_ns = datetime_to_ns(now or datetime.datetime.now())
+        with self._lock:
+            self._readers += 1
+        try:
+            jobs = []
+            for i, shard in enumerate(self._shards):
+                with shard.lock:
+                    if shard.segment is None:
+                        self._grow(shard, 0)
+                    jobs.append((shard.segment.name, self._executor.submit(
+                        _shard_log_sum, i, shard.segment.name, shard.capacity, shard.start, shard.stop,
+                        shard.windows.tobytes(), now_ns)))
+            sums = []
+            for shard, (name, future) in zip(self._shards, jobs):
+                result = future.result()
+                with shard.lock:
+                    # the rows before the first live one are out of every window of this and later reads
+                    if shard.segment is not None and shard.segment.name == name:
+                        shard.start = max(shard.start, result[4])
+                sums.append(result[:4])
+            return sums
+        finally:
+            with self._lock:
+                self._readers -= 1
+                if not self._readers:
+                    self._release()
+
+    def all_share_index(self, now=None):
+        """
+        Geometric mean of every listed stock's price, reduced from the shard sums
+        :param now: datetime object, defaults to now
+        :return: All Share Index, None if any stock has no trades in its window
+        """
+        sums = self.shard_sums(now)
+        log_sum = math.fsum(s[0] for s in sums)
+        priced, zero, unpriced = (sum(s[i] for s in sums) for i in (1, 2, 3))
+        n = priced + zero + unpriced
+        if n == 0 or unpriced:
+            return None
+        if zero:
+            return 0.0
+        return math.exp(log_sum / n)
@@ -1,60 +1,447 @@
 import datetime
+import heapq
+import itertools
+import math
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque, namedtuple
+from contextlib import contextmanager, nullcontext
 from warnings import warn
 import operator
-from regex import match
 
 """
 Version: Python 3.5.2 :: Anaconda 4.0.0 (64 bit)
-This file contains 3 classes: Market, Stock and Transaction
+This file contains 7 classes: Market, Stock, TransactionStore, Query, RollingVWAP, Bars and Transaction
 
 Market:
-    Contains a list of stocks and carries out calculations on collections of Stock objects.
+    Contains the listed stocks, indexed by (ticker, stock_type), and carries out calculations on collections of Stock
+    objects.
+    The All Share Index can be maintained incrementally as a running sum of log prices, refreshing only the stocks
+    that traded or whose price window moved since the last read.
+    Thread safe: each stock has its own lock so ingest threads scale across tickers, and market-wide reads take a
+    consistent snapshot.
+    The last All Share Index is cached and reused until a trade or listing change, or until a price window moves.
     Usage:
         LSE = Market()
+        LSE = Market(incremental_index=True)
 
     Implemented Methods:
         add_stock_to_market
+        add_stocks
+        ingest
+        ingest_rows
+        get
         remove_stock_from_market
+        add_listener
+        remove_listener
         list_stocks
         all_share_index
+        index_series
+        snapshot
+        valuation_ratios
+        set_retention
+        compact
+        subscribe_index
+        unsubscribe_index
+        cache_stats
+        aggregate_bars
+        historical_index
 
 Stock:
     Contains stock data and a list of transactions. Carries out calculations on individual Stock objects and collections
-    of stock transactions.
+    of stock transactions. Slotted, and the constructor validates its arguments through the property setters.
+    Prices are cached per window and reused until the stock's write version changes or the oldest trade in the window
+    ages out; price raises LookupError when the window holds no trades.
+    A market looks its stocks up by ticker and stock type, so neither can be changed while the stock is listed.
 
     Usage:
         GOOG = Stock(ticker='GOOG', stock_type='common', last_dividend=5, fixed_dividend=1.2, par_value=13)
 
     Implemented Methods:
         add_transaction
+        add_transactions
         dividend_yield
         PE_ratio
         validate_ticker_price
         get_transactions_for_last_x_min
         price
+        track_window
+        set_retention
+        compact
+        add_listener
+        remove_listener
+        aggregate_bars
+        bars
+        historical_price
+        cache_stats
+        query
+        get_transactions_by_date
+        get_transactions_by_price_range
+        get_transactions_by_volume_range
+        get_transactions_by_signal
+
+TransactionStore:
+    Columnar storage for the transactions of a single stock. Each field lives in its own typed buffer (int64 epoch-ns
+    timestamp, float64 price, float64 volume and a one byte buy/sell flag) so a trade costs 25 bytes instead of a full
+    Python object. Indexing the store hands back Transaction objects built on demand.
+    Rows are kept in timestamp order, late prints are inserted in place, so time windows are found by binary search.
+    Trades attributed to a trader or book carry a 4 byte code into an interned (trader, book) table, see party_code;
+    that column is only allocated once the store sees its first attributed trade.
+
+    Usage:
+        used internally by Stock, exposed as Stock.transactions
+
+    Implemented Methods:
+        append
+        row
+        window
+        sorted_index
+
+Query:
+    Lazy, composable filter over a stock's transactions by time, price, volume and signal. Nothing is read until the
+    query is evaluated. Time ranges are binary searches of the time ordered store, price and volume ranges are binary
+    searches of sorted indexes the store builds on first use and merges later appends into, and the signal is a mask
+    over the side flags, so only the candidate rows are ever touched.
+
+    Usage:
+        GOOG.get_transactions_by_date(datetime.date.today()).price_range(100, 110).signal('buy').transactions()
+
+    Implemented Methods:
+        between
+        on
+        price_range
+        volume_range
+        signal
+        columns
+        transactions
+
+RollingVWAP:
+    Streaming volume weighted price over one or more trailing windows of a TransactionStore. Keeps running
+    sum(price*volume) and sum(volume) per window, updated in O(1) per trade; trades that age out of a window are
+    expired lazily when the price is read.
+
+    Usage:
+        used internally by Stock.price
+
+    Implemented Methods:
+        add_window
+        on_insert
+        vwap
+
+Bars:
+    Columnar OHLCV bars at a fixed resolution. A stock can aggregate bars at several resolutions as it trades, so
+    charts, historical prices and the historical index read thousands of bars instead of millions of trades. Trades
+    evicted from a stock by its retention policy are also downsampled into bars so the day's history survives in a few
+    bytes per bar.
+
+    Usage:
+        GOOG.aggregate_bars()
+        GOOG.bars(datetime.timedelta(minutes=1), start, end)
+        GOOG.set_retention(datetime.timedelta(minutes=30), bar=datetime.timedelta(minutes=1))
+        GOOG.history.range(start_ns, end_ns)
+
+    Implemented Methods:
+        add
+        extend
+        range
+        vwap
+        grid
 
 Transaction:
-    Contains data for a single transaction. Note: A list within Stock could do this but it'd be more difficult to add
-    functionality later e.g. recording the transaction history for audit purposes.
+    Immutable record of a single transaction: signal, price, volume, an integer epoch-ns timestamp_ns and the optional
+    trader and book it is attributed to, with the timestamp also available as a datetime. A slotted named tuple, so it
+    has no per-instance __dict__ and its fields are plain tuple reads. The fields are validated once, when it is built.
 
     Usage:
         recommended to use add_transaction method of Stock
+        Transaction('buy', 12.3, 100, datetime.datetime.now())
+        Transaction('sell', 12.3, 100, trader='John', book='Sep-16')
 
     Implemented Methods:
         None
 
 """
 
+_EPOCH = datetime.datetime(1970, 1, 1)
+# smallest normal float, a product of prices below it has lost precision
+_FLOAT_MIN = sys.float_info.min
+# full recompute of the incremental index log sum after this many updates, to stop rounding error building up
+_LOG_SUM_RESYNC = 4096
+
+# parties is None for unattributed trades, else the party_code of each row; sequence is the number of trades the
+# stock had recorded before the batch's first row, None for batches that are not new trades
+TradeBatch = namedtuple('TradeBatch', 'timestamps prices volumes sides parties sequence', defaults=(None, None))
+Bar = namedtuple('Bar', 'start open high low close volume vwap')
+_SIDES = {'buy': 1, 'sell': 0}
+_SIGNALS = ('sell', 'buy')
+# NumPy dtypes matching the array typecodes used for column buffers
+_DTYPES = {'q': 'i8', 'd': 'f8', 'b': 'i1', 'i': 'i4'}
+_NO_LOCK = nullcontext()
+# cached price or index meaning there were no trades in the window, as distinct from nothing cached
+NO_TRADES = object()
+# latest epoch-ns, the validity bound of a cached result that only a write can change
+_NS_MAX = 2 ** 63 - 1
+# bar resolutions aggregated by default when a stock tracks bars as it trades
+BAR_RESOLUTIONS = (datetime.timedelta(seconds=1), datetime.timedelta(minutes=1), datetime.timedelta(hours=1))
+
+
+def datetime_to_ns(timestamp):
+    """
+    Converts a datetime to integer nanoseconds since the epoch. Naive datetimes are taken as wall clock time, the same
+    way datetime.now() reports it; aware datetimes are converted to local wall clock time first.
+    :param timestamp: datetime object
+    :return: int nanoseconds
+    """
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    return timedelta_to_ns(timestamp - _EPOCH)
+
+
+def timedelta_to_ns(delta):
+    """
+    Converts a timedelta to integer nanoseconds
+    :param delta: timedelta object
+    :return: int nanoseconds
+    """
+    return (delta.days * 86400 + delta.seconds) * 1000000000 + delta.microseconds * 1000
+
+
+def ns_to_timedelta(delta_ns):
+    """
+    Inverse of timedelta_to_ns. Precision below one microsecond is dropped.
+    :param delta_ns: int nanoseconds
+    :return: timedelta object
+    """
+    return datetime.timedelta(microseconds=delta_ns // 1000)
+
+
+def ns_to_datetime(timestamp_ns):
+    """
+    Inverse of datetime_to_ns. Precision below one microsecond is dropped.
+    :param timestamp_ns: int nanoseconds since the epoch
+    :return: naive datetime object
+    """
+    return _EPOCH + datetime.timedelta(microseconds=timestamp_ns // 1000)
+
+
+def _check_number(name, value):
+    if not isinstance(value, (int, float)):
+        raise TypeError("%s must be a number" % name)
+    if value < 0:
+        raise ValueError("%s must be positive" % name)
+    if not math.isfinite(value):
+        raise ValueError("%s must be finite" % name)
+
+
+def _validate_trade(signal, price, volume):
+    """
+    Validates a single trade. Plain lower case signals and non-negative float or int fields take the fast path.
+    :param signal: 'buy' or 'sell'
+    :param price: positive real number
+    :param volume: positive real number
+    :return: side flag, 1 (buy) or 0 (sell)
+    """
+    side = _SIDES.get(signal) if signal.__class__ is str else None
+    if side is None:
+        try:
+            side = _SIDES[signal.lower()]
+        except (AttributeError, KeyError):
+            raise ValueError("Signal must be either 'buy' or 'sell'")
+    if not (price.__class__ is float or price.__class__ is int) or not 0 <= price < math.inf:
+        _check_number('Price', price)
+    if not (volume.__class__ is float or volume.__class__ is int) or not 0 <= volume < math.inf:
+        _check_number('Volume', volume)
+    return side
+
+
+# interned (trader, book) attributions, stored with each trade as an index into _PARTIES; 0 is unattributed
+_PARTIES = [(None, None)]
+_PARTY_CODES = {(None, None): 0}
+_PARTY_LOCK = threading.Lock()
+
+
+def party_code(trader=None, book=None):
+    """
+    Interns a trade attribution as the small int stored with each trade
+    :param trader: trader name, or None
+    :param book: book name, or None
+    :return: int code, 0 for an unattributed trade
+    """
+    key = (trader, book)
+    code = _PARTY_CODES.get(key)
+    if code is None:
+        for name, value in (('Trader', trader), ('Book', book)):
+            if value is not None and not isinstance(value, str):
+                raise TypeError("%s must be a string" % name)
+        with _PARTY_LOCK:
+            code = _PARTY_CODES.get(key)
+            if code is None:
+                code = len(_PARTIES)
+                _PARTIES.append(key)
+                _PARTY_CODES[key] = code
+    return code
+
+
+def party(code):
+    """
+    Looks up an attribution interned by party_code
+    :param code: int code
+    :return: (trader, book)
+    """
+    return _PARTIES[code]
+
+
+def _party_column(traders, books, n):
+    """
+    Party codes of a batch
+    :return: int32 array, None when neither traders nor books are given
+    """
+    if traders is None and books is None:
+        return None
+    import numpy as np
+    traders = [None] * n if traders is None else list(traders)
+    books = [None] * n if books is None else list(books)
+    if not len(traders) == len(books) == n:
+        raise ValueError("batch columns must all be the same length")
+    return np.fromiter(map(party_code, traders, books), dtype='i4', count=n)
+
+
+def _valid_ticker(ticker):
+    """
+    Checks a ticker is an ASCII letter followed by ASCII letters and digits, the equivalent of the pattern
+    [A-Za-z][A-Za-z0-9]*$ without a regex engine to import or compile
+    :param ticker: string
+    :return: True if valid
+    """
+    return ticker.isascii() and ticker.isalnum() and ticker[0].isalpha()
+
+
+def _geometric_mean(prices):
+    """
+    Geometric mean as the n-th root of the product of the prices while that product stays in range, else as the
+    exponent of the mean log price, since the product of thousands of prices overflows
+    :param prices: list of prices, None for unpriced
+    :return: mean, None if any price is None or there are none, 0.0 if any price is zero
+    """
+    if not prices or None in prices:
+        return None
+    if min(prices) <= 0:
+        return 0.0
+    product = math.prod(prices)
+    if _FLOAT_MIN <= product < math.inf:
+        return product ** (1 / len(prices))
+    return math.exp(math.fsum(map(math.log, prices)) / len(prices))
+
+
+def validate_batch(signals, prices, volumes, timestamps=None):
+    """
+    Validates and converts a batch of trade columns with NumPy
+    :param signals: sequence of 'buy'/'sell' strings, or of 1 (buy) / 0 (sell) flags
+    :param prices: sequence of positive real numbers
+    :param volumes: sequence of positive real numbers
+    :param timestamps: sequence of datetime objects, datetime64 values or epoch-ns ints, None for now
+    :return: (int64 timestamps, float64 prices, float64 volumes, int8 sides) arrays
+    """
+    import numpy as np
+    columns = []
+    for name, values in (('Price', prices), ('Volume', volumes)):
+        try:
+            values = np.asarray(values, dtype='f8')
+        except (TypeError, ValueError):
+            raise TypeError("%s must be a number" % name)
+        if values.ndim != 1:
+            raise ValueError("%s must be a one dimensional sequence" % name)
+        if not np.isfinite(values).all():
+            raise ValueError("%s must be finite" % name)
+        if (values < 0).any():
+            raise ValueError("%s must be positive" % name)
+        columns.append(values)
+    prices, volumes = columns
+    n = len(prices)
+    if n == 0:
+        # an empty list has no dtype to validate the signals or timestamps by
+        if len(signals) or len(volumes) or (timestamps is not None and len(timestamps)):
+            raise ValueError("batch columns must all be the same length")
+        return np.zeros(0, dtype='i8'), prices, volumes, np.zeros(0, dtype='i1')
+
+    signals = np.asarray(signals)
+    if signals.dtype.kind in 'biu':
+        if not np.isin(signals, (0, 1)).all():
+            raise ValueError("Signal flags must be 1 (buy) or 0 (sell)")
+        sides = signals.astype('i1')
+    elif signals.dtype.kind in 'UO':
+        signals = np.char.lower(signals.astype('U'))
+        sides = (signals == 'buy').astype('i1')
+        if not (sides.astype(bool) | (signals == 'sell')).all():
+            raise ValueError("Signal must be either 'buy' or 'sell'")
+    else:
+        raise ValueError("Signal must be either 'buy' or 'sell'")
+
+    if timestamps is None:
+        timestamps = np.full(n, datetime_to_ns(datetime.datetime.now()), dtype='i8')
+    else:
+        timestamps = np.asarray(timestamps)
+        if timestamps.dtype.kind == 'M':
+            timestamps = timestamps.astype('datetime64[ns]').view('i8')
+        elif timestamps.dtype.kind in 'iu':
+            timestamps = timestamps.astype('i8')
+        elif timestamps.dtype.kind == 'O':
+            try:
+                timestamps = np.fromiter((datetime_to_ns(t) for t in timestamps), dtype='i8', count=len(timestamps))
+            except AttributeError:
+                raise TypeError("Timestamp must be datetime object")
+        else:
+            raise TypeError("Timestamp must be datetime object")
+
+    if not len(sides) == len(volumes) == len(timestamps) == n:
+        raise ValueError("batch columns must all be the same length")
+    return timestamps, prices, volumes, sides
+
+
 class Market:
     """
     Object to hold all the stock objects and carry out market calculations
     """
-    def __init__(self):
+    def __init__(self, incremental_index=False):
         """
             Args:
-                None
+                incremental_index: if True all_share_index is read from the running log price sum
         """
-        self.stocks = []
+        # (ticker, stock_type) -> Stock, in listing order
+        self._stocks = {}
+        # cached NumPy columns of listing metadata for valuation_ratios, rebuilt after listing or dividend changes
+        self._metadata = None
+        self._incremental_index = incremental_index
+        self._log_prices = {}
+        self._log_sum = 0.0
+        self._unpriced = 0
+        self._zero_priced = 0
+        self._updates = 0
+        # stocks to reprice, queued without taking the market lock so ingest threads never contend on it
+        self._dirty = deque()
+        self._queued = {}
+        self._deadlines = []
+        self._deadline_seq = 0
+        # stocks repriced by the last index read
+        self._repriced = 0
+        self._index_subscribers = []
+        self._listeners = []
+        self._retention = None
+        self._bar_resolutions = None
+        # write version, bumped by every trade and listing change; versions come from a counter so they never repeat
+        self._writes = itertools.count(1)
+        self._version = 0
+        # (version, computed at, valid until, index or NO_TRADES) of the last all_share_index read
+        self._index_cache = None
+        self._index_hits = 0
+        self._index_misses = 0
+        # guards the listings and incremental index state; never acquired while holding a stock lock
+        self._lock = threading.RLock()
+
+    stocks = property(lambda self: list(self._stocks.values()))
+    incremental_index = property(operator.attrgetter('_incremental_index'))
 
     def add_stock_to_market(self, stock):
         """
@@ -64,13 +451,88 @@ class Market:
         """
         if not isinstance(stock, Stock):
             raise AttributeError("Error adding stock to market - not a valid stock object")
-
-        for stocks in self.stocks:
-            if stock.ticker == stocks.ticker and stock.stock_type == stocks.stock_type:
+        key = (stock.ticker, stock.stock_type)
+        with self._lock:
+            if key in self._stocks:
                 raise LookupError("Stock already in market")
+            self._list(key, stock)
+        self._notify(stock, 'listed', None)
+
+    def add_stocks(self, stocks):
+        """
+        Adds many stock objects to the market. The whole batch is validated before anything is added.
+        :param stocks: iterable of Stock objects
+        :return:
+        """
+        batch = {}
+        with self._lock:
+            for stock in stocks:
+                if not isinstance(stock, Stock):
+                    raise AttributeError("Error adding stock to market - not a valid stock object")
+                key = (stock.ticker, stock.stock_type)
+                if key in self._stocks or key in batch:
+                    raise LookupError("Stock %s already in market" % stock.ticker)
+                batch[key] = stock
+            for key, stock in batch.items():
+                self._list(key, stock)
+        for stock in batch.values():
+            self._notify(stock, 'listed', None)
+
+    def ingest(self, tickers, signals, prices, volumes, timestamps=None, stock_type='common', traders=None,
+               books=None):
+        """
+        Records a batch of trades across the market. The whole batch is validated before anything is stored, rows are
+        grouped by ticker in one sort and each stock receives its rows as a single batch.
+        :param tickers: sequence of listed tickers
+        :param signals: sequence of 'buy'/'sell' strings, or of 1 (buy) / 0 (sell) flags
+        :param prices: sequence of positive real numbers
+        :param volumes: sequence of positive real numbers
+        :param timestamps: sequence of datetime objects, datetime64 values or epoch-ns ints, defaults to now
+        :param stock_type: type of the listings the tickers refer to
+        :param traders: sequence of trader names or None, optional
+        :param books: sequence of book names or None, optional
+        :return: number of transactions added
+        """
+        import numpy as np
+        timestamps, prices, volumes, sides = validate_batch(signals, prices, volumes, timestamps)
+        parties = _party_column(traders, books, len(prices))
+        symbols, codes = np.unique(np.asarray(tickers, dtype='U'), return_inverse=True)
+        if len(codes) != len(prices):
+            raise ValueError("batch columns must all be the same length")
+        stocks = [self.get(str(symbol), stock_type) for symbol in symbols]
+        order = np.lexsort((timestamps, codes))
+        bounds = np.searchsorted(codes[order], np.arange(len(symbols) + 1))
+        for stock, lo, hi in zip(stocks, bounds[:-1], bounds[1:]):
+            rows = order[lo:hi]
+            stock._add_batch(timestamps[rows], prices[rows], volumes[rows], sides[rows],
+                             None if parties is None else parties[rows])
+        return len(order)
+
+    def ingest_rows(self, rows, stock_type='common'):
+        """
+        Records trades given as (ticker, signal, price, volume, timestamp) rows, see ingest
+        :param rows: iterable of 5-tuples
+        :param stock_type: type of the listings the tickers refer to
+        :return: number of transactions added
+        """
+        columns = list(zip(*rows))
+        if not columns:
+            return 0
+        if len(columns) != 5:
+            raise ValueError("rows must be (ticker, signal, price, volume, timestamp)")
+        return self.ingest(*columns, stock_type=stock_type)
 
-        self.stocks.append(stock)
-        print("stock %s successfully added" % stock.ticker)
+    def get(self, ticker, stock_type='common'):
+        """
+        Looks up a listed stock
+        :param ticker: stock ticker
+        :param stock_type: 'common' or 'preferred'
+        :return: Stock
+        """
+        try:
+            return self._stocks[(ticker, stock_type)]
+        except KeyError:
+            raise LookupError("Stock %s not in market" % ticker)
 
     def remove_stock_from_market(self, stock):
         """
@@ -80,33 +542,394 @@ class Market:
         """
         if not isinstance(stock,Stock):
             raise AttributeError("stock must be a valid Stock object")
-        try:
-            self.stocks.remove(stock)
-        except ValueError:
-            raise ValueError("Error removing stock from market - stock not in market")
+        key = (stock.ticker, stock.stock_type)
+        with self._lock:
+            if self._stocks.get(key) is not stock:
+                raise ValueError("Error removing stock from market - stock not in market")
+            del self._stocks[key]
+            stock._listings -= 1
+            self._metadata = None
+            stock.remove_listener(self._on_stock_event)
+            self._set_log_price(stock, None)
+            del self._log_prices[stock]
+            del self._queued[stock]
+            self._version = next(self._writes)
+            self._unpriced -= 1
+        self._notify(stock, 'delisted', None)
+
+    def _list(self, key, stock):
+        self._stocks[key] = stock
+        stock._listings += 1
+        self._metadata = None
+        self._log_prices[stock] = None
+        self._unpriced += 1
+        self._queued[stock] = True
+        self._dirty.append(stock)
+        stock.add_listener(self._on_stock_event)
+        self._version = next(self._writes)
+        if self._retention is not None:
+            stock.set_retention(*self._retention)
+        if self._bar_resolutions is not None:
+            stock.aggregate_bars(self._bar_resolutions)
+
+    @contextmanager
+    def snapshot(self):
+        """
+        Context manager giving a consistent cut across the market: the listings and every listed stock are locked,
+        so no trade lands anywhere until the block exits. Ingest threads only wait for the length of the block.
+        :return: list of listed stocks
+        """
+        with self._lock:
+            stocks = list(self._stocks.values())
+            locked = []
+            try:
+                for stock in sorted(stocks, key=id):
+                    stock._lock.acquire()
+                    locked.append(stock)
+                yield stocks
+            finally:
+                for stock in locked:
+                    stock._lock.release()
+
+    def set_retention(self, hot, bar=datetime.timedelta(minutes=1), spill=None):
+        """
+        Applies a retention policy to every listed stock and to stocks listed later, see Stock.set_retention
+        :param hot: datetime.timedelta of trades to keep in memory, None turns retention off
+        :param bar: datetime.timedelta bar resolution for evicted trades, None to keep no bars
+        :param spill: callable(stock, TradeBatch) given each batch of evicted trades
+        :return:
+        """
+        with self._lock:
+            for stock in self._stocks.values():
+                stock.set_retention(hot, bar, spill)
+            self._retention = None if hot is None else (hot, bar, spill)
+
+    def aggregate_bars(self, resolutions=BAR_RESOLUTIONS):
+        """
+        Has every listed stock, and stocks listed later, aggregate OHLCV bars as it trades, see Stock.aggregate_bars
+        :param resolutions: datetime.timedelta bar lengths
+        :return:
+        """
+        with self._lock:
+            for stock in self._stocks.values():
+                stock.aggregate_bars(resolutions)
+            self._bar_resolutions = tuple(resolutions)
+
+    def historical_index(self, start, end, resolution=datetime.timedelta(minutes=1)):
+        """
+        All Share Index as of the close of every bar from start to end, computed from the stocks' bars rather than
+        their trades. Each stock is priced over the bars covering its price window, rounded up to whole bars.
+        :param start: datetime object
+        :param end: datetime object
+        :param resolution: datetime.timedelta bar length, aggregated by every listed stock
+        :return: list of (bar close datetime, index), index None where some stock had no trades in its window
+        """
+        import numpy as np
+        resolution_ns = timedelta_to_ns(resolution)
+        start_ns = datetime_to_ns(start)
+        start_ns -= start_ns % resolution_ns
+        n = max(0, -(-(datetime_to_ns(end) - start_ns) // resolution_ns))
+        log_sum = np.zeros(n)
+        unpriced = np.zeros(n, dtype=bool)
+        zero = np.zeros(n, dtype=bool)
+        with self.snapshot() as stocks:
+            for stock in stocks:
+                bars = stock._bars.get(resolution_ns)
+                if bars is None:
+                    raise ValueError("%s does not aggregate %s bars" % (stock.ticker, resolution))
+                width = max(1, -(-stock._price_window // resolution_ns))
+                notional, volume = bars.grid(start_ns - (width - 1) * resolution_ns, n + width - 1)
+                # rolling sums over the window by differencing running totals; bar counts say exactly which are empty
+                totals = [np.concatenate(([0], np.cumsum(column))) for column in (notional, volume, volume > 0)]
+                notional, volume, traded = [total[width:] - total[:-width] for total in totals]
+                priced = traded > 0
+                unpriced |= ~priced
+                prices = np.divide(notional, volume, out=np.zeros(n), where=priced)
+                zero |= priced & (prices <= 0)
+                np.add(log_sum, np.log(prices, out=np.zeros(n), where=prices > 0), out=log_sum)
+        index = np.exp(log_sum / len(stocks)) if stocks else np.zeros(n)
+        index[zero] = 0.0
+        closes = start_ns + resolution_ns * np.arange(1, n + 1)
+        return [(ns_to_datetime(close), None if missing or not stocks else value)
+                for close, missing, value in zip(closes.tolist(), unpriced.tolist(), index.tolist())]
+
+    def compact(self, now=None):
+        """
+        Evicts trades older than the retention period from every listed stock. Safe to call from a timer to keep
+        memory flat when some stocks stop trading.
+        :param now: datetime object, defaults to each stock's newest trade
+        :return: number of trades evicted
+        """
+        now_ns = None if now is None else datetime_to_ns(now)
+        return sum(stock.compact(now_ns) for stock in self.stocks)
+
+    def add_listener(self, callback):
+        """
+        Registers callback(stock, kind, payload) for every event of every listed stock (see Stock.add_listener),
+        plus 'listed' and 'delisted' events with None as payload when the market's listings change
+        :param callback: callable
+        :return:
+        """
+        with self._lock:
+            self._listeners = self._listeners + [callback]
+
+    def remove_listener(self, callback):
+        """
+        Unregisters a callback added with add_listener
+        :param callback: callable
+        :return:
+        """
+        with self._lock:
+            listeners = list(self._listeners)
+            listeners.remove(callback)
+            self._listeners = listeners
+
+    def _notify(self, stock, kind, payload):
+        for callback in self._listeners:
+            callback(stock, kind, payload)
 
     def list_stocks(self):
         """
         Lists stocks in market
         :return: list of stocks
         """
-        stock_list = []
-        if len(self.stocks)>500:
+        stock_list = self.stocks
+        if len(stock_list)>500:
             warn("There are over 500 stocks, are you sure you want to list them?")
             # TODO: Must be a way to get user input for continue/cancel options
-        for stock in self.stocks:
-            stock_list.append(stock)
         return stock_list
 
-    def all_share_index(self):
+    def all_share_index(self, as_of=None):
         """
         Calculates and returns All Share Index
-        :return: Market All Share Index
+        :param as_of: datetime object to compute the index at instead of now, from each stock's trades up to then
+        :return: Market All Share Index, None if any stock has no trades in its window
+        """
+        if as_of is not None:
+            as_of_ns = datetime_to_ns(as_of)
+            with self.snapshot() as stocks:
+                self._repriced = len(stocks)
+                return _geometric_mean([stock._price_as_of(stock._price_window, as_of_ns) for stock in stocks])
+        now_ns = datetime_to_ns(datetime.datetime.now())
+        # reused until a trade or listing change, or until the earliest in-window trade of any stock ages out
+        entry = self._index_cache
+        if entry is not None and entry[0] == self._version and entry[1] <= now_ns < entry[2]:
+            self._index_hits += 1
+            self._repriced = 0
+            index = entry[3]
+            return None if index is NO_TRADES else index
+        self._index_misses += 1
+        version = self._version
+        if self._incremental_index:
+            with self._lock:
+                index = self._refresh_index(now_ns)
+                valid_until = self._deadlines[0][0] if self._deadlines else _NS_MAX
+        else:
+            with self.snapshot() as stocks:
+                prices = []
+                valid_until = _NS_MAX
+                for stock in stocks:
+                    prices.append(stock._price(now_ns=now_ns))
+                    expiry = stock._price_expiry()
+                    if expiry is not None and expiry < valid_until:
+                        valid_until = expiry
+                index = _geometric_mean(prices)
+                self._repriced = len(stocks)
+        self._index_cache = (version, now_ns, valid_until, NO_TRADES if index is None else index)
+        return index
+
+    def cache_stats(self):
+        """
+        Price and index cache counters
+        :return: dict of index_hits and index_misses, and price_hits and price_misses summed over the listed stocks
+        """
+        stats = [stock.cache_stats() for stock in self.stocks]
+        return {'index_hits': self._index_hits, 'index_misses': self._index_misses,
+                'price_hits': sum(stat['hits'] for stat in stats),
+                'price_misses': sum(stat['misses'] for stat in stats)}
+
+    def index_series(self, start, end, step=datetime.timedelta(seconds=1)):
+        """
+        All Share Index at every point of a time grid, in one vectorized sweep over each stock's sorted trades: the
+        running sums of price*volume and volume are differenced between the binary searched window bounds of every
+        grid point, so the cost is one pass per stock rather than one index computation per point.
+        :param start: datetime object of the first point
+        :param end: datetime object, the last point is at or before it
+        :param step: datetime.timedelta between points
+        :return: list of (datetime, index), index None where some stock had no trades in its window
+        """
+        import numpy as np
+        step_ns = timedelta_to_ns(step)
+        if step_ns <= 0:
+            raise ValueError("step must be positive")
+        start_ns = datetime_to_ns(start)
+        grid = np.arange(start_ns, datetime_to_ns(end) + 1, step_ns, dtype='i8')
+        n = len(grid)
+        log_sum = np.zeros(n)
+        unpriced = np.zeros(n, dtype=bool)
+        zero = np.zeros(n, dtype=bool)
+        with self.snapshot() as stocks:
+            for stock in stocks:
+                store = stock._store
+                timestamps = np.frombuffer(store.timestamps, dtype='i8')
+                prices = np.frombuffer(store.prices, dtype='f8')
+                volumes = np.frombuffer(store.volumes, dtype='f8')
+                notional = np.concatenate(([0.0], np.cumsum(prices * volumes)))
+                volume = np.concatenate(([0.0], np.cumsum(volumes)))
+                # window of a point is (point - price window, point]
+                hi = np.searchsorted(timestamps, grid, 'right')
+                lo = np.searchsorted(timestamps, grid - stock._price_window, 'right')
+                del timestamps, prices, volumes
+                window_volume = volume[hi] - volume[lo]
+                priced = (hi > lo) & (window_volume > 0)
+                unpriced |= ~priced
+                price = np.divide(notional[hi] - notional[lo], window_volume, out=np.zeros(n), where=priced)
+                zero |= priced & (price <= 0)
+                np.add(log_sum, np.log(price, out=np.zeros(n), where=price > 0), out=log_sum)
+        index = np.exp(log_sum / len(stocks)) if stocks else np.zeros(n)
+        index[zero] = 0.0
+        return [(ns_to_datetime(point), None if missing or not stocks else value)
+                for point, missing, value in zip(grid.tolist(), unpriced.tolist(), index.tolist())]
+
+    def subscribe_index(self, callback, tolerance=0.0):
+        """
+        Calls callback(index) whenever the All Share Index moves by more than tolerance, relative to the last value
+        the callback was given. The index is refreshed after every trade while there are subscribers.
+        :param callback: callable taking the new index
+        :param tolerance: relative move needed to fire, e.g. 0.001 for 10 basis points
+        :return:
+        """
+        if tolerance < 0:
+            raise ValueError("tolerance must not be negative")
+        with self._lock:
+            self._index_subscribers.append([callback, tolerance, None])
+
+    def unsubscribe_index(self, callback):
+        """
+        Removes an index subscription
+        :param callback: callable previously passed to subscribe_index
+        :return:
+        """
+        with self._lock:
+            for subscriber in self._index_subscribers:
+                if subscriber[0] == callback:
+                    self._index_subscribers.remove(subscriber)
+                    return
+        raise ValueError("callback is not subscribed")
+
+    def valuation_ratios(self, ticker_prices):
         """
-        price_product = 1
-        for stock in self.stocks:
-            price_product *= stock.price()
-        return price_product**(1/len(self.stocks))
+        Dividend yield and P/E ratio for every listed stock in one vectorized pass. Common and preferred stocks are
+        handled with masks; a zero dividend gives an infinite P/E and a non-positive price gives NaN for both.
+        :param ticker_prices: ticker prices in list_stocks() order
+        :return: (dividend yields, PE ratios) as NumPy float64 arrays in list_stocks() order
+        """
+        import numpy as np
+        with self._lock:
+            if self._metadata is None:
+                stocks = self._stocks.values()
+                self._metadata = (np.array([s.stock_type == 'preferred' for s in stocks], dtype=bool),
+                                  np.array([s.last_dividend for s in stocks], dtype='f8'),
+                                  np.array([s.fixed_dividend * s.par_value for s in stocks], dtype='f8'))
+            preferred, last_dividend, preferred_dividend = self._metadata
+        try:
+            ticker_prices = np.asarray(ticker_prices, dtype='f8')
+        except (TypeError, ValueError):
+            raise TypeError("ticker price must be a number")
+        if ticker_prices.shape != last_dividend.shape:
+            raise ValueError("expected %d ticker prices, one per listed stock" % len(last_dividend))
+        ticker_prices = np.where(ticker_prices > 0, ticker_prices, np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dividend_yields = np.where(preferred, preferred_dividend, last_dividend) / ticker_prices
+            pe_ratios = ticker_prices / last_dividend
+        return dividend_yields, pe_ratios
+
+    def _on_stock_event(self, stock, kind, payload):
+        if kind == 'meta':
+            self._metadata = None
+        elif kind == 'trade':
+            self._version = next(self._writes)
+            # deque.append and dict assignment are atomic, so trades on different stocks never serialize here
+            if not self._queued.get(stock, True):
+                self._queued[stock] = True
+                self._dirty.append(stock)
+            if self._index_subscribers:
+                with self._lock:
+                    self._notify_index(self._refresh_index())
+        if self._listeners:
+            self._notify(stock, kind, payload)
+
+    def _notify_index(self, index):
+        if index is None:
+            return
+        for subscriber in self._index_subscribers:
+            callback, tolerance, last = subscriber
+            if last is None or abs(index - last) > tolerance * abs(last):
+                subscriber[2] = index
+                callback(index)
+
+    def _set_log_price(self, stock, price):
+        old = self._log_prices[stock]
+        if old is None:
+            self._unpriced -= 1
+        elif old == -math.inf:
+            self._zero_priced -= 1
+        else:
+            self._log_sum -= old
+        if price is None:
+            new = None
+            self._unpriced += 1
+        elif price <= 0:
+            new = -math.inf
+            self._zero_priced += 1
+        else:
+            new = math.log(price)
+            self._log_sum += new
+        self._log_prices[stock] = new
+        self._updates += 1
+        if self._updates >= _LOG_SUM_RESYNC:
+            self._updates = 0
+            self._log_sum = math.fsum(p for p in self._log_prices.values() if p is not None and p != -math.inf)
+
+    def _refresh_index(self, now_ns=None):
+        """
+        Reprices the stocks that traded, or whose oldest in-window trade expired, since the last read. Caller must
+        hold the market lock.
+        :param now_ns: current time in epoch-ns
+        :return: All Share Index, None if any stock has no trades in its window
+        """
+        if now_ns is None:
+            now_ns = datetime_to_ns(datetime.datetime.now())
+        deadlines = self._deadlines
+        dirty = self._dirty
+        while deadlines and deadlines[0][0] <= now_ns:
+            dirty.append(heapq.heappop(deadlines)[2])
+        repriced = set()
+        while dirty:
+            stock = dirty.popleft()
+            if stock not in self._log_prices:
+                continue
+            # a repeat is only skipped when nothing queued it since it was repriced: a trade that re-queued it after
+            # its flag was cleared may have no other entry left to be popped
+            if stock in repriced and not self._queued[stock]:
+                continue
+            repriced.add(stock)
+            # clear the flag first so a trade landing while we reprice queues the stock again
+            self._queued[stock] = False
+            with stock._lock:
+                price = stock._price(now_ns=now_ns)
+                expiry = stock._price_expiry()
+            self._set_log_price(stock, price)
+            if expiry is not None:
+                self._deadline_seq += 1
+                heapq.heappush(deadlines, (expiry, self._deadline_seq, stock))
+        self._repriced = len(repriced)
+        n = len(self._log_prices)
+        if n == 0 or self._unpriced:
+            return None
+        if self._zero_priced:
+            return 0.0
+        return math.exp(self._log_sum / n)
 
 
 class Stock:
@@ -116,19 +939,47 @@ class Stock:
     def __str__(self):
         return str(self._ticker)
 
-    def __init__(self, ticker, stock_type='common', last_dividend=0, fixed_dividend=0, par_value=0):
-        self._ticker = ticker
-        self._stock_type = stock_type
-        self._last_dividend = last_dividend
-        self._fixed_dividend = fixed_dividend
-        self._par_value = par_value
-        self.transactions = []
+    __slots__ = ('_ticker', '_stock_type', '_last_dividend', '_fixed_dividend', '_par_value', '_store', '_price_window',
+                 '_vwap', '_retention', '_spill', '_history', '_listeners', '_lock', '_bars',
+                 '_price_cache', '_hits', '_misses', '_sequence', '_listings', '__weakref__')
+
+    def __init__(self, ticker, stock_type='common', last_dividend=0, fixed_dividend=0, par_value=0,
+                 price_window=datetime.timedelta(minutes=15)):
+        # the setters notify listeners, so the list must exist before they run
+        self._listeners = []
+        # markets the stock is listed in, which key it by ticker and stock type
+        self._listings = 0
+        self.ticker = ticker
+        self.stock_type = stock_type
+        self.last_dividend = last_dividend
+        self.fixed_dividend = fixed_dividend
+        self.par_value = par_value
+        self._store = TransactionStore()
+        self._price_window = timedelta_to_ns(price_window)
+        self._vwap = RollingVWAP(self._store, (self._price_window,))
+        self._retention = None
+        self._spill = None
+        self._history = None
+        # bar resolution in ns -> Bars aggregated as trades are added
+        self._bars = {}
+        # window in ns -> (store version, computed at, valid until, price or NO_TRADES)
+        self._price_cache = {}
+        self._hits = 0
+        self._misses = 0
+        # trades recorded so far, compaction does not lower it
+        self._sequence = 0
+        # guards the transaction buffers and rolling sums; writers on different stocks never share a lock
+        self._lock = threading.RLock()
 
     ticker = property(operator.attrgetter('_ticker'))
     stock_type = property(operator.attrgetter('_stock_type'))
     last_dividend = property(operator.attrgetter('_last_dividend'))
     fixed_dividend = property(operator.attrgetter('_fixed_dividend'))
     par_value = property(operator.attrgetter('_par_value'))
+    transactions = property(operator.attrgetter('_store'))
+    price_window = property(lambda self: ns_to_timedelta(self._price_window))
+    history = property(operator.attrgetter('_history'))
+    sequence = property(operator.attrgetter('_sequence'))
 
     @ticker.setter
     def ticker(self, t):
@@ -136,15 +987,23 @@ class Stock:
             raise TypeError("Ticker must be a string")
         if len(t) not in range(1,6):
             raise Exception("Ticker must be between 1 and 5 letters")
-        if not match(r'[aA-zZ]+', t):
-            raise Exception("Ticker may not have numbers, punctuation or special characters")
+        if not _valid_ticker(t):
+            raise Exception("Ticker must start with a letter and may not have punctuation or special characters")
+        self._check_unlisted('ticker')
         self._ticker = t
 
     @stock_type.setter
     def stock_type(self, st):
         if st not in ('common', 'preferred'):
             raise Exception("stock type must be 'common' or 'preferred'")
+        self._check_unlisted('stock type')
         self._stock_type = st
+        self._notify('meta', None)
+
+    def _check_unlisted(self, name):
+        # markets look stocks up by ticker and stock type, a listed stock changing either would be lost to them
+        if self._listings:
+            raise Exception("Cannot change the %s of a listed stock, remove it from the market first" % name)
 
     @last_dividend.setter
     def last_dividend(self, ld):
@@ -153,6 +1012,7 @@ class Stock:
         if ld < 0:
             raise Exception("Cannot have negative last dividend")
         self._last_dividend = ld
+        self._notify('meta', None)
 
     @fixed_dividend.setter
     def fixed_dividend(self, fd):
@@ -161,6 +1021,7 @@ class Stock:
         if fd < 0:
             raise Exception("Cannot have negative fixed dividend")
         self._fixed_dividend = fd
+        self._notify('meta', None)
 
     @par_value.setter
     def par_value(self, v):
@@ -169,17 +1030,159 @@ class Stock:
         if v < 0:
             raise Exception("Par Value must be positive")
         self._par_value = v
+        self._notify('meta', None)
 
-    def add_transaction(self, signal, price, volume, timestamp=datetime.datetime.now()):
+    def add_transaction(self, signal, price, volume, timestamp=None, trader=None, book=None):
         """
         Adds a transaction to a stock
         :param signal: 'buy' or 'sell'
         :param price: positive real number
         :param volume: positive real number
-        :param timestamp: datetime object
+        :param timestamp: datetime object, defaults to now
+        :param trader: name of the trader, optional
+        :param book: name of the book, optional
+        :return:
+        """
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+        timestamp_ns = datetime_to_ns(timestamp)
+        code = 0 if trader is None and book is None else party_code(trader, book)
+        with self._lock:
+            position = self._store.append(signal, price, volume, timestamp_ns, code)
+            self._vwap.on_insert(price, volume, timestamp_ns)
+            for bars in self._bars.values():
+                bars.add(timestamp_ns, price, volume)
+            side = self._store.sides[position]
+            sequence = self._sequence
+            self._sequence += 1
+            if self._retention is not None:
+                self._maybe_compact()
+        # listeners run outside the stock lock so they may take the market lock without risking deadlock
+        if self._listeners:
+            self._notify('trade', TradeBatch((timestamp_ns,), (price,), (volume,), (side,), (code,) if code else None,
+                                             sequence))
+
+    def add_transactions(self, signals, prices, volumes, timestamps=None, traders=None, books=None):
+        """
+        Adds a batch of transactions in one go. The whole batch is validated with NumPy before anything is stored,
+        then written with a single extend of each column buffer.
+        :param signals: sequence of 'buy'/'sell' strings, or of 1 (buy) / 0 (sell) flags
+        :param prices: sequence of positive real numbers
+        :param volumes: sequence of positive real numbers
+        :param timestamps: sequence of datetime objects, datetime64 values or epoch-ns ints, defaults to now
+        :param traders: sequence of trader names or None, optional
+        :param books: sequence of book names or None, optional
+        :return: number of transactions added
+        """
+        timestamps, prices, volumes, sides = validate_batch(signals, prices, volumes, timestamps)
+        parties = _party_column(traders, books, len(prices))
+        order = timestamps.argsort(kind='stable')
+        self._add_batch(timestamps[order], prices[order], volumes[order], sides[order],
+                        None if parties is None else parties[order])
+        return len(order)
+
+    def _add_batch(self, timestamps, prices, volumes, sides, parties=None):
+        """
+        Stores an already validated, timestamp sorted batch of NumPy columns
+        """
+        if not len(timestamps):
+            return
+        with self._lock:
+            self._store.extend(timestamps, prices, volumes, sides, parties)
+            self._vwap.on_extend(timestamps, prices, volumes)
+            for bars in self._bars.values():
+                bars.extend(timestamps, prices, volumes)
+            sequence = self._sequence
+            self._sequence += len(timestamps)
+            if self._retention is not None:
+                self._maybe_compact()
+        if self._listeners:
+            self._notify('trade', TradeBatch(timestamps, prices, volumes, sides, parties, sequence))
+
+    def set_retention(self, hot, bar=datetime.timedelta(minutes=1), spill=None):
+        """
+        Keeps only the most recent trades in memory. Older trades are downsampled into OHLCV bars kept in
+        Stock.history and/or handed to spill, then evicted. Compaction runs on write, measured against the newest
+        stored trade, once the oldest trade is an eighth of the hot period past the cutoff.
+        :param hot: datetime.timedelta of trades to keep, at least the longest price window; None turns retention off
+        :param bar: datetime.timedelta bar resolution for evicted trades, None to keep no bars
+        :param spill: callable(stock, TradeBatch) given each batch of evicted trades, e.g. tape.BinaryTapeWriter.spill
+        :return:
+        """
+        with self._lock:
+            if hot is None:
+                self._retention = None
+                return
+            hot_ns = timedelta_to_ns(hot)
+            if hot_ns < max(self._vwap.windows):
+                raise ValueError("retention must cover the longest price window")
+            if bar is not None:
+                bar_ns = timedelta_to_ns(bar)
+                if self._history is None:
+                    self._history = Bars(bar_ns)
+                elif self._history.resolution != bar_ns:
+                    raise ValueError("history is already kept in %s bars" %
+                                     ns_to_timedelta(self._history.resolution))
+            self._retention = hot_ns
+            self._spill = spill
+            self.compact()
+
+    def compact(self, now_ns=None):
+        """
+        Evicts trades older than the retention period
+        :param now_ns: current time in epoch-ns, defaults to the newest stored trade
+        :return: number of trades evicted
+        """
+        with self._lock:
+            timestamps = self._store.timestamps
+            if self._retention is None or not timestamps:
+                return 0
+            if now_ns is None:
+                now_ns = timestamps[-1]
+            evicted = bisect_right(timestamps, now_ns - self._retention)
+            if not evicted:
+                return 0
+            import numpy as np
+            batch = TradeBatch(*(np.frombuffer(column[:evicted], dtype=_DTYPES[column.typecode]) for column in
+                                 (timestamps, self._store.prices, self._store.volumes, self._store.sides)))
+            if self._history is not None:
+                self._history.extend(batch.timestamps, batch.prices, batch.volumes)
+            if self._spill is not None:
+                self._spill(self, batch)
+            self._vwap.on_drop(evicted)
+            self._store.drop(evicted)
+            return evicted
+
+    def _maybe_compact(self):
+        timestamps = self._store.timestamps
+        if timestamps[0] < timestamps[-1] - self._retention - self._retention // 8:
+            self.compact()
+
+    def add_listener(self, callback):
+        """
+        Registers callback(stock, kind, payload) to be called after the stock changes. kind is 'trade' with a
+        TradeBatch of the new rows as payload, or 'meta' with None when a dividend, par value or type is changed.
+        :param callback: callable
         :return:
         """
-        self.transactions.append(Transaction(signal, price, volume, timestamp))
+        with self._lock:
+            self._listeners = self._listeners + [callback]
+
+    def remove_listener(self, callback):
+        """
+        Unregisters a callback added with add_listener
+        :param callback: callable
+        :return:
+        """
+        with self._lock:
+            listeners = list(self._listeners)
+            listeners.remove(callback)
+            self._listeners = listeners
+
+    def _notify(self, kind, payload):
+        # the listener list is replaced, never mutated, so it can be read without the lock
+        for callback in self._listeners:
+            callback(self, kind, payload)
 
     def dividend_yield(self, ticker_price):
         """
@@ -222,31 +1225,151 @@ class Stock:
         """
         helper method for getting transactions over a period of time
         :param x: datetime.timedelta object
-        :return: list of transactions from now to now - x
-        """
-        latest_trans_list = []
-        time_now = datetime.datetime.now()
-        sorted_transactions = sorted(self.transactions, key=operator.attrgetter("timestamp"), reverse=True)
-        loop_stop = False
-        while loop_stop == False and len(sorted_transactions) > 0:
-            last_transaction = sorted_transactions.pop()
-            if (time_now - last_transaction.timestamp) < x:
-                latest_trans_list.append(last_transaction)
+        :return: TransactionStore slice of transactions from now - x to now, oldest first
+        """
+        cutoff = datetime_to_ns(datetime.datetime.now()) - timedelta_to_ns(x)
+        with self._lock:
+            lo, hi = self._store.window(cutoff)
+            return self._store[lo:hi]
+
+    def aggregate_bars(self, resolutions=BAR_RESOLUTIONS):
+        """
+        Starts aggregating OHLCV bars at each resolution as trades are added, backfilled from the stored trades. The
+        bars outlive trades evicted by the retention policy.
+        :param resolutions: datetime.timedelta bar lengths, by default 1 second, 1 minute and 1 hour
+        :return:
+        """
+        import numpy as np
+        with self._lock:
+            for resolution in resolutions:
+                resolution_ns = timedelta_to_ns(resolution)
+                if resolution_ns in self._bars:
+                    continue
+                bars = Bars(resolution_ns)
+                store = self._store
+                bars.extend(*(np.frombuffer(column, dtype=_DTYPES[column.typecode])
+                              for column in (store.timestamps, store.prices, store.volumes)))
+                self._bars[resolution_ns] = bars
+
+    def bars(self, resolution, start=None, end=None):
+        """
+        Aggregated bars starting from start up to, not including, end
+        :param resolution: datetime.timedelta bar length, one passed to aggregate_bars
+        :param start: datetime object, None for the first bar
+        :param end: datetime object, None for after the last bar
+        :return: list of Bar
+        """
+        with self._lock:
+            bars = self._aggregated(resolution)
+            start_ns = -2 ** 63 if start is None else datetime_to_ns(start)
+            end_ns = 2 ** 63 - 1 if end is None else datetime_to_ns(end)
+            return bars.range(start_ns, end_ns)
+
+    def historical_price(self, start, end, resolution=None):
+        """
+        Volume weighted price over a past interval read from the aggregated bars, without touching trades
+        :param start: datetime object
+        :param end: datetime object
+        :param resolution: datetime.timedelta bar length to read, by default the coarsest one start and end fall on the
+            boundaries of, otherwise the finest aggregated
+        :return: price of the bars starting from start up to, not including, end; None if there were no trades
+        """
+        start_ns = datetime_to_ns(start)
+        end_ns = datetime_to_ns(end)
+        with self._lock:
+            if resolution is not None:
+                bars = self._aggregated(resolution)
             else:
-                loop_stop = True
-        return latest_trans_list
+                if not self._bars:
+                    raise ValueError("%s does not aggregate bars" % self._ticker)
+                aligned = [r for r in self._bars if start_ns % r == 0 and end_ns % r == 0]
+                bars = self._bars[max(aligned) if aligned else min(self._bars)]
+            return bars.vwap(start_ns, end_ns)
 
-    def price(self):
-        total_volume = 0
-        numerator = 0
-        latest_transactions = self.get_transactions_for_last_x_min()
-        try:
-            for transaction in latest_transactions:
-                numerator += transaction.price*transaction.volume
-                total_volume += transaction.volume
-            return numerator/total_volume
-        except ZeroDivisionError:
-            print("Error in calculation - no transactions in interval")
+    def _aggregated(self, resolution):
+        bars = self._bars.get(timedelta_to_ns(resolution))
+        if bars is None:
+            raise ValueError("%s does not aggregate %s bars" % (self._ticker, resolution))
+        return bars
+
+    def track_window(self, window):
+        """
+        Starts maintaining a rolling price over another window, e.g. 1 or 5 minutes alongside the default 15
+        :param window: datetime.timedelta object
+        :return:
+        """
+        with self._lock:
+            self._vwap.add_window(timedelta_to_ns(window))
+
+    def price(self, window=None, as_of=None):
+        """
+        Volume weighted price of the trades in the trailing window. The price window and windows added by
+        track_window are kept as rolling sums; any other window is summed from the stored trades on each call.
+        :param window: datetime.timedelta object, defaults to the stock's price window
+        :param as_of: datetime object to price at instead of now, over the trades in (as_of - window, as_of]
+        :return: price
+        """
+        window_ns = self._price_window if window is None else timedelta_to_ns(window)
+        if as_of is not None:
+            price = self._price_as_of(window_ns, datetime_to_ns(as_of))
+        elif window_ns in self._vwap._windows:
+            price = self._price(window_ns)
+        elif window_ns <= 0:
+            raise ValueError("window must be positive")
+        else:
+            price = self._price_as_of(window_ns, datetime_to_ns(datetime.datetime.now()))
+        if price is None:
+            raise LookupError("No transactions for %s in the %s before %s" %
+                              (self._ticker, ns_to_timedelta(window_ns), as_of or 'now'))
+        return price
+
+    def _price(self, window_ns=None, now_ns=None):
+        """
+        Rolling price, cached until the next write or until the oldest trade in the window ages out
+        :return: price, None if there were no transactions in the window
+        """
+        if window_ns is None:
+            window_ns = self._price_window
+        if now_ns is None:
+            now_ns = datetime_to_ns(datetime.datetime.now())
+        entry = self._price_cache.get(window_ns)
+        if entry is not None and entry[0] == self._store._version and entry[1] <= now_ns < entry[2]:
+            self._hits += 1
+            price = entry[3]
+        else:
+            with self._lock:
+                self._misses += 1
+                version = self._store._version
+                price = self._vwap.vwap(window_ns, now_ns)
+                expiry = self._vwap.expiry(window_ns)
+                if price is None:
+                    price = NO_TRADES
+                self._price_cache[window_ns] = (version, now_ns, _NS_MAX if expiry is None else expiry, price)
+        return None if price is NO_TRADES else price
+
+    def cache_stats(self):
+        """
+        Price cache counters
+        :return: dict of hits, misses and the stock's write version
+        """
+        return {'hits': self._hits, 'misses': self._misses, 'version': self._store._version}
+
+    def _price_as_of(self, window_ns, as_of_ns):
+        """
+        Volume weighted price over (as_of_ns - window_ns, as_of_ns], read from the stored trades without moving the
+        rolling sums
+        """
+        with self._lock:
+            lo, hi = self._store.window(as_of_ns - window_ns, as_of_ns)
+            prices = self._store.prices[lo:hi]
+            volumes = self._store.volumes[lo:hi]
+        total_volume = math.fsum(volumes)
+        if total_volume == 0:
+            return None
+        return math.fsum(map(operator.mul, prices, volumes)) / total_volume
+
+    def _price_expiry(self):
+        return self._vwap.expiry(self._price_window)
 
     # TODO: Useful methods to implement
     def remove_stock(self):
@@ -256,60 +1379,698 @@ class Stock:
     def ammend_stock(self, property, value):
         pass
 
-    def get_transactions_by_date(self,date):
-        pass
+    def query(self):
+        """
+        Starting point for composing transaction filters, e.g. GOOG.query().on(today).signal('buy')
+        :return: Query over every stored transaction
+        """
+        return Query(self._store, self._lock)
+
+    def get_transactions_by_date(self, date):
+        """
+        :param date: datetime.date object
+        :return: Query of the transactions on that day
+        """
+        return self.query().on(date)
 
     def get_transactions_by_price_range(self, low, high):
-        pass
+        """
+        :param low: lowest price, inclusive
+        :param high: highest price, inclusive
+        :return: Query of the transactions priced in the range
+        """
+        return self.query().price_range(low, high)
 
     def get_transactions_by_volume_range(self, low, high):
-        pass
+        """
+        :param low: lowest volume, inclusive
+        :param high: highest volume, inclusive
+        :return: Query of the transactions with a volume in the range
+        """
+        return self.query().volume_range(low, high)
 
     def get_transactions_by_signal(self, signal):
-        pass
+        """
+        :param signal: 'buy' or 'sell'
+        :return: Query of the buys or the sells
+        """
+        return self.query().signal(signal)
+
+
+class TransactionStore:
+    """
+    Columnar, array backed store of transactions
+    """
+    __slots__ = ('_timestamps', '_prices', '_volumes', '_sides', '_parties', '_version', '_moved', '_indexes')
+
+    def __init__(self):
+        self._timestamps = array('q')
+        self._prices = array('d')
+        self._volumes = array('d')
+        self._sides = array('b')
+        # party codes, only allocated once an attributed trade arrives
+        self._parties = None
+        # bumped on every write; _moved is the version of the last write that moved stored rows (a late print, a
+        # merge or a drop), before which secondary indexes can only be rebuilt, after it only appended rows are new
+        self._version = 0
+        self._moved = 0
+        self._indexes = {}
+
+    timestamps = property(operator.attrgetter('_timestamps'))
+    prices = property(operator.attrgetter('_prices'))
+    volumes = property(operator.attrgetter('_volumes'))
+    sides = property(operator.attrgetter('_sides'))
+    parties = property(operator.attrgetter('_parties'))
 
+    def __len__(self):
+        return len(self._timestamps)
 
-class Transaction:
+    def __iter__(self):
+        for i in range(len(self._timestamps)):
+            yield self.row(i)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            view = TransactionStore()
+            view._timestamps = self._timestamps[item]
+            view._prices = self._prices[item]
+            view._volumes = self._volumes[item]
+            view._sides = self._sides[item]
+            view._parties = None if self._parties is None else self._parties[item]
+            return view
+        return self.row(item)
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the column buffers
+        :return: size in bytes
+        """
+        return sum(column.itemsize * len(column) for column in self._columns())
+
+    def _columns(self):
+        columns = (self._timestamps, self._prices, self._volumes, self._sides)
+        return columns if self._parties is None else columns + (self._parties,)
+
+    def _attribute(self):
+        # the first attributed trade backfills the older rows as unattributed
+        self._parties = array('i', [0]) * len(self._timestamps)
+
+    def append(self, signal, price, volume, timestamp_ns, party=0):
+        """
+        Adds a transaction keeping the store in timestamp order. In order trades are a plain append, late prints are
+        inserted after any trades with the same timestamp.
+        :param signal: 'buy' or 'sell'
+        :param price: positive real number
+        :param volume: positive real number
+        :param timestamp_ns: int nanoseconds since the epoch
+        :param party: attribution code from party_code, 0 for none
+        :return: row index the transaction was stored at
+        """
+        side = _validate_trade(signal, price, volume)
+        self._version += 1
+        if party and self._parties is None:
+            self._attribute()
+        parties = self._parties
+        timestamps = self._timestamps
+        position = len(timestamps)
+        if position and timestamp_ns < timestamps[-1]:
+            position = bisect_right(timestamps, timestamp_ns)
+            self._moved = self._version
+            timestamps.insert(position, timestamp_ns)
+            self._prices.insert(position, price)
+            self._volumes.insert(position, volume)
+            self._sides.insert(position, side)
+            if parties is not None:
+                parties.insert(position, party)
+        else:
+            timestamps.append(timestamp_ns)
+            self._prices.append(price)
+            self._volumes.append(volume)
+            self._sides.append(side)
+            if parties is not None:
+                parties.append(party)
+        return position
+
+    def window(self, start_ns, end_ns=None):
+        """
+        Finds the rows with start_ns < timestamp <= end_ns by binary search
+        :param start_ns: exclusive lower bound in epoch-ns
+        :param end_ns: inclusive upper bound in epoch-ns, None for no upper bound
+        :return: (first row, row after last)
+        """
+        timestamps = self._timestamps
+        lo = bisect_right(timestamps, start_ns)
+        hi = len(timestamps) if end_ns is None else bisect_right(timestamps, end_ns, lo)
+        return lo, hi
+
+    def drop(self, n):
+        """
+        Removes the n oldest rows
+        :param n: number of rows
+        :return:
+        """
+        self._version += 1
+        self._moved = self._version
+        for column in self._columns():
+            del column[:n]
+
+    def extend(self, timestamps, prices, volumes, sides, parties=None):
+        """
+        Adds a timestamp sorted batch of NumPy columns. A batch that starts at or after the last stored trade is a
+        straight buffer extend; otherwise only the stored rows it overlaps are merged with it.
+        :param timestamps: int64 epoch-ns array, sorted
+        :param prices: float64 array
+        :param volumes: float64 array
+        :param sides: int8 array of 1 (buy) / 0 (sell) flags
+        :param parties: int32 array of party codes, None for unattributed trades
+        :return:
+        """
+        import numpy as np
+        self._version += 1
+        columns = ((self._timestamps, timestamps, 'i8'), (self._prices, prices, 'f8'),
+                   (self._volumes, volumes, 'f8'), (self._sides, sides, 'i1'))
+        if parties is not None and self._parties is None:
+            self._attribute()
+        if self._parties is not None:
+            columns += ((self._parties, np.zeros(len(timestamps), 'i4') if parties is None else parties, 'i4'),)
+        position = len(self._timestamps)
+        if position and timestamps[0] < self._timestamps[-1]:
+            position = bisect_right(self._timestamps, int(timestamps[0]))
+            self._moved = self._version
+            tail = np.frombuffer(self._timestamps[position:], dtype='i8')
+            order = np.concatenate((tail, timestamps)).argsort(kind='stable')
+            columns = [(column, np.concatenate((np.frombuffer(column[position:], dtype=dtype), batch))[order], dtype)
+                       for column, batch, dtype in columns]
+            for column, batch, dtype in columns:
+                del column[position:]
+        for column, batch, dtype in columns:
+            column.frombytes(np.ascontiguousarray(batch, dtype=dtype).tobytes())
+
+    def row(self, i):
+        """
+        Builds a Transaction for the i-th stored trade
+        :param i: row index, negative values count from the end
+        :return: Transaction
+        """
+        # the stored fields were validated on the way in, so skip Transaction's checks
+        return tuple.__new__(Transaction, (_SIGNALS[self._sides[i]], self._prices[i], self._volumes[i],
+                                           self._timestamps[i]) +
+                             _PARTIES[0 if self._parties is None else self._parties[i]])
+
+    def sorted_index(self, name):
+        """
+        Secondary index on the prices or volumes column, built on first use. Rows appended since it was last used are
+        sorted on their own and merged in; it is only sorted again from scratch after a write that moved stored rows.
+        :param name: 'prices' or 'volumes'
+        :return: (column values in ascending order, row of each of them) NumPy arrays
+        """
+        import numpy as np
+        index = self._indexes.get(name)
+        if index is not None and index[0] == self._version:
+            return index[2], index[3]
+        values = np.frombuffer(getattr(self, '_' + name), dtype='f8')
+        if index is None or index[0] < self._moved:
+            order = values.argsort(kind='stable')
+            sorted_values = values[order]
+        else:
+            covered = index[1]
+            added = values[covered:].argsort(kind='stable')
+            # after equal values already indexed, so equal prices stay in row order as a stable sort leaves them
+            positions = np.searchsorted(index[2], values[covered:][added], 'right')
+            sorted_values = np.insert(index[2], positions, values[covered:][added])
+            order = np.insert(index[3], positions, added + covered)
+        del values
+        self._indexes[name] = (self._version, len(self._timestamps), sorted_values, order)
+        return sorted_values, order
+
+
+class Query:
     """
-    Object to hold the transaction data
+    Lazy, composable filter over the transactions of a stock
     """
-    def __init__(self, signal, price, volume, timestamp=datetime.datetime.now()):
+    __slots__ = ('_store', '_lock', '_start_ns', '_end_ns', '_price', '_volume', '_side')
 
-        self._signal = signal
+    def __init__(self, store, lock=None, start_ns=None, end_ns=None, price=None, volume=None, side=None):
+        """
+            Args:
+                store: TransactionStore to query
+                lock: lock guarding the store, held while the query is evaluated
+                start_ns: inclusive lower bound on the timestamp in epoch-ns
+                end_ns: exclusive upper bound on the timestamp in epoch-ns
+                price: (low, high) inclusive price range
+                volume: (low, high) inclusive volume range
+                side: 1 (buy) or 0 (sell)
+        """
+        self._store = store
+        self._lock = lock
+        self._start_ns = start_ns
+        self._end_ns = end_ns
         self._price = price
         self._volume = volume
-        self._timestamp = timestamp
+        self._side = side
+
+    def _refine(self, **changes):
+        fields = dict(start_ns=self._start_ns, end_ns=self._end_ns, price=self._price, volume=self._volume,
+                      side=self._side)
+        fields.update(changes)
+        return Query(self._store, self._lock, **fields)
+
+    def between(self, start, end):
+        """
+        Narrows to trades from start to end inclusive
+        :param start: datetime object
+        :param end: datetime object
+        :return: Query
+        """
+        start_ns = datetime_to_ns(start)
+        end_ns = datetime_to_ns(end) + 1
+        if self._start_ns is not None:
+            start_ns = max(start_ns, self._start_ns)
+        if self._end_ns is not None:
+            end_ns = min(end_ns, self._end_ns)
+        return self._refine(start_ns=start_ns, end_ns=end_ns)
+
+    def on(self, date):
+        """
+        Narrows to trades on a calendar day
+        :param date: datetime.date object, or a datetime object whose date is used
+        :return: Query
+        """
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+        midnight = datetime.datetime.combine(date, datetime.time())
+        return self.between(midnight, midnight + datetime.timedelta(days=1) - datetime.timedelta(microseconds=1))
+
+    def price_range(self, low, high):
+        """
+        Narrows to trades priced from low to high inclusive
+        :return: Query
+        """
+        if self._price is not None:
+            low, high = max(low, self._price[0]), min(high, self._price[1])
+        return self._refine(price=(low, high))
 
-    signal = property(operator.attrgetter('_signal'))
-    price = property(operator.attrgetter('_price'))
-    volume = property(operator.attrgetter('_volume'))
-    timestamp = property(operator.attrgetter('_timestamp'))
+    def volume_range(self, low, high):
+        """
+        Narrows to trades with a volume from low to high inclusive
+        :return: Query
+        """
+        if self._volume is not None:
+            low, high = max(low, self._volume[0]), min(high, self._volume[1])
+        return self._refine(volume=(low, high))
 
-    @signal.setter
-    def signal(self, s):
-        if s.lower() not in ('buy', 'sell'):
+    def signal(self, signal):
+        """
+        Narrows to buys or sells
+        :param signal: 'buy' or 'sell'
+        :return: Query
+        """
+        try:
+            side = _SIDES[signal.lower()]
+        except (AttributeError, KeyError):
             raise ValueError("Signal must be either 'buy' or 'sell'")
-        self._signal = s.lower()
-
-    @price.setter
-    def price(self, p):
-        if not isinstance(p, (int, float)):
-            raise TypeError("Price must be a number")
-        if p < 0:
-            raise ValueError("Price must be positive")
-        self._price = p
-
-    @volume.setter
-    def volume(self,v):
-        if not isinstance(v, (int, float)):
-            raise TypeError("Volume must be a number")
-        if v < 0:
-            raise ValueError("Volume must be positive")
-        self._volume = v
+        if self._side is not None and self._side != side:
+            # buys that are also sells, a side no trade has
+            side = -1
+        return self._refine(side=side)
 
-    @timestamp.setter
-    def timestamp(self,ts):
-        if not isinstance(ts, datetime.datetime):
-            raise TypeError("Timestamp must be datetime object")
-        self._timestamp = ts
+    def _rows(self, store):
+        """
+        Matching rows in time order. The time range is two binary searches and each value range is two searches of
+        its sorted index; the smallest of those candidate sets is checked against the remaining filters.
+        """
+        import numpy as np
+        timestamps = store.timestamps
+        lo = 0 if self._start_ns is None else bisect_left(timestamps, self._start_ns)
+        hi = len(timestamps) if self._end_ns is None else max(lo, bisect_left(timestamps, self._end_ns, lo))
+        candidates = None
+        best = hi - lo
+        for name, bounds in (('prices', self._price), ('volumes', self._volume)):
+            if bounds is None:
+                continue
+            values, order = store.sorted_index(name)
+            first, last = np.searchsorted(values, bounds[0], 'left'), np.searchsorted(values, bounds[1], 'right')
+            if last - first < best:
+                best = max(last - first, 0)
+                candidates = np.sort(order[first:last])
+        if candidates is None:
+            rows = np.arange(lo, hi)
+        else:
+            rows = candidates[(candidates >= lo) & (candidates < hi)]
+        for name, bounds in (('prices', self._price), ('volumes', self._volume)):
+            if bounds is not None and len(rows):
+                values = np.frombuffer(getattr(store, name), dtype='f8')[rows]
+                rows = rows[(values >= bounds[0]) & (values <= bounds[1])]
+        if self._side is not None and len(rows):
+            rows = rows[np.frombuffer(store.sides, dtype='i1')[rows] == self._side]
+        return rows
+
+    def columns(self):
+        """
+        Evaluates the query
+        :return: TradeBatch of NumPy timestamp, price, volume, side and party columns of the matching trades, oldest
+            first
+        """
+        import numpy as np
+        store = self._store
+        lock = self._lock or _NO_LOCK
+        with lock:
+            rows = self._rows(store)
+            # fancy indexing copies, so the store buffers are free to grow once the lock is released
+            return TradeBatch(*(np.frombuffer(column, dtype=_DTYPES[column.typecode])[rows]
+                                for column in store._columns()))
+
+    def __len__(self):
+        with self._lock or _NO_LOCK:
+            return len(self._rows(self._store))
+
+    def __iter__(self):
+        batch = self.columns()
+        parties = itertools.repeat(0) if batch.parties is None else batch.parties.tolist()
+        for timestamp_ns, price, volume, side, code in zip(*(column.tolist() for column in batch[:4]), parties):
+            yield tuple.__new__(Transaction, (_SIGNALS[side], price, volume, timestamp_ns) + _PARTIES[code])
+
+    def transactions(self):
+        """
+        :return: list of the matching Transactions, oldest first
+        """
+        return list(self)
+
+
+class RollingVWAP:
+    """
+    Rolling volume weighted price over trailing windows of a TransactionStore
+    """
+    def __init__(self, store, windows=()):
+        """
+            Args:
+                store: TransactionStore the trades are read from
+                windows: window lengths in nanoseconds
+        """
+        self._store = store
+        # window length -> [cutoff, first row in window, sum(price*volume), sum(volume)]
+        self._windows = {}
+        for window_ns in windows:
+            self.add_window(window_ns)
+
+    windows = property(lambda self: sorted(self._windows))
+
+    def add_window(self, window_ns):
+        """
+        Tracks another window length. The sums start out covering the whole store and are trimmed on first read.
+        :param window_ns: window length in nanoseconds
+        :return:
+        """
+        if window_ns <= 0:
+            raise ValueError("window must be positive")
+        if window_ns not in self._windows:
+            store = self._store
+            self._windows[window_ns] = [None, 0,
+                                        sum(p * v for p, v in zip(store.prices, store.volumes)),
+                                        sum(store.volumes)]
+
+    def on_insert(self, price, volume, timestamp_ns):
+        """
+        Folds a newly stored trade into every window. Must be called after every TransactionStore.append.
+        :param price: trade price
+        :param volume: trade volume
+        :param timestamp_ns: trade timestamp in epoch-ns
+        :return:
+        """
+        for state in self._windows.values():
+            cutoff = state[0]
+            if cutoff is None or timestamp_ns > cutoff:
+                state[2] += price * volume
+                state[3] += volume
+            else:
+                # a late print older than the window lands before the first row in it
+                state[1] += 1
+
+    def on_extend(self, timestamps, prices, volumes):
+        """
+        Folds a batch of newly stored trades into every window. Must be called after every TransactionStore.extend.
+        :param timestamps: int64 epoch-ns array
+        :param prices: float64 array
+        :param volumes: float64 array
+        :return:
+        """
+        notional = prices * volumes
+        for state in self._windows.values():
+            cutoff = state[0]
+            if cutoff is None:
+                state[2] += float(notional.sum())
+                state[3] += float(volumes.sum())
+            else:
+                in_window = timestamps > cutoff
+                state[1] += len(timestamps) - int(in_window.sum())
+                state[2] += float(notional[in_window].sum())
+                state[3] += float(volumes[in_window].sum())
+
+    def on_drop(self, n):
+        """
+        Accounts for the n oldest rows being removed from the store. Must be called before TransactionStore.drop.
+        :param n: number of rows
+        :return:
+        """
+        prices = self._store.prices
+        volumes = self._store.volumes
+        for state in self._windows.values():
+            for i in range(state[1], n):
+                state[2] -= prices[i] * volumes[i]
+                state[3] -= volumes[i]
+            state[1] = max(state[1] - n, 0)
+
+    def vwap(self, window_ns, now_ns):
+        """
+        Expires trades that have left the window then returns the price over (now - window, latest trade]
+        :param window_ns: window length in nanoseconds, added on first use if not already tracked
+        :param now_ns: current time in epoch-ns
+        :return: volume weighted price, None if the window holds no volume
+        """
+        state = self._windows.get(window_ns)
+        if state is None:
+            self.add_window(window_ns)
+            state = self._windows[window_ns]
+        cutoff = now_ns - window_ns
+        timestamps = self._store.timestamps
+        prices = self._store.prices
+        volumes = self._store.volumes
+        last_cutoff, start, numerator, total_volume = state
+        n = len(timestamps)
+        if last_cutoff is None or cutoff >= last_cutoff:
+            while start < n and timestamps[start] <= cutoff:
+                numerator -= prices[start] * volumes[start]
+                total_volume -= volumes[start]
+                start += 1
+        else:
+            # the clock went backwards, bring trades back into the window
+            while start > 0 and timestamps[start - 1] > cutoff:
+                start -= 1
+                numerator += prices[start] * volumes[start]
+                total_volume += volumes[start]
+        if start == n:
+            # nothing left in the window, drop any accumulated rounding error
+            numerator = total_volume = 0.0
+        state[:] = [cutoff, start, numerator, total_volume]
+        if total_volume == 0:
+            return None
+        return numerator / total_volume
+
+    def expiry(self, window_ns):
+        """
+        Time at which the oldest trade in the window, as of the last read, ages out
+        :param window_ns: window length in nanoseconds
+        :return: epoch-ns, None if the window is empty or unread
+        """
+        state = self._windows.get(window_ns)
+        if state is None or state[0] is None or state[1] >= len(self._store):
+            return None
+        return self._store.timestamps[state[1]] + window_ns
+
+
+class Bars:
+    """
+    Columnar OHLCV bars at a fixed resolution
+    """
+    def __init__(self, resolution_ns):
+        """
+            Args:
+                resolution_ns: bar length in nanoseconds
+        """
+        if resolution_ns <= 0:
+            raise ValueError("bar resolution must be positive")
+        self._resolution = resolution_ns
+        self._starts = array('q')
+        self._first = array('q')
+        self._last = array('q')
+        self._opens = array('d')
+        self._highs = array('d')
+        self._lows = array('d')
+        self._closes = array('d')
+        self._volumes = array('d')
+        self._notionals = array('d')
+
+    resolution = property(operator.attrgetter('_resolution'))
+    starts = property(operator.attrgetter('_starts'))
+    volumes = property(operator.attrgetter('_volumes'))
+    notionals = property(operator.attrgetter('_notionals'))
+
+    def _columns(self):
+        return (self._starts, self._first, self._last, self._opens, self._highs, self._lows, self._closes,
+                self._volumes, self._notionals)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __getitem__(self, i):
+        volume = self._volumes[i]
+        return Bar(ns_to_datetime(self._starts[i]), self._opens[i], self._highs[i], self._lows[i], self._closes[i],
+                   volume, self._notionals[i] / volume if volume else None)
+
+    def __iter__(self):
+        for i in range(len(self._starts)):
+            yield self[i]
+
+    def add(self, timestamp_ns, price, volume):
+        """
+        Folds a single trade into its bar, creating the bar if needed. Trades may arrive out of order.
+        :param timestamp_ns: trade timestamp in epoch-ns
+        :param price: trade price
+        :param volume: trade volume
+        :return:
+        """
+        start = timestamp_ns - timestamp_ns % self._resolution
+        starts = self._starts
+        if starts and starts[-1] == start:
+            i = len(starts) - 1
+        elif not starts or start > starts[-1]:
+            i = None
+            values = (start, timestamp_ns, timestamp_ns, price, price, price, price, volume, price * volume)
+            for column, value in zip(self._columns(), values):
+                column.append(value)
+        else:
+            i = bisect_right(starts, start) - 1
+            if i < 0 or starts[i] != start:
+                i += 1
+                values = (start, timestamp_ns, timestamp_ns, price, price, price, price, volume, price * volume)
+                for column, value in zip(self._columns(), values):
+                    column.insert(i, value)
+                i = None
+        if i is not None:
+            if price > self._highs[i]:
+                self._highs[i] = price
+            if price < self._lows[i]:
+                self._lows[i] = price
+            self._volumes[i] += volume
+            self._notionals[i] += price * volume
+            if timestamp_ns < self._first[i]:
+                self._first[i] = timestamp_ns
+                self._opens[i] = price
+            if timestamp_ns >= self._last[i]:
+                self._last[i] = timestamp_ns
+                self._closes[i] = price
+
+    def extend(self, timestamps, prices, volumes):
+        """
+        Folds a timestamp sorted batch of NumPy columns into the bars, aggregating whole new bars vectorized
+        :param timestamps: int64 epoch-ns array, sorted
+        :param prices: float64 array
+        :param volumes: float64 array
+        :return:
+        """
+        import numpy as np
+        if not len(timestamps):
+            return
+        buckets = timestamps - timestamps % self._resolution
+        # rows falling in or before the newest existing bar are merged one at a time
+        merged = int(np.searchsorted(buckets, self._starts[-1], side='right')) if self._starts else 0
+        for i in range(merged):
+            self.add(int(timestamps[i]), float(prices[i]), float(volumes[i]))
+        if merged == len(timestamps):
+            return
+        timestamps, prices, volumes, buckets = (timestamps[merged:], prices[merged:], volumes[merged:],
+                                                buckets[merged:])
+        firsts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        lasts = np.concatenate((firsts[1:] - 1, [len(buckets) - 1]))
+        values = (buckets[firsts], timestamps[firsts], timestamps[lasts], prices[firsts],
+                  np.maximum.reduceat(prices, firsts), np.minimum.reduceat(prices, firsts), prices[lasts],
+                  np.add.reduceat(volumes, firsts), np.add.reduceat(prices * volumes, firsts))
+        for column, value in zip(self._columns(), values):
+            column.frombytes(np.ascontiguousarray(value, dtype=_DTYPES[column.typecode]).tobytes())
+
+    def range(self, start_ns, end_ns):
+        """
+        Bars starting in [start_ns, end_ns)
+        :param start_ns: epoch-ns
+        :param end_ns: epoch-ns
+        :return: list of Bar
+        """
+        lo = bisect_right(self._starts, start_ns - 1)
+        hi = bisect_right(self._starts, end_ns - 1, lo)
+        return [self[i] for i in range(lo, hi)]
+
+    def vwap(self, start_ns, end_ns):
+        """
+        Volume weighted price of the bars starting in [start_ns, end_ns)
+        :param start_ns: epoch-ns
+        :param end_ns: epoch-ns
+        :return: price, None if the bars hold no volume
+        """
+        lo = bisect_left(self._starts, start_ns)
+        hi = bisect_left(self._starts, end_ns, lo)
+        volume = math.fsum(self._volumes[lo:hi])
+        if volume == 0:
+            return None
+        return math.fsum(self._notionals[lo:hi]) / volume
+
+    def grid(self, start_ns, n):
+        """
+        Notional and volume of n consecutive bars from start_ns, zero where no bar was traded
+        :param start_ns: epoch-ns, rounded down to a bar boundary
+        :param n: number of bars
+        :return: (notionals, volumes) float64 NumPy arrays of length n
+        """
+        import numpy as np
+        start_ns -= start_ns % self._resolution
+        notionals = np.zeros(n)
+        volumes = np.zeros(n)
+        lo = bisect_left(self._starts, start_ns)
+        hi = bisect_left(self._starts, start_ns + n * self._resolution, lo)
+        if hi > lo:
+            positions = (np.frombuffer(self._starts, dtype='i8')[lo:hi] - start_ns) // self._resolution
+            notionals[positions] = np.frombuffer(self._notionals, dtype='f8')[lo:hi]
+            volumes[positions] = np.frombuffer(self._volumes, dtype='f8')[lo:hi]
+        return notionals, volumes
+
+
+class Transaction(namedtuple('TransactionRecord', 'signal price volume timestamp_ns trader book')):
+    """
+    Immutable record of a single transaction, timestamped in epoch-ns
+    """
+    __slots__ = ()
+
+    def __new__(cls, signal, price, volume, timestamp=None, trader=None, book=None):
+        """
+            Args:
+                signal: 'buy' or 'sell'
+                price: positive real number
+                volume: positive real number
+                timestamp: datetime object or epoch-ns int, defaults to now
+                trader: name of the trader, optional
+                book: name of the book, optional
+        """
+        side = _validate_trade(signal, price, volume)
+        for name, value in (('Trader', trader), ('Book', book)):
+            if value is not None and not isinstance(value, str):
+                raise TypeError("%s must be a string" % name)
+        if timestamp.__class__ is not int:
+            if timestamp is None:
+                timestamp = datetime.datetime.now()
+            if not isinstance(timestamp, datetime.datetime):
+                raise TypeError("Timestamp must be datetime object")
+            timestamp = datetime_to_ns(timestamp)
+        return tuple.__new__(cls, (_SIGNALS[side], price, volume, timestamp, trader, book))
+
+    timestamp = property(lambda self: ns_to_datetime(self[3]))
     # this class could be extended to record changes to transactions for audit purposes
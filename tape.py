@@ -0,0 +1,272 @@
+import csv
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+"""
+Streaming trade tape loaders for the ssm Market. Tapes are read in fixed size chunks so a multi-GB end of day file is
+replayed with bounded memory, and every chunk carries the offset to resume from.
+
+Supported formats:
+    CSV:
+        header row naming the columns ticker, signal, price, volume and timestamp in any order. Timestamps are
+        ISO 8601 strings or integer epoch-ns. Offsets are byte positions.
+    Binary:
+        compact columnar blocks written by write_binary. The file is memory-mapped and every chunk is a set of
+        zero-copy NumPy views onto it. Offsets are row numbers.
+    Parquet:
+        read through pyarrow when it is installed. Offsets are row numbers.
+
+Usage:
+    LSE = Market()
+    rows, offset = replay(LSE, read_csv('trades.csv'))
+    write_binary('trades.tape', read_csv('trades.csv'))
+    rows, offset = replay(LSE, read_binary('trades.tape', offset=offset))
+
+BinaryTapeWriter:
+    Appends chunks to a binary tape, creating it if needed. Its spill method can be given to Stock.set_retention to
+    keep evicted trades on disk.
+
+    Usage:
+        writer = BinaryTapeWriter('spill.tape')
+        LSE.set_retention(datetime.timedelta(minutes=30), spill=writer.spill)
+
+    Implemented Methods:
+        write
+        spill
+        close
+
+Implemented Functions:
+    read_csv
+    read_binary
+    read_parquet
+    write_binary
+    replay
+"""
+
+COLUMNS = ('ticker', 'signal', 'price', 'volume', 'timestamp')
+MAGIC = b'SSMTAPE1'
+# rows, length of the block's ticker dictionary in bytes
+_BLOCK_HEADER = struct.Struct('<QI')
+
+TapeChunk = namedtuple('TapeChunk', 'tickers signals prices volumes timestamps offset')
+
+
+def _pad(n):
+    return -n % 8
+
+
+def _parse_timestamps(values):
+    import numpy as np
+    try:
+        return np.array(values, dtype='i8')
+    except ValueError:
+        pass
+    try:
+        return np.array(values, dtype='datetime64[ns]').view('i8')
+    except ValueError:
+        raise ValueError("timestamps must be ISO 8601 strings or epoch-ns integers")
+
+
+def _csv_chunk(rows, positions, offset):
+    import numpy as np
+    columns = list(zip(*rows))
+    tickers, signals, prices, volumes, timestamps = (columns[i] for i in positions)
+    try:
+        prices = np.array(prices, dtype='f8')
+        volumes = np.array(volumes, dtype='f8')
+    except ValueError:
+        raise ValueError("price and volume must be numbers")
+    return TapeChunk(np.array(tickers, dtype='U'), np.array(signals, dtype='U'), prices, volumes,
+                     _parse_timestamps(timestamps), offset)
+
+
+def read_csv(path, chunk_size=100000, offset=0, encoding='utf-8'):
+    """
+    Streams a CSV trade tape
+    :param path: file path
+    :param chunk_size: rows per chunk
+    :param offset: byte offset to resume from, as returned in a previous chunk; 0 starts after the header
+    :param encoding: text encoding of the file
+    :return: generator of TapeChunk
+    """
+    with open(path, 'rb') as tape:
+        header = next(csv.reader([tape.readline().decode(encoding)]))
+        names = [name.strip().lower() for name in header]
+        try:
+            positions = [names.index(column) for column in COLUMNS]
+        except ValueError:
+            raise ValueError("CSV tape header must name the columns %s" % ', '.join(COLUMNS))
+        if offset:
+            tape.seek(offset)
+        while True:
+            lines = []
+            for line in tape:
+                if line.strip():
+                    lines.append(line.decode(encoding))
+                    if len(lines) == chunk_size:
+                        break
+            if not lines:
+                return
+            yield _csv_chunk(list(csv.reader(lines)), positions, tape.tell())
+
+
+def read_parquet(path, chunk_size=100000, offset=0):
+    """
+    Streams a Parquet trade tape with the same columns as a CSV tape. Needs pyarrow.
+    :param path: file path
+    :param chunk_size: rows per chunk
+    :param offset: row offset to resume from
+    :return: generator of TapeChunk
+    """
+    import pyarrow.parquet as pq
+    tape = pq.ParquetFile(path)
+    row = 0
+    for batch in tape.iter_batches(batch_size=chunk_size, columns=list(COLUMNS)):
+        start = row
+        row += batch.num_rows
+        if row <= offset:
+            continue
+        columns = [batch.column(i).to_numpy(zero_copy_only=False)[max(offset - start, 0):]
+                   for i in range(len(COLUMNS))]
+        tickers, signals, prices, volumes, timestamps = columns
+        if timestamps.dtype.kind == 'M':
+            timestamps = timestamps.astype('datetime64[ns]').view('i8')
+        elif timestamps.dtype.kind not in 'iu':
+            timestamps = _parse_timestamps(timestamps)
+        yield TapeChunk(tickers.astype('U'), signals.astype('U'), prices.astype('f8'), volumes.astype('f8'),
+                        timestamps.astype('i8'), row)
+
+
+class BinaryTapeWriter:
+    """
+    Appends columnar blocks to a binary tape
+    """
+    def __init__(self, path):
+        """
+            Args:
+                path: tape file, appended to if it already exists
+        """
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self.rows = 0
+
+    def write(self, tickers, signals, prices, volumes, timestamps):
+        """
+        Validates a chunk of trade columns and appends it as one block
+        :param tickers: sequence of tickers
+        :param signals: sequence of 'buy'/'sell' strings, or of 1 (buy) / 0 (sell) flags
+        :param prices: sequence of positive real numbers
+        :param volumes: sequence of positive real numbers
+        :param timestamps: sequence of datetime objects, datetime64 values or epoch-ns ints
+        :return:
+        """
+        import numpy as np
+        from ssm import validate_batch
+        timestamps, prices, volumes, sides = validate_batch(signals, prices, volumes, timestamps)
+        symbols, codes = np.unique(np.asarray(tickers, dtype='U'), return_inverse=True)
+        if len(codes) != len(prices):
+            raise ValueError("chunk columns must all be the same length")
+        dictionary = '\n'.join(symbols).encode('utf-8')
+        self._file.write(_BLOCK_HEADER.pack(len(codes), len(dictionary)))
+        self._file.write(dictionary + b'\0' * _pad(_BLOCK_HEADER.size + len(dictionary)))
+        for column in (timestamps, prices, volumes, codes.astype('<u4'), sides):
+            data = np.ascontiguousarray(column).tobytes()
+            self._file.write(data + b'\0' * _pad(len(data)))
+        self.rows += len(codes)
+
+    def spill(self, stock, batch):
+        """
+        Writes trades evicted from a stock, matching the spill callback of Stock.set_retention
+        :param stock: Stock the trades belong to
+        :param batch: ssm.TradeBatch
+        :return:
+        """
+        self.write([stock.ticker] * len(batch.timestamps), batch.sides, batch.prices, batch.volumes,
+                   batch.timestamps)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def write_binary(path, chunks):
+    """
+    Writes chunks to a new binary columnar tape, one block per chunk
+    :param path: file path
+    :param chunks: iterable of TapeChunk, e.g. from read_csv
+    :return: number of rows written
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    writer = BinaryTapeWriter(path)
+    try:
+        for chunk in chunks:
+            writer.write(chunk.tickers, chunk.signals, chunk.prices, chunk.volumes, chunk.timestamps)
+    finally:
+        writer.close()
+    return writer.rows
+
+
+def read_binary(path, chunk_size=None, offset=0):
+    """
+    Memory-maps a binary tape and yields zero-copy views of its columns. Only the ticker column is materialized,
+    from each block's dictionary.
+    :param path: file path
+    :param chunk_size: maximum rows per chunk, defaults to the tape's block size
+    :param offset: row offset to resume from
+    :return: generator of TapeChunk
+    """
+    import numpy as np
+    with open(path, 'rb') as tape:
+        if tape.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a binary trade tape" % path)
+        buffer = mmap.mmap(tape.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        position = len(MAGIC)
+        row = 0
+        while position < len(buffer):
+            n, dictionary_size = _BLOCK_HEADER.unpack_from(buffer, position)
+            position += _BLOCK_HEADER.size
+            symbols = np.array(buffer[position:position + dictionary_size].decode('utf-8').split('\n'), dtype='U')
+            position += dictionary_size + _pad(_BLOCK_HEADER.size + dictionary_size)
+            columns = []
+            for dtype in ('<i8', '<f8', '<f8', '<u4', 'i1'):
+                columns.append(np.frombuffer(buffer, dtype=dtype, count=n, offset=position))
+                position += columns[-1].nbytes + _pad(columns[-1].nbytes)
+            timestamps, prices, volumes, codes, sides = columns
+            start = row
+            row += n
+            if row <= offset:
+                continue
+            step = chunk_size or n
+            for lo in range(max(offset - start, 0), n, step):
+                hi = min(lo + step, n)
+                yield TapeChunk(symbols[codes[lo:hi]], sides[lo:hi], prices[lo:hi], volumes[lo:hi],
+                                timestamps[lo:hi], start + hi)
+            del columns, timestamps, prices, volumes, codes, sides
+    finally:
+        try:
+            buffer.close()
+        except BufferError:
+            # a consumer still holds a view of the last chunk, the map is released with it
+            pass
+
+
+def replay(market, chunks, stock_type='common'):
+    """
+    Feeds tape chunks into a Market through Market.ingest
+    :param market: Market the tickers are listed on
+    :param chunks: iterable of TapeChunk
+    :param stock_type: type of the listings the tickers refer to
+    :return: (rows ingested, offset to resume from)
+    """
+    rows = 0
+    offset = 0
+    for chunk in chunks:
+        rows += market.ingest(chunk.tickers, chunk.signals, chunk.prices, chunk.volumes, chunk.timestamps,
+                              stock_type=stock_type)
+        offset = chunk.offset
+    return rows, offset
@@ -19,4 +19,5 @@ def func(inp_str):
     words.append(word[:len(word)])
     print('_'.join(words))
 
-func("AAAABbbb")
\ No newline at end of file
+if __name__ == '__main__':
+    func("AAAABbbb")
\ No newline at end of file
@@ -0,0 +1,53 @@
+from unittest import TestCase
+import datetime
+from ssm import datetime_to_ns
+from factories import MarketFactory, StockFactory, ticker_for, timestamps_ns
+from benchmarks import run_suite, compare
+
+
+class FactoryTests(TestCase):
+
+    def test_tickers(self):
+        self.assertEqual([ticker_for(i) for i in (0, 25, 26, 27, 701, 702)], ['A', 'Z', 'AA', 'AB', 'ZZ', 'AAA'])
+        stocks = StockFactory(1000).stock_list
+        self.assertEqual(len(set(stock.ticker for stock in stocks)), 1000)
+
+    def test_timestamp_distributions(self):
+        start = datetime.datetime(2016, 6, 1, 9)
+        span = datetime.timedelta(minutes=10)
+        for distribution in ('uniform', 'poisson', 'burst'):
+            timestamps = timestamps_ns(500, start, span, distribution)
+            self.assertEqual(len(timestamps), 500)
+            self.assertTrue((timestamps[1:] >= timestamps[:-1]).all())
+            self.assertGreaterEqual(timestamps[0], datetime_to_ns(start))
+            self.assertLessEqual(timestamps[-1], datetime_to_ns(start + span))
+        self.assertRaises(ValueError, timestamps_ns, 10, start, span, 'gaussian')
+
+    def test_market(self):
+        first, second = MarketFactory(2, no_of_stocks=5, no_of_transactions=100).market_list
+        self.assertEqual(len(first.stocks), 5)
+        self.assertEqual(len(first.get('C').transactions), 100)
+        self.assertIsNotNone(first.all_share_index())
+        again = MarketFactory(1, no_of_stocks=5, no_of_transactions=100).market_list[0]
+        self.assertEqual(list(again.get('C').transactions.prices), list(first.get('C').transactions.prices))
+
+
+class BenchmarkTests(TestCase):
+
+    def test_suite(self):
+        names = ('price', 'price_uncached', 'all_share_index_uncached', 'list_stocks')
+        report = run_suite(tiers=('small',), benchmarks=names, import_runs=0)
+        self.assertEqual([r['benchmark'] for r in report['results']], list(names))
+        for result in report['results']:
+            self.assertGreater(result['ops_per_second'], 0)
+            self.assertLessEqual(result['p50_us'], result['p99_us'])
+        self.assertEqual(report['setup'][0]['trades'], 10000)
+        rows = compare(report, report)
+        self.assertEqual([row[4] for row in rows], [1.0] * 4)
+        self.assertFalse(any(row[5] for row in rows))
+
+    def test_import_budget(self):
+        from benchmarks import measure_import
+        startup = measure_import('ssm', runs=1)
+        self.assertEqual(startup['eager_modules'], [])
+        self.assertLessEqual(startup['own_ms'], startup['median_ms'])
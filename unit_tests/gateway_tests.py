@@ -0,0 +1,75 @@
+from unittest import TestCase
+import asyncio
+import datetime
+from ssm import Market, Stock, datetime_to_ns
+from gateway import Gateway, simulate, subscribe, benchmark
+
+
+class GatewayTests(TestCase):
+
+    def test_trades_reach_market_and_subscribers(self):
+        market = Market(incremental_index=True)
+        market.add_stocks([Stock('GOOG'), Stock('APPL')])
+        now_ns = datetime_to_ns(datetime.datetime.now())
+        updates = []
+
+        async def run():
+            gateway = Gateway(market, batch_interval=0.01)
+            await gateway.start()
+            listener = asyncio.ensure_future(subscribe(gateway.address, lambda u, latency: updates.append(u)))
+            while not gateway._subscribers:
+                await asyncio.sleep(0.001)
+            trades = [('GOOG', 'buy', 10.0, 100, now_ns), ('APPL', 'sell', 40.0, 100, now_ns),
+                      ('TEA', 'buy', 1.0, 1, now_ns), ('GOOG', 'hold', 1.0, 1, now_ns),
+                      ('GOOG', 'buy', float('inf'), 1, now_ns), ('APPL', 'sell', 1.0, float('nan'), now_ns)]
+            self.assertEqual(await simulate(gateway.address, trades), 6)
+            while gateway.ingested + gateway.rejected < 6:
+                await asyncio.sleep(0.001)
+            await asyncio.sleep(0.05)
+            await gateway.stop()
+            listener.cancel()
+            return gateway
+
+        gateway = asyncio.run(run())
+        self.assertEqual((gateway.ingested, gateway.rejected), (2, 4))
+        self.assertEqual(market.get('GOOG').price(), 10)
+        index = [u['value'] for u in updates if u['type'] == 'index']
+        self.assertAlmostEqual(index[-1], 20)
+        self.assertEqual(sorted(u['ticker'] for u in updates if u['type'] == 'vwap'), ['APPL', 'GOOG'])
+
+    def test_failures_reject_only_their_trades(self):
+        market = Market()
+        market.add_stocks([Stock('GOOG'), Stock('APPL')])
+        now_ns = datetime_to_ns(datetime.datetime.now())
+        failures = []
+
+        def listener(stock, kind, payload):
+            if kind == 'trade' and not failures:
+                failures.append(stock.ticker)
+                raise OSError("journal disk full")
+
+        market.add_listener(listener)
+
+        async def run():
+            gateway = Gateway(market, batch_interval=0.01)
+            await gateway.start()
+            # the listener fails the first batch, stop must still find the queue drained
+            await gateway._queue.put(('GOOG', 'buy', 10.0, 100, now_ns, now_ns))
+            await gateway._queue.join()
+            # a trade queued for a stock delisted since only rejects itself
+            for trade in (('GOOG', 'buy', 11.0, 100, now_ns, now_ns), ('TEA', 'buy', 1.0, 1, now_ns, now_ns),
+                          ('APPL', 'sell', 40.0, 100, now_ns, now_ns)):
+                gateway._queue.put_nowait(trade)
+            await asyncio.wait_for(gateway.stop(), 5)
+            return gateway
+
+        with self.assertLogs('gateway', 'ERROR'):
+            gateway = asyncio.run(run())
+        self.assertEqual((gateway.ingested, gateway.rejected), (2, 2))
+        self.assertEqual(market.get('APPL').price(), 40)
+
+    def test_benchmark_reports_latency(self):
+        results = asyncio.run(benchmark(messages=2000, rate=20000, stocks=10))
+        self.assertEqual(results['messages'], 2000)
+        self.assertGreater(results['messages_per_second'], 0)
+        self.assertIsNotNone(results['p99_publish_latency_ms'])
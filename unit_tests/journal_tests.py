@@ -0,0 +1,125 @@
+from unittest import TestCase
+import datetime
+import os
+import shutil
+import tempfile
+from ssm import Market, Stock
+from journal import Journal, write_snapshot, recover
+
+
+class JournalTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.directory, 'market.journal')
+        self.snapshot_path = os.path.join(self.directory, 'market.snapshot')
+        self.market = Market()
+        self.journal = Journal(self.journal_path, sync_every=2)
+        self.journal.attach(self.market)
+        self.time_now = datetime.datetime.now()
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def trades(self, stock):
+        return [(t.signal, t.price, t.volume, t.timestamp) for t in stock.transactions]
+
+    def test_recover_from_journal_only(self):
+        goog = Stock('GOOG', last_dividend=8)
+        self.market.add_stock_to_market(goog)
+        goog.add_transaction('buy', 10, 100, self.time_now)
+        goog.add_transactions(['sell', 'buy'], [11, 12], [50, 60], [self.time_now, self.time_now])
+        goog.last_dividend = 9
+        self.journal.sync()
+        market = recover(journal_path=self.journal_path)
+        self.assertEqual(self.trades(market.get('GOOG')), self.trades(goog))
+        self.assertEqual(market.get('GOOG').last_dividend, 9)
+
+    def test_recover_from_snapshot_and_tail(self):
+        goog = Stock('GOOG', price_window=datetime.timedelta(minutes=5))
+        appl = Stock('APPL', stock_type='preferred', fixed_dividend=0.02, par_value=100)
+        self.market.add_stocks([goog, appl])
+        goog.add_transaction('buy', 10, 100, self.time_now)
+        write_snapshot(self.market, self.snapshot_path, self.journal)
+        appl.add_transaction('sell', 20, 100, self.time_now)
+        self.market.remove_stock_from_market(goog)
+        self.journal.sync()
+        market = recover(self.snapshot_path, self.journal_path)
+        self.assertEqual([stock.ticker for stock in market.list_stocks()], ['APPL'])
+        self.assertEqual(self.trades(market.get('APPL', 'preferred')), self.trades(appl))
+        self.assertEqual(market.get('APPL', 'preferred').par_value, 100)
+
+    def test_snapshot_restores_buffers(self):
+        goog = Stock('GOOG', price_window=datetime.timedelta(minutes=5))
+        self.market.add_stock_to_market(goog)
+        goog.add_transactions(['buy'] * 3, [1, 2, 3], [10, 20, 30], [self.time_now] * 3)
+        write_snapshot(self.market, self.snapshot_path)
+        market = recover(self.snapshot_path)
+        self.assertEqual(self.trades(market.get('GOOG')), self.trades(goog))
+        self.assertEqual(market.get('GOOG').price_window, datetime.timedelta(minutes=5))
+        self.assertEqual(market.get('GOOG').price(), goog.price())
+
+    def test_torn_tail_ignored(self):
+        goog = Stock('GOOG')
+        self.market.add_stock_to_market(goog)
+        goog.add_transaction('buy', 10, 100, self.time_now)
+        self.journal.sync()
+        with open(self.journal_path, 'ab') as journal:
+            journal.write(b'\x40\0\0\0garbage')
+        market = recover(journal_path=self.journal_path)
+        self.assertEqual(len(market.get('GOOG').transactions), 1)
+
+    def test_trade_in_snapshot_and_tail_replayed_once(self):
+        # the snapshot is taken after the trade is stored but before the journal writes its record
+        market = Market()
+        journal = Journal(os.path.join(self.directory, 'race.journal'))
+        snapshotted = []
+
+        def snapshot(stock, kind, payload):
+            if kind == 'trade' and not snapshotted:
+                write_snapshot(market, self.snapshot_path, journal)
+                snapshotted.append(True)
+
+        market.add_listener(snapshot)
+        journal.attach(market)
+        goog = Stock('GOOG')
+        market.add_stock_to_market(goog)
+        goog.add_transactions(['buy', 'sell'], [10, 11], [100, 50], [self.time_now] * 2)
+        goog.add_transaction('buy', 12, 10, self.time_now)
+        journal.close()
+        recovered = recover(self.snapshot_path, journal.path)
+        self.assertEqual(self.trades(recovered.get('GOOG')), self.trades(goog))
+
+    def test_parties_recovered(self):
+        goog = Stock('GOOG')
+        appl = Stock('APPL')
+        self.market.add_stocks([goog, appl])
+        goog.add_transaction('buy', 10, 100, self.time_now, trader='John', book='Sep-16')
+        appl.add_transaction('buy', 20, 100, self.time_now)
+        write_snapshot(self.market, self.snapshot_path, self.journal)
+        goog.add_transactions(['sell', 'buy'], [11, 12], [50, 60], [self.time_now] * 2, traders=['Paul', None])
+        self.journal.sync()
+        market = recover(self.snapshot_path, self.journal_path)
+        self.assertEqual([(t.trader, t.book) for t in market.get('GOOG').transactions],
+                         [('John', 'Sep-16'), ('Paul', None), (None, None)])
+        self.assertEqual(market.get('APPL').transactions[0].trader, None)
+        self.assertEqual(self.trades(market.get('GOOG')), self.trades(goog))
+
+    def test_sequence_continues_after_recovery(self):
+        # retention leaves fewer rows in the snapshot than the stock has recorded
+        goog = Stock('GOOG')
+        self.market.add_stock_to_market(goog)
+        self.market.set_retention(datetime.timedelta(minutes=20), bar=None)
+        goog.add_transactions(['buy'] * 10, [1] * 10, [1] * 10, [self.time_now - datetime.timedelta(hours=1)] * 10)
+        goog.add_transactions(['buy'] * 10, [2] * 10, [1] * 10, [self.time_now] * 10)
+        write_snapshot(self.market, self.snapshot_path, self.journal)
+        self.journal.close()
+        market = recover(self.snapshot_path, self.journal_path)
+        self.assertEqual(len(market.get('GOOG').transactions), 10)
+        # the recovered market keeps journaling into the same file
+        self.journal = Journal(self.journal_path)
+        self.journal.attach(market)
+        market.get('GOOG').add_transactions(['sell'] * 5, [3] * 5, [1] * 5, [self.time_now] * 5)
+        self.journal.sync()
+        self.assertEqual(len(recover(self.snapshot_path, self.journal_path).get('GOOG').transactions), 15)
@@ -0,0 +1,72 @@
+from unittest import TestCase
+import datetime
+from ssm import Market, Stock
+import metrics
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.market = Market(incremental_index=True)
+        self.time_now = datetime.datetime.now()
+        self.stock = Stock('TEA')
+        self.market.add_stocks([self.stock, Stock('POP')])
+        self.market.ingest(['TEA', 'POP', 'TEA'], ['buy', 'sell', 'buy'], [10, 20, 30], [1, 2, 3],
+                           [self.time_now - datetime.timedelta(minutes=20), self.time_now, self.time_now])
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.reset()
+
+    def test_disabled_by_default(self):
+        self.assertFalse(metrics.enabled())
+        self.stock.price()
+        self.assertEqual(metrics.snapshot()['stock_price']['calls'], 0)
+        self.assertEqual(Stock.price.__name__, 'price')
+
+    def test_counts_and_scanned(self):
+        metrics.enable()
+        metrics.enable()
+        self.assertTrue(metrics.enabled())
+        self.assertEqual(self.stock.price(), 30)
+        self.stock.price()
+        self.stock.get_transactions_for_last_x_min()
+        self.market.all_share_index()
+        self.market.all_share_index()
+        self.stock.add_transaction('buy', 10, 5, self.time_now)
+        self.market.ingest(['POP', 'POP'], ['buy', 'buy'], [1, 1], [1, 1])
+        self.assertRaises(ValueError, self.stock.add_transaction, 'hold', 10, 5)
+        values = metrics.snapshot()
+        self.assertEqual(values['stock_price']['calls'], 2)
+        # the first read expires the 20 minute old trade, the second has nothing to do
+        self.assertEqual(values['stock_price']['scanned_sum'], 1)
+        self.assertEqual(values['stock_get_transactions_for_last_x_min']['scanned_sum'], 1)
+        self.assertEqual(values['market_all_share_index']['calls'], 2)
+        self.assertEqual(values['market_all_share_index']['scanned_sum'], 2)
+        self.assertEqual(values['stock_add_transaction']['calls'], 2)
+        self.assertEqual(values['stock_add_transaction']['errors'], 1)
+        self.assertEqual(values['market_ingest']['scanned_sum'], 2)
+        self.assertEqual(values['stock_price']['latency_buckets'][-1][1], 2)
+        self.assertIsNotNone(metrics.latency_percentile('stock_price', 0.99))
+        self.assertIsNone(metrics.latency_percentile('stock_add_transactions', 0.5))
+        metrics.disable()
+        self.assertFalse(metrics.enabled())
+        self.stock.price()
+        self.assertEqual(metrics.snapshot()['stock_price']['calls'], 2)
+
+    def test_scanned_for_summed_windows(self):
+        metrics.enable()
+        self.assertEqual(self.stock.price(as_of=self.time_now), 30)
+        self.stock.price(datetime.timedelta(hours=1), self.time_now)
+        self.stock.price(window=datetime.timedelta(hours=1))
+        # the as_of read prices the trade at now, the hour long windows both trades
+        self.assertEqual(metrics.snapshot()['stock_price']['scanned_sum'], 5)
+
+    def test_prometheus(self):
+        metrics.enable()
+        self.stock.price()
+        text = metrics.prometheus()
+        self.assertIn('ssm_stock_price_calls_total 1\n', text)
+        self.assertIn('ssm_stock_price_latency_seconds_bucket{le="+Inf"} 1\n', text)
+        self.assertIn('# TYPE ssm_market_ingest_scanned_transactions histogram\n', text)
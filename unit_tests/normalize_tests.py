@@ -0,0 +1,24 @@
+from unittest import TestCase
+from normalize import normalize, normalize_all, benchmark
+
+
+class NormalizeTests(TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(normalize('AAAABbbb'), 'AAAA_Bbbb')
+        self.assertEqual(normalize('ABcDe'), 'A_Bc_De')
+        self.assertEqual(normalize('TradePrice'), 'Trade_Price')
+        self.assertEqual(normalize('lastVWAPPrice2'), 'lastVWAP_Price2')
+        self.assertEqual(normalize('ÉtéPrix'), 'Été_Prix')
+        self.assertEqual([normalize(name) for name in ('', 'A', 'abc', 'ABC')], ['', 'A', 'abc', 'ABC'])
+        self.assertRaises(TypeError, normalize, None)
+
+    def test_batch_is_memoized(self):
+        normalize.cache_clear()
+        self.assertEqual(normalize_all(iter(['BidPrice', 'AskPrice', 'BidPrice'])),
+                         ['Bid_Price', 'Ask_Price', 'Bid_Price'])
+        self.assertEqual(normalize.cache_info().hits, 1)
+
+    def test_matches_legacy_splitter(self):
+        rates = benchmark(n=2000, distinct=200)
+        self.assertEqual(sorted(rates), ['normalize uncached', 'normalize_all cached', 'test.func'])
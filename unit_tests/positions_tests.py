@@ -0,0 +1,68 @@
+from unittest import TestCase
+import datetime
+from ssm import Market, Stock
+from positions import PositionKeeper
+
+
+class PositionKeeperTests(TestCase):
+
+    def setUp(self):
+        self.market = Market()
+        self.stock = Stock('TEA')
+        self.market.add_stocks([self.stock, Stock('POP')])
+        self.keeper = PositionKeeper()
+        self.keeper.attach(self.market)
+        self.time_now = datetime.datetime.now()
+
+    def test_average_cost_and_pnl(self):
+        self.stock.add_transaction('buy', 100, 10, self.time_now, trader='John', book='Sep-16')
+        self.stock.add_transaction('buy', 110, 10, self.time_now, trader='John', book='Sep-16')
+        self.stock.add_transaction('sell', 120, 15, self.time_now, trader='John', book='Sep-16')
+        position = self.keeper.position('John', 'TEA', 'Sep-16')
+        self.assertEqual((position.quantity, position.average_cost, position.realized, position.trades),
+                         (5, 105, 225, 3))
+        # marked against the 15 minute volume weighted price
+        self.assertAlmostEqual(position.mark, self.stock.price())
+        self.assertAlmostEqual(position.unrealized, 5 * (self.stock.price() - 105))
+        # flipping short realizes the rest of the long and opens the remainder at the trade price
+        self.stock.add_transaction('sell', 100, 10, self.time_now, trader='John', book='Sep-16')
+        position = self.keeper.position('John', 'TEA', 'Sep-16')
+        self.assertEqual((position.quantity, position.average_cost, position.realized), (-5, 100, 200))
+
+    def test_positions_from_batches(self):
+        self.stock.add_transaction('buy', 100, 10, self.time_now)
+        self.market.ingest(['POP', 'POP', 'TEA'], ['buy', 'sell', 'sell'], [10, 12, 100], [5, 5, 10],
+                           traders=['Paul', 'Paul', 'John'])
+        positions = self.keeper.positions()
+        self.assertEqual([(p.trader, p.ticker, p.book, p.quantity) for p in positions],
+                         [('John', 'TEA', None, -10), ('Paul', 'POP', None, 0)])
+        self.assertEqual(positions[1].pnl, 10)
+        self.assertEqual(len(self.keeper.positions(trader='Paul')), 1)
+        self.assertRaises(LookupError, self.keeper.position, 'Paul', 'TEA')
+
+    def test_mark_falls_back_to_last_trade(self):
+        self.stock.add_transaction('buy', 100, 10, self.time_now - datetime.timedelta(minutes=30), trader='John')
+        self.assertEqual(self.keeper.position('John', 'TEA').mark, 100)
+        self.keeper.detach(self.market)
+        self.stock.add_transaction('buy', 100, 10, self.time_now, trader='John')
+        self.assertEqual(self.keeper.position('John', 'TEA').trades, 1)
+
+    def test_zero_volume_trade_on_flat_position(self):
+        events = []
+        self.market.add_listener(lambda stock, kind, payload: events.append(kind))
+        self.stock.add_transaction('buy', 100, 0, self.time_now, trader='John')
+        position = self.keeper.position('John', 'TEA')
+        self.assertEqual((position.quantity, position.average_cost, position.trades), (0, 0, 1))
+        # the listener added after the keeper still sees the trade
+        self.assertEqual(events, ['trade'])
+
+    def test_listings_sharing_a_ticker(self):
+        preferred = Stock('TEA', stock_type='preferred')
+        self.market.add_stock_to_market(preferred)
+        self.stock.add_transaction('buy', 10, 100, self.time_now, trader='John')
+        preferred.add_transaction('buy', 1000, 100, self.time_now, trader='John')
+        common = self.keeper.position('John', 'TEA')
+        self.assertEqual((common.stock_type, common.quantity, common.average_cost, common.mark),
+                         ('common', 100, 10, 10))
+        self.assertEqual(self.keeper.position('John', 'TEA', stock_type='preferred').mark, 1000)
+        self.assertEqual([p.stock_type for p in self.keeper.positions(ticker='TEA')], ['common', 'preferred'])
@@ -0,0 +1,102 @@
+from unittest import TestCase
+import math
+import sys
+import time
+from ssm import Market, Stock
+from pubsub import MetricBus, Update
+
+
+class MetricBusTests(TestCase):
+
+    def setUp(self):
+        self.market = Market(incremental_index=True)
+        self.tea = Stock('TEA', last_dividend=2)
+        self.pop = Stock('POP')
+        self.market.add_stocks([self.tea, self.pop])
+        self.bus = MetricBus(self.market)
+
+    def tearDown(self):
+        self.bus.close()
+
+    def test_only_touched_stock_is_pushed(self):
+        updates = []
+        self.bus.subscribe(updates.extend, metrics=('price', 'pe_ratio'), tickers=['TEA'])
+        self.pop.add_transaction('buy', 50, 10)
+        self.assertEqual(updates, [])
+        self.tea.add_transaction('buy', 100, 10)
+        self.assertEqual(updates, [Update('TEA', 'price', 100.0, 'common'), Update('TEA', 'pe_ratio', 50.0, 'common')])
+        # a dividend change moves the P/E ratio but not the price
+        self.tea.last_dividend = 4
+        self.assertEqual(updates[-1], Update('TEA', 'pe_ratio', 25.0, 'common'))
+        self.pop.add_transaction('buy', 50, 10)
+        self.assertEqual(len(updates), 3)
+
+    def test_index_and_unchanged_values(self):
+        updates = []
+        self.bus.subscribe(updates.extend, metrics=('index', 'dividend_yield'))
+        self.tea.add_transaction('buy', 100, 10)
+        self.assertEqual(updates, [Update('TEA', 'dividend_yield', 0.02, 'common'), Update(None, 'index', None)])
+        self.pop.add_transaction('buy', 25, 10)
+        self.assertEqual(updates[2], Update('POP', 'dividend_yield', 0.0, 'common'))
+        self.assertAlmostEqual(updates[3].value, 50.0)
+        # the same price again changes nothing, so nothing is pushed
+        self.pop.add_transaction('buy', 25, 10)
+        self.assertEqual(len(updates), 4)
+
+    def test_rate_limit_coalesces(self):
+        calls = []
+        subscription = self.bus.subscribe(calls.append, min_interval=60)
+        for price in (100, 101, 102):
+            self.tea.add_transaction('buy', price, 10)
+        self.pop.add_transaction('buy', 50, 10)
+        self.assertEqual(calls, [[Update('TEA', 'price', 100.0, 'common')]])
+        self.bus.flush()
+        self.assertEqual(calls[1], [Update('TEA', 'price', 101.0, 'common'), Update('POP', 'price', 50.0, 'common')])
+        subscription.cancel()
+        self.tea.add_transaction('buy', 200, 10)
+        self.bus.flush()
+        self.assertEqual(len(calls), 2)
+        self.assertRaises(ValueError, subscription.cancel)
+        self.assertRaises(ValueError, self.bus.subscribe, calls.append, metrics=('volume',))
+
+    def test_held_back_updates_are_dispatched(self):
+        calls = []
+        self.bus.subscribe(calls.append, metrics=('price', 'pe_ratio'), tickers=['POP'], min_interval=0.02)
+        self.pop.add_transaction('buy', 50, 10)
+        self.pop.add_transaction('buy', 60, 10)
+        deadline = time.monotonic() + 2
+        while len(calls) < 2 and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertEqual(calls, [[Update('POP', 'price', 50.0, 'common'),
+                                  Update('POP', 'pe_ratio', math.inf, 'common')],
+                                 [Update('POP', 'price', 55.0, 'common')]])
+
+    def test_failing_subscriber_is_reported(self):
+        def fail(updates):
+            raise RuntimeError("screen closed")
+
+        reported = []
+        events = []
+        updates = []
+        self.bus.subscribe(fail)
+        self.bus.subscribe(updates.extend)
+        # a listener added after the bus still sees the trade
+        self.market.add_listener(lambda stock, kind, payload: events.append(kind))
+        original = sys.excepthook
+        sys.excepthook = lambda *info: reported.append(info[0])
+        try:
+            self.tea.add_transaction('buy', 100, 10)
+        finally:
+            sys.excepthook = original
+        self.assertEqual(reported, [RuntimeError])
+        self.assertEqual(events, ['trade'])
+        self.assertEqual(updates, [Update('TEA', 'price', 100.0, 'common')])
+
+    def test_listings_sharing_a_ticker(self):
+        updates = []
+        preferred = Stock('TEA', stock_type='preferred')
+        self.market.add_stock_to_market(preferred)
+        self.bus.subscribe(updates.extend, tickers=['TEA'])
+        self.tea.add_transaction('buy', 100, 10)
+        preferred.add_transaction('buy', 80, 10)
+        self.assertEqual(updates, [Update('TEA', 'price', 100.0, 'common'), Update('TEA', 'price', 80.0, 'preferred')])
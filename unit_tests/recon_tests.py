@@ -0,0 +1,61 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import recon
+from recon import aggregate_trades, load_risk, reconcile
+
+
+class ReconTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.trades = os.path.join(self.directory, 'trades.csv')
+        self.risk = os.path.join(self.directory, 'risk.csv')
+        with open(self.trades, 'w') as trades:
+            trades.write('ID,Quantity,Price,B/S,Instrument,Expiry,Trader\n'
+                         'TR1,100,10.0,B,X,Sep-16,John\n'
+                         'TR2,40,11.0,S,X,Sep-16,Paul\n'
+                         'TR3,10,5.0,B,Y,Dec-16,John\n'
+                         'TR4,20,2.5,S,Z,Mar-17,David\n')
+        with open(self.risk, 'w') as risk:
+            risk.write('Instrument,Expiry,Risk\n'
+                       'X,Sep-16,560.0\n'
+                       'Y,Dec-16,49.0\n'
+                       'W,Jun-16,10.0\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_aggregate_trades(self):
+        positions = aggregate_trades(self.trades, workers=1)
+        self.assertEqual(positions[('X', 'Sep-16')], (60.0, 560.0, 2))
+        self.assertEqual(positions[('Z', 'Mar-17')], (-20.0, -50.0, 1))
+        # tiny blocks and several workers split the file and must still give the same totals
+        original = recon._PARALLEL_MIN_BYTES
+        recon._PARALLEL_MIN_BYTES = 0
+        try:
+            self.assertEqual(aggregate_trades(self.trades, chunk_bytes=10, workers=3), positions)
+        finally:
+            recon._PARALLEL_MIN_BYTES = original
+
+    def test_reconcile(self):
+        breaks = reconcile(self.trades, self.risk)
+        self.assertEqual([(b.instrument, b.expiry, b.status) for b in breaks],
+                         [('W', 'Jun-16', 'missing trades'), ('Y', 'Dec-16', 'mismatch'),
+                          ('Z', 'Mar-17', 'missing risk')])
+        self.assertAlmostEqual(breaks[1].difference, 1.0)
+        self.assertEqual(len(reconcile(self.trades, self.risk, tolerance=1.5)), 2)
+        self.assertEqual(load_risk(self.risk)[('X', 'Sep-16')], 560.0)
+
+    def test_vba_data(self):
+        root = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'VBA')
+        breaks = reconcile(os.path.join(root, 'internal.csv'), os.path.join(root, 'external.csv'))
+        self.assertEqual([(b.instrument, b.expiry, b.status) for b in breaks], [('X', 'Sep-16', 'mismatch')])
+        self.assertAlmostEqual(breaks[0].difference, -7.1)
+
+    def test_bad_input(self):
+        with open(self.trades, 'a') as trades:
+            trades.write('TR5,1,1.0,H,X,Sep-16,John\n')
+        self.assertRaises(ValueError, aggregate_trades, self.trades, workers=1)
+        self.assertRaises(ValueError, aggregate_trades, self.risk, workers=1)
@@ -0,0 +1,40 @@
+from unittest import TestCase
+import datetime
+from ssm import Market, Stock
+from sharded import ShardedMarket
+
+
+class ShardedMarketTests(TestCase):
+
+    def setUp(self):
+        self.market = Market(incremental_index=True)
+        self.time_now = datetime.datetime.now()
+        stocks = [Stock('S%d' % i) for i in range(50)]
+        self.market.add_stocks(stocks)
+        for i, stock in enumerate(stocks):
+            stock.add_transactions(['buy'] * 3, [i + 1, i + 2, 1000], [10, 30, 5],
+                                   [self.time_now, self.time_now, self.time_now - datetime.timedelta(hours=1)])
+
+    def test_matches_incremental_index(self):
+        with ShardedMarket(self.market, shards=3) as sharded:
+            self.assertAlmostEqual(sharded.all_share_index(self.time_now), self.market.all_share_index())
+            self.assertEqual(sum(s[1] for s in sharded.shard_sums(self.time_now)), 50)
+            self.market.get('S7').add_transaction('buy', 500, 1000, self.time_now)
+            self.assertAlmostEqual(sharded.all_share_index(self.time_now), self.market.all_share_index())
+
+    def test_unpriced_stock(self):
+        self.market.add_stock_to_market(Stock('TEA'))
+        with ShardedMarket(self.market, shards=2) as sharded:
+            self.assertIsNone(sharded.all_share_index(self.time_now))
+
+    def test_follows_trades_and_listings(self):
+        with ShardedMarket(self.market, shards=4) as sharded:
+            stock = self.market.get('S3')
+            # enough trades to outgrow the first segments
+            stock.add_transactions(['sell'] * 5000, [7] * 5000, [100] * 5000, [self.time_now] * 5000)
+            late = Stock('LATE')
+            late.add_transaction('buy', 250, 10, self.time_now)
+            self.market.add_stock_to_market(late)
+            self.market.remove_stock_from_market(self.market.get('S9'))
+            self.assertAlmostEqual(sharded.all_share_index(self.time_now), self.market.all_share_index())
+            self.assertEqual(sum(s[1] for s in sharded.shard_sums(self.time_now)), 50)
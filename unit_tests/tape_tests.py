@@ -0,0 +1,97 @@
+from unittest import TestCase, skipUnless
+import datetime
+import importlib.util
+import os
+import shutil
+import tempfile
+from ssm import Market, Stock, datetime_to_ns
+from tape import read_csv, read_binary, read_parquet, write_binary, replay
+
+
+class TapeLoaderTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, 'trades.csv')
+        self.time_now = datetime.datetime.now().replace(microsecond=0)
+        with open(self.csv_path, 'w') as tape:
+            tape.write('timestamp,ticker,signal,price,volume\n')
+            for i in range(10):
+                stamp = self.time_now - datetime.timedelta(seconds=i)
+                tape.write('%s,%s,%s,%d,100\n' % (stamp.isoformat(), ('GOOG', 'APPL')[i % 2], ('buy', 'sell')[i % 3 == 0],
+                                                   10 + i))
+        self.market = Market()
+        self.market.add_stocks([Stock('GOOG'), Stock('APPL')])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_csv_chunks(self):
+        chunks = list(read_csv(self.csv_path, chunk_size=4))
+        self.assertEqual([len(chunk.prices) for chunk in chunks], [4, 4, 2])
+        self.assertEqual(chunks[0].timestamps[1], datetime_to_ns(self.time_now - datetime.timedelta(seconds=1)))
+        self.assertEqual(list(chunks[0].tickers), ['GOOG', 'APPL', 'GOOG', 'APPL'])
+
+    def test_csv_resume(self):
+        first = next(read_csv(self.csv_path, chunk_size=3))
+        rest = list(read_csv(self.csv_path, chunk_size=100, offset=first.offset))
+        self.assertEqual(list(rest[0].prices), [13, 14, 15, 16, 17, 18, 19])
+
+    def test_replay_into_market(self):
+        rows, offset = replay(self.market, read_csv(self.csv_path, chunk_size=3))
+        self.assertEqual(rows, 10)
+        self.assertEqual(offset, os.path.getsize(self.csv_path))
+        self.assertEqual([t.price for t in self.market.get('GOOG').transactions], [18, 16, 14, 12, 10])
+        self.assertEqual(self.market.get('APPL').transactions[0].signal, 'sell')
+
+    def test_binary_round_trip(self):
+        binary_path = os.path.join(self.directory, 'trades.tape')
+        self.assertEqual(write_binary(binary_path, read_csv(self.csv_path, chunk_size=4)), 10)
+        chunks = list(read_binary(binary_path, chunk_size=3))
+        self.assertEqual([len(chunk.prices) for chunk in chunks], [3, 1, 3, 1, 2])
+        self.assertEqual([chunk.offset for chunk in chunks], [3, 4, 7, 8, 10])
+        csv_chunk = next(read_csv(self.csv_path, chunk_size=10))
+        self.assertEqual(list(chunks[0].tickers) + list(chunks[1].tickers), list(csv_chunk.tickers[:4]))
+        self.assertEqual(list(chunks[0].timestamps), list(csv_chunk.timestamps[:3]))
+        del chunks, csv_chunk
+
+    def test_binary_resume(self):
+        binary_path = os.path.join(self.directory, 'trades.tape')
+        write_binary(binary_path, read_csv(self.csv_path, chunk_size=4))
+        rows, offset = replay(self.market, read_binary(binary_path, offset=6))
+        self.assertEqual((rows, offset), (4, 10))
+        self.assertEqual([t.price for t in self.market.get('GOOG').transactions], [18, 16])
+
+    def test_not_a_tape(self):
+        self.assertRaises(ValueError, list, read_binary(self.csv_path))
+
+    def test_spill_evicted_trades(self):
+        from tape import BinaryTapeWriter
+        spill_path = os.path.join(self.directory, 'spill.tape')
+        writer = BinaryTapeWriter(spill_path)
+        stock = self.market.get('GOOG')
+        stock.set_retention(datetime.timedelta(minutes=15), spill=writer.spill)
+        stock.add_transaction('buy', 10, 100, self.time_now - datetime.timedelta(hours=1))
+        stock.add_transaction('sell', 20, 100, self.time_now)
+        writer.close()
+        chunks = list(read_binary(spill_path))
+        self.assertEqual([(str(c.tickers[0]), float(c.prices[0]), int(c.signals[0])) for c in chunks],
+                         [('GOOG', 10, 1)])
+        del chunks
+
+    @skipUnless(importlib.util.find_spec('pyarrow'), "pyarrow is not installed")
+    def test_parquet_chunks_and_resume(self):
+        import pyarrow
+        import pyarrow.parquet
+        parquet_path = os.path.join(self.directory, 'trades.parquet')
+        csv_chunk = next(read_csv(self.csv_path, chunk_size=10))
+        pyarrow.parquet.write_table(pyarrow.table({'timestamp': csv_chunk.timestamps, 'ticker': csv_chunk.tickers,
+                                                   'signal': csv_chunk.signals, 'price': csv_chunk.prices,
+                                                   'volume': csv_chunk.volumes}), parquet_path)
+        chunks = list(read_parquet(parquet_path, chunk_size=4))
+        self.assertEqual([chunk.offset for chunk in chunks], [4, 8, 10])
+        self.assertEqual(list(chunks[0].tickers), list(csv_chunk.tickers[:4]))
+        self.assertEqual(list(chunks[1].timestamps), list(csv_chunk.timestamps[4:8]))
+        rows, offset = replay(self.market, read_parquet(parquet_path, chunk_size=4, offset=6))
+        self.assertEqual((rows, offset), (4, 10))
+        self.assertEqual([t.price for t in self.market.get('GOOG').transactions], [18, 16])
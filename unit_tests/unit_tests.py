@@ -1,6 +1,6 @@
 from unittest import TestCase, skip
 import datetime
-from ssm import Market, Stock
+from ssm import Market, Stock, datetime_to_ns, timedelta_to_ns
 
 """
 Requirements
@@ -69,17 +69,17 @@ class AddStockTest(TestCase):
         self.assertRaises(ValueError, self.market1.remove_stock_from_market, stock)
 
     def test_empty_stock_ticker(self):
-        self.assertRaises(Exception, Stock(''))
+        self.assertRaises(Exception, Stock, '')
 
     def test_ticker_length(self):
         self.assertIsInstance(Stock('A'), Stock)
         self.assertIsInstance(Stock('AAAAA'), Stock)
         self.assertIsInstance(Stock('AB123'), Stock)
-        self.assertRaises(TypeError, Stock(123))
-        self.assertRaises(Exception, Stock(' A'))
-        self.assertRaises(Exception, Stock('A '))
-        self.assertRaises(Exception, Stock('!@£$%'))
-        self.assertRaises(Exception, Stock('AAAAAA'))
+        self.assertRaises(TypeError, Stock, 123)
+        self.assertRaises(Exception, Stock, ' A')
+        self.assertRaises(Exception, Stock, 'A ')
+        self.assertRaises(Exception, Stock, '!@£$%')
+        self.assertRaises(Exception, Stock, 'AAAAAA')
 
     def test_good_stock_type(self):
         stock1 = Stock('APPL', 'common')
@@ -88,7 +88,7 @@ class AddStockTest(TestCase):
         self.assertIsInstance(stock2, Stock)
 
     def test_bad_stock_type(self):
-        self.assertRaises(Exception, Stock('APPL', 'other type'))
+        self.assertRaises(Exception, Stock, 'APPL', 'other type')
 
     def test_good_last_dividend(self):
         stock1 = Stock('APPL', last_dividend=0)
@@ -99,8 +99,8 @@ class AddStockTest(TestCase):
         self.assertIsInstance(stock3, Stock)
 
     def test_bad_last_dividend(self):
-        self.assertRaises(Exception, Stock('APPL', last_dividend=-1))
-        self.assertRaises(Exception, Stock('APPL', last_dividend='sadf'))
+        self.assertRaises(Exception, Stock, 'APPL', last_dividend=-1)
+        self.assertRaises(Exception, Stock, 'APPL', last_dividend='sadf')
 
     def test_good_fixed_dividend(self):
         stock1 = Stock('APPL', fixed_dividend=0)
@@ -111,8 +111,8 @@ class AddStockTest(TestCase):
         self.assertIsInstance(stock3, Stock)
 
     def test_bad_fixed_dividend(self):
-        self.assertRaises(Exception, Stock('APPL', fixed_dividend=-1))
-        self.assertRaises(Exception, Stock('APPL', fixed_dividend='sadf'))
+        self.assertRaises(Exception, Stock, 'APPL', fixed_dividend=-1)
+        self.assertRaises(Exception, Stock, 'APPL', fixed_dividend='sadf')
 
     def test_good_par_value(self):
         stock1 = Stock('APPL', par_value=0)
@@ -123,8 +123,8 @@ class AddStockTest(TestCase):
         self.assertIsInstance(stock3, Stock)
 
     def test_bad_par_value(self):
-        self.assertRaises(Exception, Stock('APPL', par_value=-1))
-        self.assertRaises(Exception, Stock('APPL', par_value='sadf'))
+        self.assertRaises(Exception, Stock, 'APPL', par_value=-1)
+        self.assertRaises(Exception, Stock, 'APPL', par_value='sadf')
 
     def test_duplicate_stock_throws_error(self):
         stock1 = Stock('GOOG')
@@ -250,6 +250,15 @@ class AllStockCalculationTests(TestCase):
         asi = (s1_price*s2_price)**(1/no_of_stocks)
         self.assertEqual(market1.all_share_index(), asi)
 
+    def test_GBCE_calculation_large_market(self):
+        # the product of the prices overflows a float, as thousands of ordinary prices do
+        market = Market()
+        stocks = [Stock('S%d' % i) for i in range(20)]
+        market.add_stocks(stocks)
+        for stock in stocks:
+            stock.add_transaction('buy', 1e20, 1)
+        self.assertAlmostEqual(market.all_share_index() / 1e20, 1)
+
 
 class TestTransactions(TestCase):
 
@@ -263,8 +272,638 @@ class TestTransactions(TestCase):
         self.assertEqual(self.stock.transactions[-1].volume, 100)
 
     def test_add_bad_transaction(self):
-        self.assertRaises(ValueError ,self.stock.add_transaction('blah', 12.3, 100))
-        self.assertRaises(ValueError, self.stock.add_transaction('buy', -1, 100))
-        self.assertRaises(TypeError, self.stock.add_transaction('buy', 'asfkjh', 100))
-        self.assertRaises(ValueError, self.stock.add_transaction('buy', 12.3, -1))
-        self.assertRaises(TypeError, self.stock.add_transaction('buy', 12.3, 'dsfjh'))
\ No newline at end of file
+        self.assertRaises(ValueError, self.stock.add_transaction, 'blah', 12.3, 100)
+        self.assertRaises(ValueError, self.stock.add_transaction, 'buy', -1, 100)
+        self.assertRaises(TypeError, self.stock.add_transaction, 'buy', 'asfkjh', 100)
+        self.assertRaises(ValueError, self.stock.add_transaction, 'buy', 12.3, -1)
+        self.assertRaises(TypeError, self.stock.add_transaction, 'buy', 12.3, 'dsfjh')
+
+class TransactionStoreTests(TestCase):
+
+    def setUp(self):
+        self.stock = Stock('GOOG')
+
+    def test_transactions_round_trip(self):
+        time_now = datetime.datetime(2016, 3, 10, 9, 30, 15, 250)
+        self.stock.add_transaction('sell', 99.5, 25, time_now)
+        transaction = self.stock.transactions[0]
+        self.assertEqual(transaction.signal, 'sell')
+        self.assertEqual(transaction.price, 99.5)
+        self.assertEqual(transaction.volume, 25)
+        self.assertEqual(transaction.timestamp, time_now)
+
+    def test_store_is_columnar(self):
+        for i in range(10):
+            self.stock.add_transaction('buy', 10 + i, 100)
+        self.assertEqual(len(self.stock.transactions), 10)
+        self.assertEqual(self.stock.transactions.nbytes, 10 * 25)
+        self.assertEqual([t.price for t in self.stock.transactions[2:4]], [12, 13])
+
+    def test_unknown_signal_rejected(self):
+        self.assertRaises(ValueError, self.stock.add_transaction, 'hold', 10, 100)
+
+    def test_late_prints_kept_in_time_order(self):
+        time_now = datetime.datetime.now()
+        for minutes in (5, 1, 20, 3):
+            self.stock.add_transaction('buy', minutes, 100, time_now - datetime.timedelta(minutes=minutes))
+        self.assertEqual([t.price for t in self.stock.transactions], [20, 5, 3, 1])
+
+    def test_window_ignores_older_history(self):
+        time_now = datetime.datetime.now()
+        self.stock.add_transaction('buy', 1, 100, time_now - datetime.timedelta(minutes=30))
+        self.stock.add_transaction('buy', 2, 100, time_now - datetime.timedelta(minutes=10))
+        self.stock.add_transaction('buy', 3, 100, time_now - datetime.timedelta(minutes=20))
+        latest_transactions = self.stock.get_transactions_for_last_x_min()
+        self.assertEqual([t.price for t in latest_transactions], [2])
+
+
+class RollingPriceTests(TestCase):
+
+    def setUp(self):
+        self.stock = Stock('GOOG')
+        self.time_now = datetime.datetime.now()
+
+    def add(self, price, volume, minutes_ago):
+        self.stock.add_transaction('buy', price, volume, self.time_now - datetime.timedelta(minutes=minutes_ago))
+
+    def test_price_ignores_trades_outside_window(self):
+        self.add(50, 100, 20)
+        self.add(10, 100, 5)
+        self.add(20, 300, 1)
+        self.assertEqual(self.stock.price(), (10*100 + 20*300)/400.)
+
+    def test_late_print_inside_window(self):
+        self.add(10, 100, 1)
+        self.stock.price()
+        self.add(20, 100, 10)
+        self.add(99, 100, 60)
+        self.assertEqual(self.stock.price(), 15)
+
+    def test_multiple_windows(self):
+        self.stock.track_window(datetime.timedelta(minutes=1))
+        self.add(10, 100, 3)
+        self.add(20, 100, 0.5)
+        self.assertEqual(self.stock.price(datetime.timedelta(minutes=1)), 20)
+        self.assertEqual(self.stock.price(datetime.timedelta(minutes=5)), 15)
+        self.assertEqual(self.stock.price(), 15)
+
+    def test_untracked_window_not_tracked(self):
+        self.add(10, 100, 3)
+        self.add(20, 100, 0.5)
+        self.assertEqual(self.stock.price(datetime.timedelta(minutes=1)), 20)
+        self.assertEqual(self.stock.price(datetime.timedelta(minutes=2)), 20)
+        self.assertNotIn(timedelta_to_ns(datetime.timedelta(minutes=1)), self.stock._vwap._windows)
+        self.assertEqual(len(self.stock._price_cache), 0)
+        self.assertRaises(LookupError, self.stock.price, datetime.timedelta(seconds=10))
+        self.assertRaises(ValueError, self.stock.price, datetime.timedelta(0))
+
+    def test_configurable_window(self):
+        stock = Stock('APPL', price_window=datetime.timedelta(minutes=1))
+        stock.add_transaction('buy', 10, 100, self.time_now - datetime.timedelta(minutes=3))
+        stock.add_transaction('buy', 20, 100, self.time_now)
+        self.assertEqual(stock.price(), 20)
+
+    def test_empty_window(self):
+        self.add(10, 100, 30)
+        self.assertRaises(LookupError, self.stock.price)
+
+
+class IncrementalIndexTests(TestCase):
+
+    def setUp(self):
+        self.market = Market(incremental_index=True)
+        self.stocks = [Stock(ticker) for ticker in ('GOOG', 'APPL', 'TEA')]
+        for stock in self.stocks:
+            self.market.add_stock_to_market(stock)
+
+    def test_matches_geometric_mean(self):
+        for price, stock in zip((10, 20, 40), self.stocks):
+            stock.add_transaction('buy', price, 100, datetime.datetime.now())
+        self.assertAlmostEqual(self.market.all_share_index(), (10*20*40)**(1/3.))
+        self.stocks[0].add_transaction('buy', 30, 300, datetime.datetime.now())
+        self.assertAlmostEqual(self.market.all_share_index(), (25*20*40)**(1/3.))
+
+    def test_no_overflow_with_many_stocks(self):
+        market = Market(incremental_index=True)
+        for i in range(2000):
+            stock = Stock('S%d' % i)
+            market.add_stock_to_market(stock)
+            stock.add_transaction('buy', 1e6, 1, datetime.datetime.now())
+        self.assertAlmostEqual(market.all_share_index(), 1e6, places=4)
+
+    def test_unpriced_stock(self):
+        self.stocks[0].add_transaction('buy', 10, 100, datetime.datetime.now())
+        self.assertIsNone(self.market.all_share_index())
+
+    def test_removed_stock_leaves_index(self):
+        for price, stock in zip((10, 20, 40), self.stocks):
+            stock.add_transaction('buy', price, 100, datetime.datetime.now())
+        self.market.all_share_index()
+        self.market.remove_stock_from_market(self.stocks[2])
+        self.assertAlmostEqual(self.market.all_share_index(), (10*20)**0.5)
+
+    def test_expired_window_reprices(self):
+        time_now = datetime.datetime.now()
+        for stock in self.stocks:
+            stock.add_transaction('buy', 10, 100, time_now - datetime.timedelta(minutes=14.99))
+        self.stocks[0].add_transaction('buy', 40, 100, time_now)
+        self.assertAlmostEqual(self.market._refresh_index(), (25*10*10)**(1/3.))
+        later = datetime_to_ns(time_now + datetime.timedelta(minutes=1))
+        self.assertIsNone(self.market._refresh_index(later))
+        self.stocks[1].add_transaction('buy', 10, 100, time_now)
+        self.stocks[2].add_transaction('buy', 10, 100, time_now)
+        self.assertAlmostEqual(self.market._refresh_index(later), (40*10*10)**(1/3.))
+
+    def test_subscription_tolerance(self):
+        moves = []
+        self.market.subscribe_index(moves.append, tolerance=0.1)
+        for stock in self.stocks:
+            stock.add_transaction('buy', 10, 100, datetime.datetime.now())
+        self.stocks[0].add_transaction('buy', 10.1, 100000, datetime.datetime.now())
+        self.stocks[0].add_transaction('buy', 20, 100000000, datetime.datetime.now())
+        self.assertEqual(len(moves), 2)
+        self.assertAlmostEqual(moves[0], 10)
+        self.market.unsubscribe_index(moves.append)
+        self.stocks[0].add_transaction('buy', 100, 1000000000, datetime.datetime.now())
+        self.assertEqual(len(moves), 2)
+
+
+class StockRegistryTests(TestCase):
+
+    def setUp(self):
+        self.market = Market()
+
+    def test_get_by_ticker(self):
+        common = Stock('GOOG')
+        preferred = Stock('GOOG', stock_type='preferred')
+        self.market.add_stocks([common, preferred])
+        self.assertIs(self.market.get('GOOG'), common)
+        self.assertIs(self.market.get('GOOG', 'preferred'), preferred)
+        self.assertRaises(LookupError, self.market.get, 'APPL')
+
+    def test_bulk_add_is_validated_first(self):
+        self.market.add_stock_to_market(Stock('TEA'))
+        self.assertRaises(LookupError, self.market.add_stocks, [Stock('GOOG'), Stock('TEA')])
+        self.assertRaises(LookupError, self.market.add_stocks, [Stock('POP'), Stock('POP')])
+        self.assertRaises(AttributeError, self.market.add_stocks, [Stock('GIN'), 'ALE'])
+        self.assertEqual([stock.ticker for stock in self.market.list_stocks()], ['TEA'])
+
+    def test_bulk_add_keeps_order(self):
+        stocks = [Stock('S%d' % i) for i in range(300)]
+        self.market.add_stocks(stocks)
+        self.assertEqual(self.market.list_stocks(), stocks)
+
+    def test_remove_equal_but_unlisted_stock(self):
+        self.market.add_stock_to_market(Stock('GOOG'))
+        self.assertRaises(ValueError, self.market.remove_stock_from_market, Stock('GOOG'))
+        self.assertEqual(len(self.market.list_stocks()), 1)
+
+    def test_listed_key_is_fixed(self):
+        goog = Stock('GOOG')
+        self.market.add_stock_to_market(goog)
+        with self.assertRaises(Exception):
+            goog.stock_type = 'preferred'
+        with self.assertRaises(Exception):
+            goog.ticker = 'GOOGL'
+        self.assertIs(self.market.get('GOOG'), goog)
+        goog.last_dividend = 3
+        self.market.remove_stock_from_market(goog)
+        goog.stock_type = 'preferred'
+        self.market.add_stock_to_market(goog)
+        self.assertIs(self.market.get('GOOG', 'preferred'), goog)
+
+
+class BatchIngestionTests(TestCase):
+
+    def setUp(self):
+        self.market = Market()
+        self.goog = Stock('GOOG')
+        self.appl = Stock('APPL')
+        self.market.add_stocks([self.goog, self.appl])
+        self.time_now = datetime.datetime.now()
+
+    def test_default_timestamp_is_current(self):
+        self.goog.add_transaction('buy', 10, 100)
+        self.assertLess(datetime.datetime.now() - self.goog.transactions[-1].timestamp,
+                        datetime.timedelta(seconds=5))
+
+    def test_add_transactions_sorts_and_merges(self):
+        self.goog.add_transaction('buy', 1, 1, self.time_now - datetime.timedelta(minutes=3))
+        self.goog.add_transaction('buy', 4, 1, self.time_now)
+        stamps = [self.time_now - datetime.timedelta(minutes=m) for m in (1, 5, 2)]
+        self.assertEqual(self.goog.add_transactions(['buy', 'SELL', 'buy'], [2, 0.5, 3], [1, 1, 1], stamps), 3)
+        self.assertEqual([t.price for t in self.goog.transactions], [0.5, 1, 3, 2, 4])
+        self.assertEqual(self.goog.transactions[0].signal, 'sell')
+        self.assertAlmostEqual(self.goog.price(), (0.5 + 1 + 3 + 2 + 4) / 5.)
+        self.assertAlmostEqual(self.goog.price(datetime.timedelta(minutes=2.5)), 3)
+
+    def test_batch_updates_read_window(self):
+        self.goog.add_transaction('buy', 10, 100, self.time_now - datetime.timedelta(minutes=1))
+        self.goog.price()
+        self.goog.add_transactions([1, 0], [20, 99], [100, 100],
+                                   [self.time_now, self.time_now - datetime.timedelta(minutes=30)])
+        self.assertEqual(self.goog.price(), 15)
+
+    def test_bad_batch_rejected_whole(self):
+        self.assertRaises(ValueError, self.goog.add_transactions, ['buy', 'hold'], [1, 1], [1, 1])
+        self.assertRaises(ValueError, self.goog.add_transactions, ['buy', 'buy'], [1, -1], [1, 1])
+        self.assertRaises(TypeError, self.goog.add_transactions, ['buy', 'buy'], [1, 'x'], [1, 1])
+        self.assertRaises(ValueError, self.goog.add_transactions, ['buy'], [1, 2], [1, 1])
+        self.assertEqual(len(self.goog.transactions), 0)
+
+    def test_empty_batch(self):
+        self.assertEqual(self.goog.add_transactions([], [], []), 0)
+        self.assertEqual(self.market.ingest([], [], [], []), 0)
+        self.assertEqual(self.market.ingest([], [], [], [], timestamps=[]), 0)
+        self.assertRaises(ValueError, self.goog.add_transactions, ['buy'], [], [])
+        self.assertEqual(len(self.goog.transactions), 0)
+
+    def test_market_ingest_routes_by_ticker(self):
+        rows = [('GOOG', 'buy', 10, 100, self.time_now),
+                ('APPL', 'sell', 20, 100, self.time_now),
+                ('GOOG', 'buy', 30, 100, self.time_now - datetime.timedelta(seconds=1))]
+        self.assertEqual(self.market.ingest_rows(rows), 3)
+        self.assertEqual([t.price for t in self.goog.transactions], [30, 10])
+        self.assertEqual(self.appl.price(), 20)
+
+    def test_market_ingest_unknown_ticker(self):
+        self.assertRaises(LookupError, self.market.ingest, ['GOOG', 'TEA'], ['buy', 'buy'], [1, 1], [1, 1])
+        self.assertEqual(len(self.goog.transactions), 0)
+
+
+class ValuationRatioTests(TestCase):
+
+    def setUp(self):
+        self.market = Market()
+        self.market.add_stocks([Stock('TEA'),
+                                Stock('POP', last_dividend=8),
+                                Stock('GIN', stock_type='preferred', last_dividend=8, fixed_dividend=0.02,
+                                      par_value=100)])
+
+    def test_matches_scalar_methods(self):
+        prices = [50, 80, 200]
+        dividend_yields, pe_ratios = self.market.valuation_ratios(prices)
+        for stock, price, dividend_yield, pe_ratio in zip(self.market.list_stocks(), prices, dividend_yields,
+                                                          pe_ratios):
+            self.assertAlmostEqual(dividend_yield, stock.dividend_yield(price))
+            if stock.last_dividend:
+                self.assertAlmostEqual(pe_ratio, stock.PE_ratio(price))
+            else:
+                self.assertEqual(pe_ratio, float('inf'))
+
+    def test_bad_prices(self):
+        dividend_yields, pe_ratios = self.market.valuation_ratios([0, -1, 10])
+        self.assertTrue(all(d != d for d in dividend_yields[:2]))
+        self.assertTrue(all(p != p for p in pe_ratios[:2]))
+        self.assertRaises(ValueError, self.market.valuation_ratios, [1, 2])
+        self.assertRaises(TypeError, self.market.valuation_ratios, ['a', 2, 3])
+
+    def test_metadata_changes_picked_up(self):
+        self.market.valuation_ratios([1, 1, 1])
+        self.market.get('TEA').last_dividend = 5
+        self.market.add_stock_to_market(Stock('ALE', last_dividend=1))
+        dividend_yields, pe_ratios = self.market.valuation_ratios([10, 10, 10, 10])
+        self.assertEqual(list(dividend_yields[[0, 3]]), [0.5, 0.1])
+        self.assertEqual(pe_ratios[0], 2)
+
+
+class RetentionTests(TestCase):
+
+    def setUp(self):
+        self.stock = Stock('GOOG')
+        self.start = datetime.datetime(2016, 3, 10, 8)
+
+    def test_memory_stays_flat(self):
+        self.stock.set_retention(datetime.timedelta(minutes=30))
+        for second in range(0, 4 * 3600, 10):
+            self.stock.add_transaction('buy', 10, 100, self.start + datetime.timedelta(seconds=second))
+        self.assertLessEqual(len(self.stock.transactions), (30 + 30 / 8.) * 6 + 1)
+        self.assertEqual(self.stock.history[0].volume, 600)
+        self.assertEqual(sum(bar.volume for bar in self.stock.history) + sum(self.stock.transactions.volumes),
+                         4 * 360 * 100)
+
+    def test_price_survives_compaction(self):
+        for minute in range(60):
+            self.stock.add_transaction('buy', minute, 1, self.start + datetime.timedelta(minutes=minute))
+        now_ns = datetime_to_ns(self.start + datetime.timedelta(minutes=59))
+        before = self.stock._price(now_ns=now_ns)
+        self.stock.set_retention(datetime.timedelta(minutes=20))
+        self.assertEqual(len(self.stock.transactions), 20)
+        self.assertEqual(self.stock._price(now_ns=now_ns), before)
+
+    def test_bars_from_evicted_trades(self):
+        for second, price in ((0, 5), (20, 9), (40, 1), (50, 4), (70, 6)):
+            self.stock.add_transaction('buy', price, 1, self.start + datetime.timedelta(seconds=second))
+        self.stock.set_retention(datetime.timedelta(minutes=15))
+        self.stock.compact(datetime_to_ns(self.start + datetime.timedelta(hours=1)))
+        bar = self.stock.history[0]
+        self.assertEqual((bar.start, bar.open, bar.high, bar.low, bar.close, bar.volume, bar.vwap),
+                         (self.start, 5, 9, 1, 4, 4, 19 / 4.))
+        self.assertEqual(len(self.stock.history), 2)
+        self.assertEqual(len(self.stock.transactions), 0)
+
+    def test_retention_shorter_than_window(self):
+        self.assertRaises(ValueError, self.stock.set_retention, datetime.timedelta(minutes=5))
+
+    def test_market_policy_applies_to_new_listings(self):
+        market = Market()
+        market.set_retention(datetime.timedelta(minutes=20))
+        market.add_stock_to_market(self.stock)
+        self.stock.add_transaction('buy', 1, 1, self.start)
+        self.stock.add_transaction('buy', 1, 1, self.start + datetime.timedelta(hours=1))
+        self.assertEqual(len(self.stock.transactions), 1)
+        self.assertEqual(market.compact(self.start + datetime.timedelta(hours=2)), 1)
+
+
+class ConcurrentIngestionTests(TestCase):
+
+    def test_parallel_writers_and_reader(self):
+        import threading
+        market = Market(incremental_index=True)
+        stocks = [Stock('S%d' % i) for i in range(8)]
+        market.add_stocks(stocks)
+        time_now = datetime.datetime.now()
+        indices = []
+
+        def write(stock):
+            for i in range(500):
+                stock.add_transaction('buy', 10, 1, time_now)
+
+        def read():
+            for i in range(200):
+                indices.append(market.all_share_index())
+
+        threads = [threading.Thread(target=write, args=(stock,)) for stock in stocks]
+        threads.append(threading.Thread(target=read))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([len(stock.transactions) for stock in stocks], [500] * 8)
+        self.assertTrue(all(index is None or abs(index - 10) < 1e-9 for index in indices))
+        self.assertAlmostEqual(market.all_share_index(), 10)
+
+    def test_incremental_index_not_left_stale(self):
+        import math
+        import threading
+        market = Market(incremental_index=True)
+        stocks = [Stock('S%d' % i) for i in range(50)]
+        market.add_stocks(stocks)
+        time_now = datetime.datetime.now()
+        done = []
+
+        def write(offset):
+            for i in range(2000):
+                stocks[(i * 7 + offset) % 50].add_transaction('buy', 1 + (i + offset) % 17, 1 + i % 5, time_now)
+
+        def read():
+            while not done:
+                market.all_share_index()
+
+        writers = [threading.Thread(target=write, args=(offset,)) for offset in range(4)]
+        reader = threading.Thread(target=read)
+        reader.start()
+        for thread in writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.append(True)
+        reader.join()
+        index = market.all_share_index()
+        for stock in stocks:
+            self.assertAlmostEqual(market._log_prices[stock], math.log(stock._price()))
+        self.assertAlmostEqual(index, math.exp(sum(math.log(stock.price()) for stock in stocks) / 50))
+
+    def test_snapshot_blocks_writers(self):
+        import threading
+        market = Market()
+        stock = Stock('GOOG')
+        market.add_stock_to_market(stock)
+        writer = threading.Thread(target=stock.add_transaction, args=('buy', 10, 1))
+        with market.snapshot() as stocks:
+            writer.start()
+            writer.join(0.05)
+            self.assertEqual(len(stocks[0].transactions), 0)
+        writer.join()
+        self.assertEqual(len(stock.transactions), 1)
+
+
+class TransactionRecordTests(TestCase):
+
+    def test_record_is_compact_and_immutable(self):
+        from ssm import Transaction
+        time_now = datetime.datetime(2016, 3, 10, 9, 30, 15, 250)
+        transaction = Transaction('BUY', 12.5, 100, time_now)
+        self.assertEqual(transaction.signal, 'buy')
+        self.assertEqual(transaction.timestamp_ns, datetime_to_ns(time_now))
+        self.assertEqual(transaction.timestamp, time_now)
+        self.assertEqual(Transaction('buy', 12.5, 100, transaction.timestamp_ns), transaction)
+        self.assertFalse(hasattr(transaction, '__dict__'))
+        self.assertRaises(AttributeError, setattr, transaction, 'price', 1)
+
+    def test_record_validated_on_construction(self):
+        from ssm import Transaction
+        self.assertRaises(ValueError, Transaction, 'hold', 1, 1)
+        self.assertRaises(ValueError, Transaction, 'buy', -1, 1)
+        self.assertRaises(ValueError, Transaction, 'buy', float('nan'), 1)
+        self.assertRaises(TypeError, Transaction, 'buy', 1, '1')
+        self.assertRaises(TypeError, Transaction, 'buy', 1, 1, '2016-03-10')
+        self.assertRaises(TypeError, Transaction, 'buy', 1, 1, None, 7)
+
+    def test_trader_and_book(self):
+        stock = Stock('GOOG')
+        time_now = datetime.datetime.now()
+        stock.add_transaction('buy', 10, 1, time_now)
+        stock.add_transaction('sell', 11, 2, time_now, trader='John', book='Sep-16')
+        stock.add_transaction('buy', 9, 3, time_now - datetime.timedelta(seconds=1), trader='Paul')
+        stock.add_transactions(['sell', 'buy'], [12, 13], [4, 5], [time_now, time_now], traders=['John', None])
+        self.assertEqual([(t.trader, t.book) for t in stock.transactions],
+                         [('Paul', None), (None, None), ('John', 'Sep-16'), ('John', None), (None, None)])
+        self.assertEqual(stock.query().price_range(11, 12).transactions()[0].book, 'Sep-16')
+        self.assertIsNone(Stock('POP').transactions.parties)
+
+    def test_stock_is_slotted(self):
+        stock = Stock('GOOG')
+        self.assertFalse(hasattr(stock, '__dict__'))
+        self.assertRaises(AttributeError, setattr, stock, 'colour', 'blue')
+
+
+class QueryTests(TestCase):
+
+    def setUp(self):
+        self.stock = Stock('GOOG')
+        self.day = datetime.datetime(2016, 3, 10)
+        self.stock.add_transactions(['buy', 'sell', 'buy', 'sell', 'buy', 'buy'], [10, 12, 11, 15, 9, 12],
+                                    [100, 50, 10, 500, 100, 75],
+                                    [self.day - datetime.timedelta(minutes=1),
+                                     self.day, self.day + datetime.timedelta(hours=9),
+                                     self.day + datetime.timedelta(hours=16), self.day + datetime.timedelta(days=1),
+                                     self.day + datetime.timedelta(days=1, hours=1)])
+
+    def test_filters(self):
+        self.assertEqual([t.price for t in self.stock.get_transactions_by_date(self.day.date())], [12, 11, 15])
+        self.assertEqual([t.price for t in self.stock.get_transactions_by_price_range(11, 12)], [12, 11, 12])
+        self.assertEqual([t.volume for t in self.stock.get_transactions_by_volume_range(60, 100)], [100, 100, 75])
+        self.assertEqual(len(self.stock.get_transactions_by_signal('SELL')), 2)
+        self.assertRaises(ValueError, self.stock.get_transactions_by_signal, 'hold')
+
+    def test_composed_and_lazy(self):
+        query = self.stock.get_transactions_by_price_range(9, 12).signal('buy')
+        self.assertEqual([t.price for t in query.on(self.day + datetime.timedelta(days=1))], [9, 12])
+        self.assertEqual(len(query.volume_range(0, 80)), 2)
+        self.assertEqual(len(query.price_range(11, 20).price_range(0, 11)), 1)
+        self.assertEqual(len(query.signal('sell')), 0)
+        self.stock.add_transaction('buy', 10.5, 1, self.day + datetime.timedelta(hours=12))
+        # the query is evaluated against the store as it is now, with the price index rebuilt after the write
+        self.assertEqual(len(query.on(self.day)), 2)
+        batch = query.columns()
+        self.assertEqual(batch.prices.tolist(), [10, 11, 10.5, 9, 12])
+        self.assertEqual(query.transactions()[0].timestamp, self.day - datetime.timedelta(minutes=1))
+
+    def test_sorted_index_kept_up_to_date(self):
+        import random
+        store = self.stock.transactions
+        generator = random.Random(1)
+        start_ns = datetime_to_ns(self.day + datetime.timedelta(days=2))
+        for step in range(200):
+            timestamp = self.day + datetime.timedelta(days=2, seconds=step)
+            if step % 50 == 49:
+                # a late print moves the stored rows, so the index is rebuilt
+                timestamp = self.day
+            self.stock.add_transaction('buy', generator.choice([10, 11, 12.5]), generator.randint(1, 9), timestamp)
+            if step % 7 == 0:
+                values, order = store.sorted_index('prices')
+                prices = list(store.prices)
+                self.assertEqual(values.tolist(), sorted(prices))
+                self.assertEqual(order.tolist(), sorted(range(len(prices)), key=prices.__getitem__))
+        self.assertEqual([t.price for t in self.stock.get_transactions_by_price_range(12.5, 15)
+                          .between(self.day + datetime.timedelta(days=2), self.day + datetime.timedelta(days=3))],
+                         [p for t, p in zip(store.timestamps, store.prices) if t >= start_ns and p >= 12.5])
+
+
+class BarAggregationTests(TestCase):
+
+    def setUp(self):
+        self.open = datetime.datetime(2016, 3, 10, 8)
+        self.market = Market()
+        self.tea = Stock('TEA', price_window=datetime.timedelta(minutes=2))
+        self.pop = Stock('POP', price_window=datetime.timedelta(minutes=2))
+        self.market.add_stocks([self.tea, self.pop])
+        self.tea.add_transaction('buy', 10, 100, self.open + datetime.timedelta(seconds=5))
+
+    def test_bars_built_as_trades_arrive(self):
+        self.market.aggregate_bars()
+        minute = datetime.timedelta(minutes=1)
+        self.tea.add_transaction('sell', 12, 100, self.open + datetime.timedelta(seconds=30))
+        self.tea.add_transactions(['buy', 'buy'], [8, 11], [200, 100],
+                                  [self.open + datetime.timedelta(seconds=40), self.open + datetime.timedelta(minutes=3)])
+        bars = self.tea.bars(minute)
+        self.assertEqual([(b.open, b.high, b.low, b.close, b.volume) for b in bars],
+                         [(10, 12, 8, 8, 400), (11, 11, 11, 11, 100)])
+        self.assertEqual(bars[0].start, self.open)
+        self.assertEqual(len(self.tea.bars(datetime.timedelta(seconds=1))), 4)
+        self.assertEqual(len(self.tea.bars(datetime.timedelta(hours=1), self.open, self.open + minute)), 1)
+        self.assertEqual(self.tea.historical_price(self.open, self.open + minute), (1000 + 1200 + 1600) / 400)
+        self.assertEqual(self.tea.historical_price(self.open, self.open + datetime.timedelta(seconds=30)), 10)
+        self.assertIsNone(self.tea.historical_price(self.open + minute, self.open + 2 * minute))
+        self.assertRaises(ValueError, self.tea.bars, datetime.timedelta(minutes=5))
+        self.market.add_stock_to_market(Stock('GIN'))
+        self.assertEqual(self.market.get('GIN').bars(minute), [])
+
+    def test_historical_index(self):
+        self.market.aggregate_bars([datetime.timedelta(minutes=1)])
+        self.pop.add_transaction('buy', 40, 100, self.open + datetime.timedelta(minutes=1, seconds=10))
+        self.tea.add_transaction('buy', 20, 300, self.open + datetime.timedelta(minutes=2, seconds=10))
+        series = self.market.historical_index(self.open, self.open + datetime.timedelta(minutes=4))
+        self.assertEqual([close for close, index in series],
+                         [self.open + datetime.timedelta(minutes=i) for i in range(1, 5)])
+        self.assertIsNone(series[0][1])
+        self.assertAlmostEqual(series[1][1], (10 * 40) ** 0.5)
+        # the first TEA trade has left the two bar window by the close of the third bar
+        self.assertAlmostEqual(series[2][1], (20 * 40) ** 0.5)
+        self.assertIsNone(series[3][1])
+
+
+class AsOfTests(TestCase):
+
+    def setUp(self):
+        self.open = datetime.datetime(2016, 3, 10, 8)
+        self.market = Market()
+        self.tea = Stock('TEA', price_window=datetime.timedelta(minutes=5))
+        self.pop = Stock('POP', price_window=datetime.timedelta(minutes=5))
+        self.market.add_stocks([self.tea, self.pop])
+        minute = datetime.timedelta(minutes=1)
+        self.tea.add_transactions(['buy'] * 4, [10, 20, 30, 40], [100, 100, 200, 100],
+                                  [self.open, self.open + 2 * minute, self.open + 6 * minute, self.open + 9 * minute])
+        self.pop.add_transactions(['sell'] * 2, [50, 60], [10, 30], [self.open + minute, self.open + 7 * minute])
+
+    def test_price_as_of(self):
+        minute = datetime.timedelta(minutes=1)
+        self.assertEqual(self.tea.price(as_of=self.open + 2 * minute), 15)
+        # the window is (as_of - 5 minutes, as_of], so the trade at exactly 5 minutes before has left it
+        self.assertEqual(self.tea.price(as_of=self.open + 5 * minute), 20)
+        self.assertEqual(self.tea.price(window=minute, as_of=self.open + 6 * minute), 30)
+        self.assertRaises(LookupError, self.tea.price, as_of=self.open - minute)
+
+    def test_index_as_of(self):
+        minute = datetime.timedelta(minutes=1)
+        self.assertAlmostEqual(self.market.all_share_index(as_of=self.open + 3 * minute), (15 * 50) ** 0.5)
+        self.assertIsNone(self.market.all_share_index(as_of=self.open + 12 * minute + datetime.timedelta(seconds=1)))
+
+    def test_index_series_matches_as_of(self):
+        series = self.market.index_series(self.open, self.open + datetime.timedelta(minutes=15),
+                                          datetime.timedelta(seconds=30))
+        self.assertEqual(len(series), 31)
+        self.assertEqual(series[-1][0], self.open + datetime.timedelta(minutes=15))
+        for point, index in series:
+            expected = self.market.all_share_index(as_of=point)
+            if expected is None:
+                self.assertIsNone(index)
+            else:
+                self.assertAlmostEqual(index, expected)
+        self.assertIsNotNone(series[6][1])
+
+
+class PriceCacheTests(TestCase):
+
+    def setUp(self):
+        self.time_now = datetime.datetime.now()
+        self.market = Market()
+        self.stock = Stock('GOOG')
+        self.market.add_stock_to_market(self.stock)
+
+    def test_price_cached_until_write(self):
+        self.stock.add_transaction('buy', 10, 100, self.time_now)
+        version = self.stock.cache_stats()['version']
+        self.assertEqual(self.stock.price(), 10)
+        self.assertEqual(self.stock.price(), 10)
+        self.assertEqual(self.stock.cache_stats(), {'hits': 1, 'misses': 1, 'version': version})
+        self.stock.add_transaction('buy', 20, 100, self.time_now)
+        self.assertEqual(self.stock.price(), 15)
+        self.assertEqual(self.stock.cache_stats()['misses'], 2)
+        self.assertGreater(self.stock.cache_stats()['version'], version)
+
+    def test_cache_expires_with_window(self):
+        now_ns = datetime_to_ns(self.time_now)
+        self.stock.add_transaction('buy', 10, 100, self.time_now - datetime.timedelta(minutes=14, seconds=59))
+        self.stock.add_transaction('buy', 20, 100, self.time_now)
+        self.assertEqual(self.stock._price(now_ns=now_ns), 15)
+        # no write, but the first trade has aged out of the window a second later
+        self.assertEqual(self.stock._price(now_ns=now_ns + timedelta_to_ns(datetime.timedelta(seconds=1))), 20)
+        self.assertEqual(self.stock.cache_stats()['hits'], 0)
+
+    def test_no_trades_cached_and_raised(self):
+        self.assertRaises(LookupError, self.stock.price)
+        self.assertRaises(LookupError, self.stock.price)
+        self.assertEqual(self.stock.cache_stats()['hits'], 1)
+
+    def test_index_cached(self):
+        self.assertIsNone(self.market.all_share_index())
+        self.stock.add_transaction('buy', 10, 100, self.time_now)
+        self.assertEqual(self.market.all_share_index(), 10)
+        self.assertEqual(self.market.all_share_index(), 10)
+        stats = self.market.cache_stats()
+        self.assertEqual((stats['index_hits'], stats['index_misses']), (1, 2))
+        self.market.add_stock_to_market(Stock('APPL'))
+        self.assertIsNone(self.market.all_share_index())
+        self.assertEqual(self.market.cache_stats()['index_misses'], 3)